@@ -20,6 +20,7 @@ Changed the algorithm slightly:
     - the original does the update (seems to) at the end
     of a slot; we run it at the start
 """
+from bisect import bisect_left
 import eh_constants as ehct
 
 class Kansal():
@@ -31,6 +32,10 @@ class Kansal():
     Run allocate at the start of a cycle, then in each slot
     run update to correct prediction errors.
     """
+    # the configuration, checked by EHSimulator.restore
+    parameters = ('eta', 't_slot', 'slots_per_cycle', 'engine')
+    # allocate orders the slots by time of day, see SimAlg.allocate
+    takes_cycle_slot = True
     
     def eh_coef(self, slot_idx, eh):
         """Computes kansal's coefficient for a dark slot
@@ -60,23 +65,40 @@ class Kansal():
         return ehct.emax*val
 
     
-    def __init__(self, eta, slots_per_cycle, t_slot):
+    def __init__(self, eta, slots_per_cycle, t_slot, engine='incremental'):
         """
         Parameters:
-        eta -- efficiency of battery storage
+        eta     -- efficiency of battery storage
+        engine  -- 'incremental' (update_incremental) or 'legacy'
+                   (update_legacy), both give the same allocations
         """
+        if engine not in ('incremental', 'legacy'):
+            raise ValueError("Unknown engine %s" % engine)
         self.allocation = [0 for i in xrange(slots_per_cycle)]
         self.allocated = 0
+        self.slots_per_cycle = slots_per_cycle
         self.eta = eta
         self.t_slot = t_slot
+        self.engine = engine
+        self.coef = []          # cost of a unit of duty cycle, per slot
+        self.raisable = []      # slots not at dmax, in order
+        self.lowerable = []     # slots above dmin, in order
 
-    def allocate(self, eh_pred, b0):
+    def allocate(self, eh_pred, b0, cycle_slot=0):
         """Kansal optimal
 
+        Parameters:
+        eh_pred     -- prediction for the slots of the plan
+        b0          -- battery at the start of the plan
+        cycle_slot  -- slot of the cycle the plan starts in, for plans
+                       re-planned within a cycle
+
         Returns    -- energy allocation in each slot
         """
         # convert EH to power
         self.eh = [float(eh)/self.t_slot for eh in eh_pred]
+        # the horizon is the length of the prediction
+        self.allocation = [0 for i in xrange(len(self.eh))]
         total_eh = sum([i*self.t_slot for i in self.eh])
         self.allocated = 0
         sunny_slots = []
@@ -94,8 +116,14 @@ class Kansal():
         # 2. how much energy have we allocated
         excess = total_eh - self.allocated
         if excess > 0 and len(dark_slots) > 0:
-            # underallocated, increase dark slots
-            dark_slots.sort(key=lambda x: self.eh_coef(x, self.eh))
+            # underallocated, increase dark slots; among equally good
+            # slots, by time of day, the same slot of every cycle of the
+            # horizon before the next slot: a horizon of several cycles
+            # isn't spent in its first cycle, and plans starting at any
+            # slot of the cycle fill the same slots (the order of the
+            # slots for a plan of a cycle)
+            spc = self.slots_per_cycle
+            dark_slots.sort(key=lambda x: (self.eh_coef(x, self.eh), (x + cycle_slot) % spc, (x + cycle_slot) // spc))
             # assign full dmax to as many slots as possible
             available_for = int(excess/Kansal.dc_to_e(ehct.dmax))
             if available_for > len(dark_slots):
@@ -112,10 +140,117 @@ class Kansal():
             per_slot = (self.allocated - total_eh)/float(len(sunny_slots))
             for i in sunny_slots:
                 self.allocation[i] -= Kansal.e_to_dc(per_slot)
+        if self.engine == 'incremental':
+            self.index_slots()
         # done
         return Kansal.dc_to_e(self.allocation[0])
 
+    def excess(self, slot_idx, eh_pred_prev, eh_real):
+        """Energy (as power) left over from the previous slot, negative
+        if more was consumed than planned
+        """
+        estimated = eh_pred_prev/float(self.t_slot)
+        eh_real_p = eh_real/float(self.t_slot)
+        if eh_real > ehct.pc:
+            return estimated - eh_real_p
+        return (estimated - eh_real_p)*(1 - self.allocation[slot_idx-1]*(1-1/self.eta))
+
+    def slot_coef(self, j):
+        """Energy (as power) per unit of duty cycle in slot j, R in update"""
+        if self.eh[j] > ehct.pc:
+            return ehct.pc
+        return ehct.pc/self.eta + self.eh[j]*(1-1/self.eta)
+
+    def index_slots(self):
+        """Set up the slot coefficients and the ordered lists of slots
+        that can be raised and lowered, used by update_incremental.
+        """
+        self.coef = [self.slot_coef(j) for j in xrange(len(self.eh))]
+        self.raisable = [j for j in xrange(len(self.eh)) if self.allocation[j] != ehct.dmax]
+        self.lowerable = [j for j in xrange(len(self.eh)) if self.allocation[j] > ehct.dmin]
+
+    def reindex_slot(self, j):
+        """Move slot j in or out of raisable and lowerable, after
+        its allocation changed
+        """
+        for slots, member in ((self.raisable, self.allocation[j] != ehct.dmax),
+                              (self.lowerable, self.allocation[j] > ehct.dmin)):
+            i = bisect_left(slots, j)
+            present = i < len(slots) and slots[i] == j
+            if member and not present:
+                slots.insert(i, j)
+            elif present and not member:
+                del slots[i]
+
     def update(self, slot_idx, eh_pred, eh_pred_prev, eh_real, prev_battery):
+        """Update the allocation to account for the difference
+        between observed and estimated harvested energy,
+        see update_legacy.
+        """
+        if self.engine == 'incremental':
+            return self.update_incremental(slot_idx, eh_pred_prev, eh_real)
+        return self.update_legacy(slot_idx, eh_pred, eh_pred_prev, eh_real, prev_battery)
+
+    def update_incremental(self, slot_idx, eh_pred_prev, eh_real):
+        """Same as update_legacy, visiting only the slots that can
+        still be raised (excess) or lowered (deficit).
+
+        Raising goes through the future slots in order and lowering
+        from the end of the cycle, and every slot but the last one
+        visited is set to dmax (dmin), so each correction costs a
+        bisection plus the slots it saturates.
+        """
+        excess = self.excess(slot_idx, eh_pred_prev, eh_real)
+        if excess == 0: return Kansal.dc_to_e(self.allocation[slot_idx])
+        changed = []
+        if excess > 0:
+            # increase consumption in the remaining slots, in order
+            slots = self.raisable
+            i = bisect_left(slots, slot_idx)
+            while i < len(slots):
+                j = slots[i]
+                r = self.coef[j]*(ehct.dmax - self.allocation[j])
+                changed.append(j)
+                if r < excess:
+                    excess -= r
+                    self.allocation[j] = ehct.dmax
+                    i += 1
+                else:
+                    self.allocation[j] += excess/self.coef[j]
+                    break
+        else:
+            # decrease consumption in the remaining slots, from the end
+            slots = self.lowerable
+            i = len(slots) - 1
+            while i >= 0 and slots[i] >= slot_idx:
+                j = slots[i]
+                r = self.coef[j]*(ehct.dmin - self.allocation[j])
+                changed.append(j)
+                if r > excess:
+                    excess -= r
+                    self.allocation[j] = ehct.dmin
+                    i -= 1
+                else:
+                    self.allocation[j] += excess/self.coef[j]
+                    break
+        for j in changed:
+            self.reindex_slot(j)
+        return Kansal.dc_to_e(self.allocation[slot_idx])
+
+    def update_batch(self, slot_idx, eh_pred_prev, eh_real):
+        """Apply the corrections for consecutive slots at once.
+
+        Parameters
+        slot_idx        -- index of the first slot
+        eh_pred_prev    -- eh prediction for the slot before each slot
+        eh_real         -- observed eh_value in the slot before each slot
+        Returns         -- energy allocation for each slot
+        """
+        update = self.update_incremental if self.engine == 'incremental' else \
+                lambda i, p, r: self.update_legacy(i, None, p, r, None)
+        return [update(slot_idx + k, p, r) for k, (p, r) in enumerate(zip(eh_pred_prev, eh_real))]
+
+    def update_legacy(self, slot_idx, eh_pred, eh_pred_prev, eh_real, prev_battery):
         """Update the allocation to account for the difference
         between observed and estimated harvested energy
 
@@ -8,9 +8,17 @@ It runs an algorithm to extract the energy allocation, it then computes
 the battery trace and determines if there are any violations.
 """
 
+import os
+import copy
+import pickle
+import hashlib
+import itertools
+from collections import deque, namedtuple
 from time import time
 import numpy as np
 
+from predictor import Predictor, MatrixPredictor, cycle_matrix, ewma_matrix
+
 class EHAlg():
     """Abstract base class for algorithms.
     This is purely indicative since there are no abstract classes in Python
@@ -22,46 +30,216 @@ class EHAlg():
     def update(self, slot_idx, eh_pred_crt, eh_pred_prev, eh_observed_prev, start_batt):
         pass
 
-class SimAlg():
-    """For maintaining and running an algorithm in the simulation"""
-    def __init__(self, name, alg, B0):
+# error codes in SimAlg.error_type
+no_error, waste, overspent = 0, 1, 2
+error_names = {waste: 'waste', overspent: 'overspent'}
+
+class RunningStats(object):
+    """Count, mean and standard deviation of a series of values, kept as
+    running sums (Welford) so that long simulations don't keep the values"""
+    __slots__ = ('count', '_mean', '_m2')
+
+    def __init__(self):
+        self.count = 0
+        self._mean = 0.
+        self._m2 = 0.
+
+    def __getstate__(self):
+        return (self.count, self._mean, self._m2)
+
+    def __setstate__(self, state):
+        self.count, self._mean, self._m2 = state
+
+    def add(self, x):
+        self.count += 1
+        delta = x - self._mean
+        self._mean += delta/self.count
+        self._m2 += delta*(x - self._mean)
+
+    @property
+    def mean(self):
+        return self._mean if self.count else float('nan')
+
+    @property
+    def std(self):
+        """As np.std, of all the values"""
+        return (self._m2/self.count)**0.5 if self.count else float('nan')
+
+class SimAlg(object):
+    """For maintaining and running an algorithm in the simulation.
+
+    The per-slot metrics are kept in arrays preallocated for num_slots
+    (grown if more slots are simulated), and the totals are kept as
+    running sums. See view and summary.
+    """
+    __slots__ = ('name', 'alg', 'bmin', 'bmax', 'history', 'slot_count',
+                 '_allocation', '_battery', '_harvested', '_predicted',
+                 '_error_type', '_error_quantity',
+                 'allocated', 'harvested', 'predicted', 'battery_level',
+                 'error_count', 'error_quantity', 'waste', 'overspent',
+                 'min_e_used', 'max_e_used', 'zero_e_slots')
+
+    def __init__(self, name, alg, B0, bmin=None, bmax=None, num_slots=0, history=True):
+        """
+        Parameters:
+        name        -- name of the algorithm
+        alg         -- algorithm instance
+        B0          -- initial battery level
+        bmin, bmax  -- battery thresholds, default from eh_constants
+        num_slots   -- number of slots to preallocate for
+        history     -- False to keep only the totals, not the per-slot metrics
+        """
         self.name = name
         self.alg = alg
-        self.allocation = []    # allocation for the full eh_trace
+        self.bmin = ehct.bmin if bmin is None else bmin
+        self.bmax = ehct.bmax if bmax is None else bmax
+        self.history = history
+        self.slot_count = 0
+        self._allocation = np.zeros(num_slots)      # allocation in each slot
+        self._battery = np.zeros(num_slots+1)       # battery at the start of each slot
+        self._battery[0] = B0
+        self._harvested = np.zeros(num_slots)
+        self._predicted = np.zeros(num_slots)
+        self._error_type = np.zeros(num_slots, dtype=np.int8)   # no_error/waste/overspent
+        self._error_quantity = np.zeros(num_slots)
+        self.allocated = 0      # cumulative sum of allocated energy
         self.harvested = 0      # cumulative sum of harvested energy
         self.predicted = 0      # cumulative sum of predicted harvested energy
-        self.battery = [B0]       # complete battery trace
-        self.errors = []        # {'idx', 'type':'waste'/'overspent', 'quantity'}
+        self.battery_level = B0
+        self.error_count = 0
+        self.error_quantity = 0 # cumulative quantity of the battery errors
+        self.waste = 0          # cumulative quantity of the waste errors
+        self.overspent = 0      # cumulative quantity of the overspent errors
         self.min_e_used = None
         self.zero_e_slots = 0   # number of slots when alg consumed 0
         self.max_e_used = None
-        self.slot_count = 0
+
+    def __getstate__(self):
+        """State for pickling (see EHSimulator.checkpoint), with the
+        per-slot metrics of the simulated slots only"""
+        state = dict((name, getattr(self, name)) for name in self.__slots__)
+        n = self.slot_count
+        for name in ('_allocation', '_harvested', '_predicted', '_error_type', '_error_quantity'):
+            state[name] = state[name][:n]
+        state['_battery'] = self._battery[:n+1]
+        state['num_slots'] = len(self._allocation)
+        return state
+
+    def __setstate__(self, state):
+        num_slots = state.pop('num_slots')
+        for name, value in state.items():
+            setattr(self, name, value)
+        # preallocate again, as in __init__
+        for name in ('_allocation', '_harvested', '_predicted', '_error_type', '_error_quantity', '_battery'):
+            a = getattr(self, name)
+            full = np.zeros(num_slots + (name == '_battery'), dtype=a.dtype)
+            full[:len(a)] = a
+            setattr(self, name, full)
+
+    def _grow(self):
+        n = max(1, 2*len(self._allocation))
+        for name in ('_allocation', '_harvested', '_predicted', '_error_type', '_error_quantity'):
+            a = getattr(self, name)
+            grown = np.zeros(n, dtype=a.dtype)
+            grown[:len(a)] = a
+            setattr(self, name, grown)
+        grown = np.zeros(n+1)
+        grown[:len(self._battery)] = self._battery
+        self._battery = grown
 
     def update_metrics(self, e, eh, eh_pred):
-        self.allocation.append(e)
+        """Account for a slot. Returns the battery error, as
+        (error type, quantity).
+        """
+        i = self.slot_count
+        error = (no_error, 0)
+        self.allocated += e
         self.harvested += eh
         self.predicted += eh_pred
         self.slot_count += 1
-        b = self.battery[-1] + eh - e
+        b = self.battery_level + eh - e
         if self.min_e_used == None or e < self.min_e_used:
             self.min_e_used = e
         if self.max_e_used == None or e > self.max_e_used:
             self.max_e_used = e
         if e == 0:
             self.zero_e_slots += 1
-        if b < ehct.bmin:
-            self.errors.append({'idx':len(self.allocation)-1, 'type':'overspent', 'quantity': ehct.bmin - b})
-            b = ehct.bmin
-        elif b > ehct.bmax:
-            self.errors.append({'idx':len(self.allocation)-1, 'type':'waste', 'quantity': b - ehct.bmax})
-            b = ehct.bmax
-        self.battery.append(b)
-
-    def allocate(self, eh_pred):
+        if b < self.bmin:
+            error = (overspent, self.bmin - b)
+            self.overspent += self.bmin - b
+            self.error_quantity += self.bmin - b
+            self.error_count += 1
+            b = self.bmin
+        elif b > self.bmax:
+            error = (waste, b - self.bmax)
+            self.waste += b - self.bmax
+            self.error_quantity += b - self.bmax
+            self.error_count += 1
+            b = self.bmax
+        self.battery_level = b
+        if self.history:
+            if i == len(self._allocation):
+                self._grow()
+            self._allocation[i] = e
+            self._harvested[i] = eh
+            self._predicted[i] = eh_pred
+            self._error_type[i], self._error_quantity[i] = error
+            self._battery[i+1] = b
+        return error
+
+    @property
+    def allocation(self):
+        """Allocation for the simulated slots"""
+        return self._allocation[:self.slot_count]
+
+    @property
+    def battery(self):
+        """Battery trace, starting with B0"""
+        return self._battery[:self.slot_count+1]
+
+    @property
+    def errors(self):
+        """The battery errors as [{'idx', 'type':'waste'/'overspent', 'quantity'}]"""
+        idx = np.flatnonzero(self._error_type[:self.slot_count])
+        return [{'idx': i, 'type': error_names[self._error_type[i]], 'quantity': self._error_quantity[i]} for i in idx]
+
+    def view(self):
+        """The per-slot metrics as arrays (views, not copies):
+        allocation, battery (slot_count+1 values, starting with B0),
+        harvested, predicted, error_type and error_quantity.
+        """
+        n = self.slot_count
+        return {'allocation': self._allocation[:n],
+                'battery': self._battery[:n+1],
+                'harvested': self._harvested[:n],
+                'predicted': self._predicted[:n],
+                'error_type': self._error_type[:n],
+                'error_quantity': self._error_quantity[:n]}
+
+    def summary(self):
+        """The totals of the simulation so far"""
+        return {'allocated': self.allocated,
+                'harvested': self.harvested,
+                'predicted': self.predicted,
+                'errors': self.error_count,
+                'error_quantity': self.error_quantity,
+                'waste': self.waste,
+                'overspent': self.overspent,
+                'final': self.battery_level,
+                'slots': self.slot_count,
+                'min_e_used': self.min_e_used,
+                'max_e_used': self.max_e_used,
+                'zero_e_slots': self.zero_e_slots}
+
+    def allocate(self, eh_pred, cycle_slot=0):
         """Allocate energy for slots up until the finite horizon,
-        using the harvesting prediction eh_pred.
+        using the harvesting prediction eh_pred. cycle_slot, the slot of
+        the cycle the plan starts in, is passed to the algorithms that
+        take it (takes_cycle_slot).
         """
-        e = self.alg.allocate(eh_pred, self.battery[-1])
+        if getattr(self.alg, 'takes_cycle_slot', False):
+            return self.alg.allocate(eh_pred, self.battery_level, cycle_slot)
+        e = self.alg.allocate(eh_pred, self.battery_level)
         return e
 
     def update(self, slot_idx, eh_pred, eh_pred_prev, eh_observed):
@@ -73,17 +251,99 @@ class SimAlg():
         eh_pred_prev  -- prediction for the previous slot
         eh_observed   -- observed eh in the previous slot
         """
-        e = self.alg.update(slot_idx, eh_pred, eh_pred_prev, eh_observed, self.battery[-1])
+        e = self.alg.update(slot_idx, eh_pred, eh_pred_prev, eh_observed, self.battery_level)
         return e
 
     def pretty_print(self):
+        s = self.summary()
         print "Algorithm:", self.name
-        print "Total allocated %d vs harvested %d predicted %d. Ratio %2.2f. Emin %.2f Emax %.2f Zero slots %d" % (sum(self.allocation), self.harvested, self.predicted, sum(self.allocation)/float(self.harvested), self.min_e_used, self.max_e_used, self.zero_e_slots)
-        print "Battery errors %d total slots %d quantity %d. Waste %d overspent %d. Final %f" % (len(self.errors), self.slot_count, sum([e['quantity'] for e in self.errors]), sum([e['quantity'] for e in self.errors if e['type'] == 'waste']), sum([e['quantity'] for e in self.errors if e['type'] == 'overspent']), self.battery[-1])
-        return [sum(self.allocation), self.harvested, sum([e['quantity'] for e in self.errors]), self.battery[-1]]
+        print "Total allocated %d vs harvested %d predicted %d. Ratio %2.2f. Emin %.2f Emax %.2f Zero slots %d" % (s['allocated'], s['harvested'], s['predicted'], s['allocated']/float(s['harvested']), s['min_e_used'], s['max_e_used'], s['zero_e_slots'])
+        print "Battery errors %d total slots %d quantity %d. Waste %d overspent %d. Final %f" % (s['errors'], s['slots'], s['error_quantity'], s['waste'], s['overspent'], s['final'])
+        return [s['allocated'], s['harvested'], s['error_quantity'], s['final']]
+
+def read_samples(trace_file):
+    """Read the irradiance column of an EH trace file into an array.
+    Lines starting with ',' (the csv header) are skipped.
+    """
+    with open(trace_file) as f:
+        text = ''.join([l for l in f if l[0] != ','])
+    return np.fromstring(text.strip().replace('\n', ','), sep=',').reshape(-1, 2)[:, 1]
+
+def aggregate_slots(samples, sampling_interval, slot_length, panel_area, div_factor, drop_last=True):
+    """Convert irradiance samples (uW/cm2) into harvested energy per slot (J).
+    As in the original loader, the last (possibly partial) slot is dropped,
+    unless drop_last is False, in which case only partial slots are.
+    """
+    per_slot = slot_length/sampling_interval
+    if drop_last:
+        num_slots = (len(samples)-1)/per_slot
+    else:
+        num_slots = len(samples)/per_slot
+    samples = np.asarray(samples[:num_slots*per_slot], dtype=np.float64)
+    energy = samples*panel_area*sampling_interval/(10**6*div_factor)
+    return energy.reshape(num_slots, per_slot).sum(axis=1)
+
+def iter_samples(trace_file, chunk_lines=1<<16):
+    """Read the irradiance column of an EH trace file in chunks of
+    chunk_lines lines, as arrays, see read_samples.
+    """
+    with open(trace_file) as f:
+        while True:
+            lines = [l for l in itertools.islice(f, chunk_lines) if l[0] != ',']
+            if not lines:
+                break
+            text = ''.join(lines)
+            yield np.fromstring(text.strip().replace('\n', ','), sep=',').reshape(-1, 2)[:, 1]
 
-class EHTrace():
-    def __init__(self, trace_file, sampling_interval, slot_length, panel_area, div_factor):
+def stream_slots(chunks, sampling_interval, slot_length, panel_area, div_factor):
+    """aggregate_slots for samples coming in chunks (arrays or lists).
+    Yields the energy of each slot, as soon as the sample after it is
+    read, so the last slot is dropped as by aggregate_slots.
+    """
+    per_slot = slot_length/sampling_interval
+    pending = np.zeros(0)
+    for chunk in chunks:
+        pending = np.concatenate((pending, np.asarray(chunk, dtype=np.float64)))
+        num_slots = (len(pending)-1)/per_slot
+        if num_slots <= 0:
+            continue
+        for e in aggregate_slots(pending, sampling_interval, slot_length, panel_area, div_factor):
+            yield e
+        pending = pending[num_slots*per_slot:]
+
+def load_trace(trace_file, sampling_interval, slot_length, panel_area, div_factor, cache_dir=None, use_cache=True):
+    """Load a trace file and aggregate it into slots.
+    The aggregated trace is cached as .npy, keyed by the file hash and
+    the aggregation parameters, so subsequent loads skip the parsing.
+
+    cache_dir   -- where to keep the cache, default is .trace_cache next
+                   to the trace file
+    use_cache   -- set to False to always parse the file
+    """
+    if not use_cache:
+        return aggregate_slots(read_samples(trace_file), sampling_interval, slot_length, panel_area, div_factor)
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(trace_file)), '.trace_cache')
+    sha = hashlib.sha1()
+    with open(trace_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), ''):
+            sha.update(chunk)
+    key = '%s_%s_%r_%r_%r_%r' % (os.path.basename(trace_file), sha.hexdigest()[:16], sampling_interval, slot_length, panel_area, div_factor)
+    cache_file = os.path.join(cache_dir, key + '.npy')
+    if os.path.exists(cache_file):
+        return np.load(cache_file)
+    trace = aggregate_slots(read_samples(trace_file), sampling_interval, slot_length, panel_area, div_factor)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    # write to a temporary name first, concurrent loaders may race
+    tmp_file = '%s.%d.tmp' % (cache_file, os.getpid())
+    with open(tmp_file, 'wb') as f:
+        np.save(f, trace)
+    os.rename(tmp_file, cache_file)
+    return trace
+
+class EHTrace(object):
+    def __init__(self, trace_file, sampling_interval, slot_length, panel_area, div_factor, cache_dir=None):
         """
         An EH trace imported from a file.
         The file needs to have on each line: <measurement index, irrad (uW/cm2)>.
@@ -93,16 +353,74 @@ class EHTrace():
         slot_length         -- time slot length for the algorithm
         panel_area          -- size of panel in cm2
         div_factor          -- allows dividing the harvested energy.
+        cache_dir           -- location of the aggregated trace cache, see load_trace
         """
-        with open(trace_file) as f:
-            eh_trace0 = [float(l.split(',')[1]) for l in f if l[0] != ',']
-            eh_trace = [sum([eh*panel_area*sampling_interval/(10**6*div_factor) for eh in eh_trace0[i*(slot_length/sampling_interval):(i+1)*(slot_length/sampling_interval)]]) for i in xrange((len(eh_trace0)-1)/(slot_length/sampling_interval))]
-            self.trace = eh_trace
+        trace = load_trace(trace_file, sampling_interval, slot_length, panel_area, div_factor, cache_dir)
+        self._setup(trace, sampling_interval, slot_length, panel_area, div_factor)
+
+    def _setup(self, trace, sampling_interval, slot_length, panel_area, div_factor):
+        self.trace = trace
         self.sampling_interval = sampling_interval
         self.slot_length = slot_length
         self.slots_per_cycle = 24*3600/self.slot_length
         self.panel_area = panel_area
         self.div_factor = div_factor
+        self._matrices = {}
+
+    def cycle_matrix(self):
+        """The trace as a (cycles x slots_per_cycle) read-only matrix,
+        see predictor.cycle_matrix.
+        """
+        if 'cycles' not in self._matrices:
+            m = cycle_matrix(self.trace, self.slots_per_cycle)
+            m.flags.writeable = False
+            self._matrices['cycles'] = m
+        return self._matrices['cycles']
+
+    def ewma_matrix(self, alpha):
+        """The EWMA predictions for the trace, see predictor.ewma_matrix.
+        Computed once per alpha.
+        """
+        if alpha not in self._matrices:
+            m = ewma_matrix(self.trace, self.slots_per_cycle, alpha)
+            m.flags.writeable = False
+            self._matrices[alpha] = m
+        return self._matrices[alpha]
+
+    @classmethod
+    def from_store(cls, store, station, year=None, season=None, slot_length=3600, panel_area=25, div_factor=100):
+        """
+        An EH trace for a selection of a trace_store.TraceStore, e.g.
+        EHTrace.from_store(store, '725315', 2003, 'summer').
+        The irradiance samples are kept as a view on the store (samples).
+        """
+        self = cls.__new__(cls)
+        self.samples = store.select(station, year, season)
+        trace = aggregate_slots(self.samples, store.sampling_interval, slot_length, panel_area, div_factor, drop_last=False)
+        self._setup(trace, store.sampling_interval, slot_length, panel_area, div_factor)
+        return self
+
+    @classmethod
+    def from_slots(cls, trace, slot_length, panel_area=25, div_factor=100):
+        """
+        An EH trace from the energy harvested in each slot, e.g. a
+        synthetic one. panel_area and div_factor are only recorded.
+        """
+        self = cls.__new__(cls)
+        self._setup(np.asarray(trace, dtype=np.float64), slot_length, slot_length, panel_area, div_factor)
+        return self
+
+    def rescaled(self, panel_area, div_factor):
+        """
+        The same trace for a different panel area and divisor.
+        The harvested energy is linear in both, so the aggregated
+        trace is scaled instead of reloaded.
+        """
+        other = self.__class__.__new__(self.__class__)
+        other.__dict__.update(self.__dict__)
+        scale = (float(panel_area)/self.panel_area)*(float(self.div_factor)/div_factor)
+        other._setup(self.trace*scale, self.sampling_interval, self.slot_length, panel_area, div_factor)
+        return other
 
     def __len__(self):
         return len(self.trace)
@@ -110,46 +428,164 @@ class EHTrace():
     def __getitem__(self, k):
         return self.trace.__getitem__(k)
 
+class EHTraceStream(object):
+    def __init__(self, samples, sampling_interval, slot_length, panel_area, div_factor):
+        """
+        An EH trace read lazily, for EHSimulator.run_stream.
+        Parameters:
+        samples             -- EH trace file (see EHTrace), or an iterable
+                               of irradiance samples or of chunks (arrays)
+                               of samples
+        sampling_interval, slot_length, panel_area, div_factor -- as for EHTrace
+        """
+        self.samples = samples
+        self.sampling_interval = sampling_interval
+        self.slot_length = slot_length
+        self.slots_per_cycle = 24*3600/self.slot_length
+        self.panel_area = panel_area
+        self.div_factor = div_factor
+
+    def __iter__(self):
+        """The energy of each slot, as EHTrace would have them"""
+        if isinstance(self.samples, basestring):
+            chunks = iter_samples(self.samples)
+        else:
+            chunks = self._chunks()
+        return stream_slots(chunks, self.sampling_interval, self.slot_length, self.panel_area, self.div_factor)
+
+    def _chunks(self, size=1<<16):
+        """The samples in chunks: chunks (arrays) as they come, single
+        samples in lists of size, so that only one chunk is in memory"""
+        it = iter(self.samples)
+        for first in it:
+            if np.ndim(first) != 0:
+                yield first
+                for chunk in it:
+                    yield chunk
+                return
+            yield [first] + list(itertools.islice(it, size - 1))
+            while True:
+                chunk = list(itertools.islice(it, size))
+                if not chunk:
+                    return
+                yield chunk
+
 import eh_constants as ehct
-from predictor import Predictor
 class DummyPredictor():
+    shared = ('trace',)     # not part of the state, see EHSimulator.checkpoint
+
     def __init__(self, trace, slots_per_cycle):
         self.trace = trace
         self.slots_per_cycle = slots_per_cycle
-        self.index = 0
+        self.added = 0
 
     def add_value(self, val):
-        pass
+        self.added += 1
 
     def predict_cycle(self):
-        self.index += self.slots_per_cycle
         #print "Using Dummy predictor"
-        return self.trace[self.index:self.index+self.slots_per_cycle]
+        return self.trace[self.added:self.added+self.slots_per_cycle]
 
     def predict(self, idx):
-        return self.trace[self.index+idx]
+        # idx is in the current cycle
+        return self.trace[self.added - self.added%self.slots_per_cycle + idx]
+
+    def predict_horizon(self, length):
+        return self.trace[self.added:self.added+length]
+
+class CycleOracle():
+    """Predicts the cycle given to set_cycle, the oracle for run_stream"""
+    def __init__(self):
+        self.cycle = None
+        self.added = 0      # slots of the cycle added so far
+
+    def set_cycle(self, cycle):
+        self.cycle = cycle
+        self.added = 0
+
+    def add_value(self, val):
+        self.added += 1
+
+    def predict_cycle(self):
+        return self.cycle
+
+    def predict_horizon(self, length):
+        if self.added + length > len(self.cycle):
+            raise ValueError("The oracle of a stream only knows the current cycle")
+        return self.cycle[self.added:self.added+length]
+
+    def predict(self, idx):
+        return self.cycle[idx]
+
+# one slot of one algorithm, from EHSimulator.run_stream; battery is the
+# level at the end of the slot
+SlotRecord = namedtuple('SlotRecord', ['slot', 'algorithm', 'allocation', 'harvested',
+        'predicted', 'battery', 'error_type', 'error_quantity'])
 
 class EHSimulator():
-    def __init__(self, eh_trace, b0, dummy_predictor=False):
+    def __init__(self, eh_trace, b0, dummy_predictor=False, bmin=None, bmax=None, precomputed=False, predictor=None,
+                 horizon=None, replan_every=None):
         """
         Parameters:
-        eh_trace    -- energy harvesting trace
+        eh_trace    -- energy harvesting trace, EHTrace or EHTraceStream
         b0          -- initial battery value
         dummy_predictor -- True if want to use oracle, false for EWMA
+        bmin, bmax  -- battery thresholds, default from eh_constants
+        precomputed -- True to replay the predictions from the trace's
+                       matrices (MatrixPredictor) instead of running the
+                       predictor; the algorithms then get a read-only
+                       cycle prediction that doesn't change during the cycle
+        predictor   -- a predictor to use instead, e.g. from
+                       PredictorBank.predictor; a new one for every run
+        horizon     -- slots the algorithms plan for, e.g. a week
+        replan_every -- slots between two plans, at most horizon
+                       Without horizon and replan_every, the algorithms
+                       plan at the start of every cycle, for the cycle
+                       (predict_cycle). Otherwise they plan for horizon
+                       slots (default slots_per_cycle), every replan_every
+                       slots (default the shorter of horizon and
+                       slots_per_cycle) from the first simulated slot, with
+                       the predictor's predict_horizon; update gets the
+                       slot's index in the plan.
         """
+        spc = eh_trace.slots_per_cycle
+        if horizon is not None or replan_every is not None:
+            if horizon is None:
+                horizon = spc
+            if replan_every is None:
+                replan_every = min(horizon, spc)
+            if not 0 < replan_every <= horizon:
+                raise ValueError("Can't plan for %s slots every %s slots" % (horizon, replan_every))
+        self.horizon = horizon
+        self.replan_every = replan_every
+        self.slot_count = 0     # slots simulated, for replan_every
+        self.last_pred = None   # prediction of the previous slot, for replan_every
+        self.started = False    # see start
+        self.resumed_finished = False   # see run
         self.eh_trace=eh_trace
         self.b0=b0
+        self.bmin = bmin
+        self.bmax = bmax
         # TODO comment this next line to use the dummy predictor
         self.dummy_predictor = dummy_predictor
+        self.precomputed = precomputed
+        self.custom_predictor = predictor
         if not self.dummy_predictor:
             self.predictor = Predictor(self.eh_trace.slots_per_cycle, ehct.pred_alpha)
         self.algorithms = []
+        # allocate times per algorithm, and MALLEC's battery slots per plan
         self.runtime = {}
-        self.mallec_batt_slots = []
+        self.mallec_batt_slots = RunningStats()
 
     def add_algorithm(self, name, alg):
-        self.algorithms.append(SimAlg(name, alg, self.b0))
-        self.runtime[name] = []
+        if isinstance(self.eh_trace, EHTraceStream):
+            # only the totals, in constant memory
+            sim_alg = SimAlg(name, alg, self.b0, self.bmin, self.bmax, history=False)
+        else:
+            num_slots = len(self.eh_trace) - self.eh_trace.slots_per_cycle
+            sim_alg = SimAlg(name, alg, self.b0, self.bmin, self.bmax, num_slots)
+        self.algorithms.append(sim_alg)
+        self.runtime[name] = RunningStats()
 
     def load_trace(self, trace_file, sampling_interval, panel_area, factor):
         """Load a trace from file, considering:
@@ -158,50 +594,255 @@ class EHSimulator():
         panel_area          -- size of panel to be used in the simulation
         factor              -- factor to divide the trace
         """
-        with open(trace_file) as f:
-            eh_trace0 = [float(l.split(',')[1]) for l in f if l[0] != ',']
-            eh_trace = [sum([eh*panel_area*sampling_interval/(10**6*factor) for eh in eh_trace0[i*(ehct.t_slot/sampling_interval):(i+1)*(ehct.t_slot/sampling_interval)]]) for i in xrange((len(eh_trace0)-1)/(ehct.t_slot/sampling_interval))]
-            self.eh_trace = eh_trace
+        self.eh_trace = load_trace(trace_file, sampling_interval, ehct.t_slot, panel_area, factor)
 
-    def run(self):
+    def run(self, checkpoint_every=None, checkpoint_file=None):
         """Runs the simulation for the given trace and with the registered
-        algorithms.
+        algorithms, from where it was (see advance and restore).
         Prints the results.
         Returns the results as follows:
             for each algorithm, [allocated, harvested, errors, final]
+
+        checkpoint_every -- cycles between two checkpoints written to
+                            checkpoint_file (see save_checkpoint); if the
+                            file exists, the run resumes from it.
+                            resumed_finished tells if the run was already
+                            finished there, and so wasn't simulated at all.
         """
+        if isinstance(self.eh_trace, EHTraceStream):
+            for record in self.run_stream():
+                pass
+            return self.results()
+        self.resumed_finished = False
+        if checkpoint_file is not None and os.path.exists(checkpoint_file):
+            with open(checkpoint_file, 'rb') as f:
+                self.restore(f.read())
+            self.resumed_finished = self.finished()
+        while self.advance(checkpoint_every):
+            if checkpoint_file is not None:
+                self.save_checkpoint(checkpoint_file)
+        if checkpoint_file is not None:
+            self.save_checkpoint(checkpoint_file)
+        return self.results()
+
+    def _make_predictor(self):
+        """The predictor for a run over the whole trace"""
         num_slots = len(self.eh_trace)
         # TODO uncomment this next to use the dummy predictor
-        if self.dummy_predictor:
-            self.predictor = DummyPredictor(self.eh_trace, self.eh_trace.slots_per_cycle)
-        day = 0
-        # first cycle is only for obtaining the prediction, no algorithms run
+        if self.custom_predictor is not None:
+            return self.custom_predictor
+        elif self.precomputed and self.dummy_predictor:
+            return MatrixPredictor(self.eh_trace.cycle_matrix(), self.eh_trace.slots_per_cycle, True, num_slots)
+        elif self.precomputed:
+            return MatrixPredictor(self.eh_trace.ewma_matrix(ehct.pred_alpha), self.eh_trace.slots_per_cycle)
+        elif self.dummy_predictor:
+            return DummyPredictor(self.eh_trace, self.eh_trace.slots_per_cycle)
+        return Predictor(self.eh_trace.slots_per_cycle, ehct.pred_alpha)
+
+    def start(self):
+        """Set up a run over the whole trace: the first cycle is only for
+        obtaining the prediction, no algorithms run"""
+        self.predictor = self._make_predictor()
+        self.slot_count = 0
         for eh in self.eh_trace[:self.eh_trace.slots_per_cycle]:
             self.predictor.add_value(eh)
+        self.started = True
+
+    def finished(self):
+        """True once all the slots of the trace are simulated"""
+        return self.started and self.slot_count >= len(self.eh_trace) - self.eh_trace.slots_per_cycle
+
+    def advance(self, cycles=None):
+        """Simulate the algorithms for (at most) the given number of
+        cycles, all the remaining ones by default, starting the run
+        if needed. Returns True if slots remain to simulate.
+        """
+        if not self.started:
+            self.start()
+        spc = self.eh_trace.slots_per_cycle
+        num_slots = len(self.eh_trace) - spc
+        stop = num_slots if cycles is None else min(num_slots, (self.slot_count//spc + cycles)*spc)
         # run the algorithms for the remainder of the trace
-        for idx, eh in enumerate(self.eh_trace[self.eh_trace.slots_per_cycle:]):
-            _idx = idx%self.eh_trace.slots_per_cycle
-            if _idx == 0:
+        for idx in xrange(self.slot_count, stop):
+            _idx = idx%spc
+            self.simulate_slot(_idx, self.eh_trace[spc+idx], self.eh_trace[idx-1] if idx else None)
+        return self.slot_count < num_slots
+
+    def checkpoint(self):
+        """The state of the run, to resume it later with restore:
+        the position in the trace, the state of the predictor and of
+        every algorithm (SimAlg, with the metrics of the simulated
+        slots, and the algorithm instance). The trace and the
+        precomputed predictions are not included, they come from the
+        simulator restoring it. Returns a string (pickle).
+        """
+        if isinstance(self.eh_trace, EHTraceStream):
+            raise ValueError("Checkpoints need the full trace")
+        shared = getattr(self.predictor, 'shared', ()) if self.started else ()
+        state = {'trace': (len(self.eh_trace), self.eh_trace.slots_per_cycle),
+                 'planning': (self.horizon, self.replan_every),
+                 'started': self.started,
+                 'slot_count': self.slot_count,
+                 'last_pred': self.last_pred,
+                 'predictor': dict((k, v) for k, v in vars(self.predictor).items() if k not in shared)
+                              if self.started else None,
+                 'algorithms': self.algorithms,
+                 'runtime': self.runtime,
+                 'mallec_batt_slots': self.mallec_batt_slots}
+        return pickle.dumps(state, pickle.HIGHEST_PROTOCOL)
+
+    def save_checkpoint(self, path):
+        """Write a checkpoint to path, replacing it at once"""
+        with open(path + '.tmp', 'wb') as f:
+            f.write(self.checkpoint())
+        os.rename(path + '.tmp', path)
+
+    def restore(self, checkpoint):
+        """Continue from a checkpoint of a simulation of the same trace,
+        in the same mode, with the same algorithms (their instances are
+        replaced by those of the checkpoint). The algorithms must have
+        the same names, classes, battery thresholds and parameters (the
+        attributes named in the parameters of their class)."""
+        state = pickle.loads(checkpoint)
+        if state['trace'] != (len(self.eh_trace), self.eh_trace.slots_per_cycle):
+            raise ValueError("The checkpoint is of a different trace")
+        if state['planning'] != (self.horizon, self.replan_every):
+            raise ValueError("The checkpoint plans with a different horizon")
+        names = [a.name for a in self.algorithms]
+        if [a.name for a in state['algorithms']] != names:
+            raise ValueError("The checkpoint is of the algorithms %s, not %s"
+                             % ([a.name for a in state['algorithms']], names))
+        for a, saved in zip(self.algorithms, state['algorithms']):
+            if a.alg.__class__ is not saved.alg.__class__:
+                raise ValueError("The checkpoint's %s is a %s" % (a.name, saved.alg.__class__.__name__))
+            for p in ('bmin', 'bmax'):
+                if getattr(a, p) != getattr(saved, p):
+                    raise ValueError("The checkpoint's %s has %s %r, not %r" % (a.name, p, getattr(saved, p), getattr(a, p)))
+            for p in getattr(a.alg, 'parameters', ()):
+                if getattr(a.alg, p, None) != getattr(saved.alg, p, None):
+                    raise ValueError("The checkpoint's %s has %s %r, not %r"
+                                     % (a.name, p, getattr(saved.alg, p, None), getattr(a.alg, p, None)))
+        self.algorithms = state['algorithms']
+        self.runtime = state['runtime']
+        self.mallec_batt_slots = state['mallec_batt_slots']
+        self.slot_count = state['slot_count']
+        self.last_pred = state.get('last_pred')
+        self.started = state['started']
+        if self.started:
+            # the shared parts (e.g. precomputed predictions) from this
+            # simulator, the rest from the checkpoint
+            self.predictor = copy.copy(self._make_predictor())
+            vars(self.predictor).update(state['predictor'])
+
+    def fork(self, count=None):
+        """Copies of the simulation at its current position, which
+        continue independently, e.g. after changing the parameters of
+        their algorithms:
+
+            branch = sim.fork()
+            branch.algorithms[0].alg.eta = 0.9
+            branch.run()
+
+        The copies share the trace and the precomputed predictions
+        (read-only) with this simulator; the rest of the state is copied.
+        Returns a simulator, or a list of count of them.
+        """
+        state = self.checkpoint()
+        branches = []
+        for i in xrange(1 if count is None else count):
+            branch = copy.copy(self)
+            branch.restore(state)
+            branches.append(branch)
+        return branches[0] if count is None else branches
+
+    def run_stream(self):
+        """Runs the simulation for an EHTraceStream, reading the trace as
+        it goes and keeping only the current cycle and the one before.
+        The results are the same as run's for the same trace.
+        Yields a SlotRecord per slot and algorithm; the results are
+        then available from results().
+        """
+        spc = self.eh_trace.slots_per_cycle
+        if self.custom_predictor is not None:
+            self.predictor = self.custom_predictor
+        elif self.precomputed:
+            raise ValueError("Precomputed predictions need the full trace")
+        elif self.dummy_predictor:
+            self.predictor = CycleOracle()
+        slots = iter(self.eh_trace)
+        # the observed value given to update is the one from a cycle
+        # and a slot before (see run), so keep spc+1 values
+        past = deque(maxlen=spc+1)
+        self.slot_count = 0
+        # first cycle is only for obtaining the prediction, no algorithms run
+        for eh in itertools.islice(slots, spc):
+            self.predictor.add_value(eh)
+            past.append(eh)
+        slot = 0
+        while True:
+            # read a cycle ahead, for the oracle
+            cycle = np.array(list(itertools.islice(slots, spc)))
+            if len(cycle) == 0:
+                break
+            if self.dummy_predictor and self.custom_predictor is None:
+                self.predictor.set_cycle(cycle)
+            for _idx, eh in enumerate(cycle):
+                metrics = self.simulate_slot(_idx, eh, past[0] if slot else None)
+                for a, e, pred, error in metrics:
+                    yield SlotRecord(slot, a.name, e, eh, pred, a.battery_level, error[0], error[1])
+                past.append(eh)
+                slot += 1
+
+    def simulate_slot(self, _idx, eh, observed):
+        """Run the algorithms for slot _idx of the cycle: allocate at the
+        start of the cycle (or of a plan, see replan_every), update with
+        the observed value otherwise.
+        Returns (SimAlg, allocation, prediction, battery error) for each
+        algorithm.
+        """
+        metrics = []
+        if self.replan_every is None:
+            plan_idx = _idx
+        else:
+            plan_idx = self.slot_count % self.replan_every
+        self.slot_count += 1
+        if plan_idx == 0:
+            if self.replan_every is None:
                 # a new cycle starts
                 cycle_pred = self.predictor.predict_cycle()
-                #if day > 2: break
-                # run the allocation part of algorithms at the start of the cycle
-                for a in self.algorithms:
-                    start = time()
-                    e = a.allocate(cycle_pred)
-                    end = time()
-                    self.runtime[a.name].append(end-start)
-                    if a.name == 'mallec':
-                        self.mallec_batt_slots.append(len(a.alg.battery_slots))
-                    a.update_metrics(e, eh, self.predictor.predict(_idx))
-                day += 1
             else:
-                # update the allocation for this slot
-                for a in self.algorithms:
-                    e = a.update(_idx, self.predictor.predict(_idx), self.predictor.predict(_idx-1), self.eh_trace[idx-1])
-                    a.update_metrics(e, eh, self.predictor.predict(_idx))
-            # update the predictor with this latest observed EH value
-            self.predictor.add_value(eh)
+                cycle_pred = self.predictor.predict_horizon(self.horizon)
+            # run the allocation part of algorithms at the start of the cycle
+            pred = self.predictor.predict(_idx)
+            for a in self.algorithms:
+                start = time()
+                e = a.allocate(cycle_pred, _idx)
+                end = time()
+                self.runtime[a.name].add(end-start)
+                if a.name == 'mallec':
+                    self.mallec_batt_slots.add(len(a.alg.battery_slots))
+                metrics.append((a, e, pred, a.update_metrics(e, eh, pred)))
+        else:
+            # update the allocation for this slot
+            pred = self.predictor.predict(_idx)
+            if _idx == 0:
+                # a plan going on in a new cycle; the predictor's slots
+                # are of the new cycle
+                pred_prev = self.last_pred
+            else:
+                pred_prev = self.predictor.predict(_idx-1)
+            for a in self.algorithms:
+                e = a.update(plan_idx, pred, pred_prev, observed)
+                metrics.append((a, e, pred, a.update_metrics(e, eh, pred)))
+        self.last_pred = pred
+        # update the predictor with this latest observed EH value
+        self.predictor.add_value(eh)
+        return metrics
+
+    def results(self):
+        """Prints the results of the algorithms.
+        Returns for each algorithm, [allocated, harvested, errors, final]
+        """
         results = []
         # print the results
         for a in self.algorithms:
@@ -209,21 +850,27 @@ class EHSimulator():
             results.append(a_res)
         # print runtime statistics
         for alg, timings in self.runtime.items():
-            print alg, np.mean(timings), np.std(timings)
+            print alg, timings.mean, timings.std
         # print battery slot statistics
-        print np.mean(self.mallec_batt_slots), np.std(self.mallec_batt_slots)
+        if self.mallec_batt_slots.count:
+            print self.mallec_batt_slots.mean, self.mallec_batt_slots.std
         return results
 
-def runsim(trace, algorithms, batt_init, with_oracle):
+def runsim(trace, algorithms, batt_init, with_oracle, bmin=None, bmax=None, precomputed=False, predictor=None,
+           horizon=None, replan_every=None):
     """
     Runs a simulation for the given algorithms and trace
     Parameters:
-    trace       -- Instance of EHTrace
+    trace       -- Instance of EHTrace, or EHTraceStream
     algorithms  -- List of ('alg_name', alg instance)
     batt_init   -- Initial battery level
     with_oracle -- True/False for oracle/error prediction
+    bmin, bmax  -- battery thresholds, default from eh_constants
+    precomputed -- replay precomputed predictions, see EHSimulator
+    predictor   -- a predictor to use instead, see EHSimulator
+    horizon, replan_every -- receding horizon planning, see EHSimulator
     """
-    sim = EHSimulator(trace, batt_init, with_oracle)
+    sim = EHSimulator(trace, batt_init, with_oracle, bmin, bmax, precomputed, predictor, horizon, replan_every)
     #sim.load_trace(trace, 3600, 25, factor)
     for alg_name, alg in algorithms:
         sim.add_algorithm(alg_name, alg)
@@ -0,0 +1,220 @@
+"""
+Benchmarks of the allocation algorithms across cycle sizes and traces.
+
+Every benchmark is timed for 24, 144, 1440 and 8640 slots per cycle
+(1h down to 10s slots), on two kinds of cycles:
+  nsrdb       -- days of the 725315 NSRDB trace
+  alternating -- the same days with sun and cloud alternating every
+                 slot, which fragments MALLEC's battery slots
+The hourly energies are repeated for the shorter slots, so the energy
+per slot, and its relation to emin/emax, is the same at every size.
+
+The benchmarks are the allocate of every algorithm and engine, the
+update (per slot, over slots from sunrise, with prediction errors; over
+the rest of the cycle for Buchli, update_cycle) and a whole EHSimulator.run of two cycles with all the
+algorithms. Benchmarks that would take more than max_seconds at a
+size, from their time at the smaller one, are skipped.
+
+    python benchmark.py --out results.json --baseline baseline.json
+
+records the results and compares them with a baseline, reporting any
+benchmark slower by more than the threshold. Baselines are machine
+specific and aren't kept in the repository (--save-baseline).
+"""
+import os
+import sys
+import json
+import platform
+from datetime import datetime
+from timeit import default_timer
+from StringIO import StringIO
+
+import numpy as np
+
+import eh_constants as ehct
+from alg_tester import EHTrace, runsim
+import _kansal
+import _buchli
+import gorlatova
+import optimised_scheduler_for_energy_neutrality as mallec
+
+sizes = [24, 144, 1440, 8640]
+cases = ['nsrdb', 'alternating']
+nsrdb_trace = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'datasets', '725315_rad_only_full_no_gaps.csv')
+first_day = 150     # summer days, with a long daylight period
+default_baseline = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+
+# name -> algorithm factory, for slots per cycle
+algorithms = {
+        'mallec[numpy]': lambda n: mallec.MallecOptimal(n, engine='numpy'),
+        'mallec[legacy]': lambda n: mallec.MallecOptimal(n, engine='legacy'),
+        'mallec[incremental]': lambda n: mallec.MallecOptimal(n, correction='incremental'),
+        'mallec[replan]': lambda n: mallec.MallecOptimal(n, correction='replan'),
+        'kansal[incremental]': lambda n: _kansal.Kansal(1, n, 24*3600/n, 'incremental'),
+        'kansal[legacy]': lambda n: _kansal.Kansal(1, n, 24*3600/n, 'legacy'),
+        'buchli[legacy]': lambda n: _buchli.Buchli(10, n, engine='legacy'),
+        'buchli[direct]': lambda n: _buchli.Buchli(10, n, engine='direct'),
+        'gorlatova[fast]': lambda n: gorlatova.Gorlatova(n, engine='fast'),
+        'gorlatova[legacy]': lambda n: gorlatova.Gorlatova(n, engine='legacy'),
+        }
+# algorithms whose update is benchmarked (Gorlatova doesn't correct)
+with_update = ['mallec[incremental]', 'mallec[replan]', 'kansal[incremental]', 'kansal[legacy]', 'buchli[legacy]', 'buchli[direct]']
+# algorithms whose update is also benchmarked over the whole cycle, as in
+# EHSimulator.run, where its cost depends on the slot (warm starts)
+whole_cycle = ['buchli[direct]']
+# algorithms in the EHSimulator.run benchmark
+simulated = ['mallec[numpy]', 'kansal[incremental]', 'buchli[direct]', 'gorlatova[fast]']
+
+def cycles(case, slots_per_cycle, count):
+    """count cycles of slots_per_cycle slots for a case, as arrays"""
+    trace = EHTrace(nsrdb_trace, 3600, 3600, 25, 100)
+    per_hour = slots_per_cycle/24
+    days = []
+    for d in xrange(first_day, first_day + count):
+        day = np.repeat(trace.trace[24*d:24*(d+1)], per_hour)
+        if case == 'alternating':
+            day = day*np.tile([1.8, 0.2], slots_per_cycle/2)
+        days.append(day)
+    return days
+
+def bench_allocate(name, day, B0):
+    alg = algorithms[name](len(day))
+    eh_pred = list(day)
+    start = default_timer()
+    alg.allocate(eh_pred, B0)
+    return default_timer() - start
+
+def bench_update(name, day, B0, updates):
+    """Per-slot time of updates from sunrise (where there are prediction
+    errors to correct), the observed energy being off the prediction
+    by +/-20%
+    """
+    alg = algorithms[name](len(day))
+    alg.allocate(list(day), B0)
+    first = max(1, np.flatnonzero(day)[0])
+    updates = min(updates, len(day) - first)
+    start = default_timer()
+    for i in xrange(first, first + updates):
+        observed = day[i-1]*(1.2 if i % 2 else 0.8)
+        alg.update(i, day[i], day[i-1], observed, B0)
+    return (default_timer() - start)/updates
+
+def bench_run(days):
+    """A simulation of all the days but the first, which is for the predictor"""
+    trace = EHTrace.from_slots(np.concatenate(days), 24*3600/len(days[0]))
+    algs = [(name, algorithms[name](len(days[0]))) for name in simulated]
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        start = default_timer()
+        runsim(trace, algs, (ehct.bmin+ehct.bmax)/2, False)
+        return default_timer() - start
+    finally:
+        sys.stdout = stdout
+
+def summary(times):
+    return {'min': min(times), 'median': float(np.median(times)), 'runs': len(times)}
+
+def run_benchmarks(sizes=sizes, cases=cases, repeat=3, updates=48, max_seconds=60, min_time=0.02):
+    """Run all the benchmarks.
+    repeat      -- runs of every benchmark (a different cycle each)
+    updates     -- updates timed per cycle
+    min_time    -- runs are averaged over as many calls as fit in this
+    max_seconds -- stop repeating a benchmark after this long, and skip
+                   it for the larger sizes if it would take longer,
+                   assuming quadratic growth
+    Returns {benchmark: {'min', 'median', 'runs'} or {'skipped': reason}},
+    times being in seconds per call (per slot for update),
+    benchmarks being named like 'kansal[legacy].update/nsrdb/1440'.
+    """
+    B0 = (ehct.bmin + ehct.bmax)/2
+    results = {}
+    elapsed = {}    # (benchmark, case) -> (size, time taken)
+    for n in sorted(sizes):
+        for case in cases:
+            days = cycles(case, n, repeat + 2)
+            benches = [(name + '.allocate', lambda r, name=name: bench_allocate(name, days[r], B0)) for name in sorted(algorithms)]
+            benches += [(name + '.update', lambda r, name=name: bench_update(name, days[r], B0, updates)) for name in with_update]
+            benches += [(name + '.update_cycle', lambda r, name=name: bench_update(name, days[r], B0, n)) for name in whole_cycle]
+            benches.append(('simulator.run', lambda r: bench_run(days[r:r+3])))
+            for bench, func in benches:
+                key = '%s/%s/%d' % (bench, case, n)
+                if (bench, case) in elapsed:
+                    size, taken = elapsed[(bench, case)]
+                    if taken*(float(n)/size)**2 > max_seconds:
+                        results[key] = {'skipped': 'estimated over %ss' % max_seconds}
+                        print "%-45s %11s" % (key, 'skipped')
+                        continue
+                start = default_timer()
+                # fast benchmarks are averaged over enough calls to take min_time
+                first = func(0)
+                call_time = default_timer() - start
+                number = max(1, int(min_time/call_time))
+                times = []
+                for r in xrange(repeat):
+                    if r == 0 and number == 1:
+                        times.append(first)
+                    else:
+                        times.append(sum([func(r) for i in xrange(number)])/number)
+                    if default_timer() - start > max_seconds:
+                        break
+                elapsed[(bench, case)] = (n, default_timer() - start)
+                results[key] = summary(times)
+                print "%-45s %10.6fs" % (key, results[key]['min'])
+    return results
+
+def environment():
+    return {'date': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'platform': platform.platform(),
+            'node': platform.node()}
+
+def save(results, filename):
+    with open(filename, 'w') as f:
+        json.dump({'environment': environment(), 'results': results}, f, indent=1, sort_keys=True)
+
+def load(filename):
+    with open(filename) as f:
+        return json.load(f)['results']
+
+def compare(results, baseline, threshold=1.5):
+    """Compare the results with a baseline, by the minimum times.
+    Returns the regressions as [(benchmark, baseline, new, ratio)],
+    those where new > threshold*baseline.
+    """
+    regressions = []
+    for key in sorted(results):
+        if key not in baseline or 'min' not in results[key] or 'min' not in baseline[key]:
+            continue
+        ratio = results[key]['min']/baseline[key]['min'] if baseline[key]['min'] > 0 else float('inf')
+        if ratio > threshold:
+            regressions.append((key, baseline[key]['min'], results[key]['min'], ratio))
+    return regressions
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark the allocation algorithms')
+    parser.add_argument('--sizes', default=','.join(map(str, sizes)), help='slots per cycle, comma separated')
+    parser.add_argument('--cases', default=','.join(cases), help='cycle kinds, comma separated')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of every benchmark')
+    parser.add_argument('--max-seconds', type=float, default=60, help='time limit of a benchmark')
+    parser.add_argument('--out', default='benchmark_results.json', help='where to write the results')
+    parser.add_argument('--baseline', default=default_baseline, help='results to compare with')
+    parser.add_argument('--threshold', type=float, default=1.5, help='slowdown reported as a regression')
+    parser.add_argument('--save-baseline', action='store_true', help='also save the results as the baseline')
+    args = parser.parse_args()
+
+    results = run_benchmarks([int(n) for n in args.sizes.split(',')], args.cases.split(','),
+            args.repeat, max_seconds=args.max_seconds)
+    save(results, args.out)
+    if args.save_baseline:
+        save(results, args.baseline)
+    elif os.path.exists(args.baseline):
+        regressions = compare(results, load(args.baseline), args.threshold)
+        for key, old, new, ratio in regressions:
+            print "REGRESSION %-45s %10.6fs -> %10.6fs (x%.2f)" % (key, old, new, ratio)
+        if regressions:
+            sys.exit(1)
+        print "No regressions against", args.baseline
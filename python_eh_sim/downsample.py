@@ -0,0 +1,80 @@
+"""
+Shape-preserving downsampling of long series, for plotting.
+
+A 14 year hourly battery trace has ~120k points, far more than the
+pixels of a plot. Both functions split the series into buckets of
+consecutive points (about one per pixel) and return the indices of
+the points to draw, in order, so that any other series of the same
+length can be indexed alike:
+
+    idx = minmax(battery, 1000)
+    plt.plot(t[idx], battery[idx])
+
+minmax keeps the lowest and highest point of every bucket, so the
+envelope of the series (e.g. the battery hitting bmin) is exact.
+lttb (Largest-Triangle-Three-Buckets, Steinarsson 2013) keeps the one
+point per bucket forming the largest triangle with its neighbours,
+which follows the visual shape with half the points.
+NaNs are never selected, unless a bucket has nothing else.
+"""
+import numpy as np
+
+def bucket_edges(n, buckets):
+    """Start of every bucket and the end, for n points in buckets buckets"""
+    buckets = max(1, min(buckets, n))
+    return np.linspace(0, n, buckets + 1).astype(np.int64)
+
+def minmax(y, buckets):
+    """Indices of the minimum and maximum of every bucket of y, in order;
+    at most 2*buckets points"""
+    y = np.asarray(y, dtype=np.float64)
+    n = len(y)
+    if n <= 2*buckets:
+        return np.arange(n)
+    edges = bucket_edges(n, buckets)
+    starts = edges[:-1]
+    sizes = np.diff(edges)
+    bucket = np.repeat(np.arange(len(starts)), sizes)
+    with np.errstate(invalid='ignore'):
+        lo = np.fmin.reduceat(y, starts)
+        hi = np.fmax.reduceat(y, starts)
+        # first point equal to the bucket's minimum (maximum)
+        first_lo = np.unique(bucket[y == lo[bucket]], return_index=True)
+        first_hi = np.unique(bucket[y == hi[bucket]], return_index=True)
+    idx_lo = np.flatnonzero(y == lo[bucket])[first_lo[1]]
+    idx_hi = np.flatnonzero(y == hi[bucket])[first_hi[1]]
+    # buckets of NaNs only keep their first point
+    nan_buckets = np.setdiff1d(np.arange(len(starts)), first_lo[0])
+    return np.unique(np.concatenate((idx_lo, idx_hi, starts[nan_buckets])))
+
+def lttb(y, points, x=None):
+    """Indices of points points of y (at x, default the indices),
+    chosen with Largest-Triangle-Three-Buckets. The first and last
+    points are always kept."""
+    y = np.asarray(y, dtype=np.float64)
+    n = len(y)
+    if points >= n or points < 3:
+        return np.arange(n)
+    x = np.arange(n, dtype=np.float64) if x is None else np.asarray(x, dtype=np.float64)
+    # the first and last points are buckets of their own
+    edges = 1 + bucket_edges(n - 2, points - 2)
+    finite = ~np.isnan(y)
+    idx = np.empty(len(edges) + 1, dtype=np.int64)
+    idx[0] = 0
+    idx[-1] = n - 1
+    a = 0
+    for b in xrange(len(edges) - 1):
+        lo, hi = edges[b], edges[b+1]
+        # the average of the next bucket (the last point, for the last one)
+        if b + 2 < len(edges):
+            nxt = slice(hi, edges[b+2])
+            ok = finite[nxt]
+            cx = x[nxt][ok].mean() if ok.any() else x[hi]
+            cy = y[nxt][ok].mean() if ok.any() else y[hi]
+        else:
+            cx, cy = x[-1], y[-1]
+        area = np.abs((x[a] - cx)*(y[lo:hi] - y[a]) - (x[a] - x[lo:hi])*(cy - y[a]))
+        area[~finite[lo:hi]] = -1
+        a = lo + int(np.argmax(area))
+        idx[b+1] = a
+    return idx
@@ -0,0 +1,240 @@
+"""
+Monte Carlo ensembles of simulations with noisy predictions or traces.
+
+Besides the oracle and EWMA predictors of run_test, an ensemble runs
+many replicas of the simulation of a trace, each with its own random
+perturbation, and returns the distribution of the results, e.g.
+
+    dists = ensemble(('../datasets/725315_rad_only_full_no_gaps.csv',3600,3600,25,100),
+                     1000, noise=('lognormal', {'sigma': 0.3}), processes=None)
+    print dists['mallec']['error_quantity'].summary()
+
+The noise is a multiplicative factor per slot, from one of noise_models,
+applied to the predictions given to the algorithms (target='prediction',
+on top of the oracle or EWMA) or to the trace itself (target='trace',
+e.g. clouds, the EWMA then predicting the perturbed trace).
+
+Every replica draws its factors from its own random stream, seeded from
+the ensemble seed and the replica number, so a replica is the same
+whatever process simulates it; all the algorithms see the same
+perturbation in a replica (common random numbers). The results are
+aggregated as they come, in replica order, into running moments and
+histograms (Distribution), so the results are the same for any number
+of processes and no replica is kept.
+"""
+import hashlib
+import itertools
+import multiprocessing
+import numpy as np
+
+import eh_constants as ehct
+from alg_tester import EHTrace, EHSimulator
+from predictor import MatrixPredictor
+from shared import SharedArrays, SharedTrace, open_trace
+import run_test
+
+# noise models: functions (rng, size, **params) returning size
+# multiplicative factors, none negative
+def gaussian(rng, size, sigma):
+    """1 + sigma*N(0, 1), clipped at 0"""
+    return np.maximum(1 + sigma*rng.standard_normal(size), 0)
+
+def lognormal(rng, size, sigma):
+    """Log-normal with mean 1"""
+    return np.exp(sigma*rng.standard_normal(size) - sigma*sigma/2)
+
+def uniform(rng, size, width):
+    """Uniform in [1-width, 1+width], clipped at 0"""
+    return np.maximum(rng.uniform(1 - width, 1 + width, size), 0)
+
+def clouds(rng, size, p, depth):
+    """1 - depth in a fraction p of the slots, 1 elsewhere"""
+    return np.where(rng.random_sample(size) < p, 1 - depth, 1.)
+
+noise_models = {'gaussian': gaussian, 'lognormal': lognormal, 'uniform': uniform, 'clouds': clouds}
+targets = ('prediction', 'trace')
+
+# the per-replica metrics aggregated, from SimAlg.summary
+metrics = ['allocated', 'harvested', 'errors', 'error_quantity', 'waste', 'overspent', 'final']
+# histogram edges of the errors, in % of the harvested energy
+default_edges = np.linspace(0, 50, 101)
+
+def replica_rng(seed, replica):
+    """The random stream of a replica of an ensemble: a RandomState
+    seeded with a hash of the ensemble seed and the replica number"""
+    digest = hashlib.sha256('%r:%d' % (seed, replica)).digest()
+    return np.random.RandomState(np.frombuffer(digest, dtype=np.uint32))
+
+class NoisyPredictor():
+    """Multiplies the predictions of a predictor by factors, one per
+    slot of the trace, so that a slot has the same error whether it is
+    predicted by predict, predict_cycle or predict_horizon."""
+    def __init__(self, predictor, factors, num_slots):
+        self.predictor = predictor
+        self.factors = factors
+        self.num_slots = num_slots
+        self.added = 0
+
+    def add_value(self, val):
+        self.predictor.add_value(val)
+        self.added += 1
+
+    def predict(self, idx):
+        return self.predictor.predict(idx)*self.factors[self.added - self.added%self.num_slots + idx]
+
+    def predict_cycle(self):
+        cycle = self.predictor.predict_cycle()
+        return cycle*self.factors[self.added:self.added + len(cycle)]
+
+    def predict_horizon(self, length):
+        horizon = self.predictor.predict_horizon(length)
+        return horizon*self.factors[self.added:self.added + len(horizon)]
+
+class Distribution(object):
+    """Running statistics of a metric: count, mean and variance (Welford),
+    min, max, and optionally a histogram over fixed edges (values out of
+    the edges are counted in the first or last bin). NaNs (failed
+    replicas) are only counted."""
+
+    def __init__(self, edges=None):
+        self.count = 0
+        self.failed = 0
+        self.mean = 0.
+        self.m2 = 0.
+        self.min = float('inf')
+        self.max = float('-inf')
+        self.edges = None if edges is None else np.asarray(edges, dtype=np.float64)
+        self.histogram = None if edges is None else np.zeros(len(edges) - 1, dtype=np.int64)
+
+    def add(self, x, h=None):
+        """Add a value; h is the value histogrammed, x by default"""
+        if x != x:
+            self.failed += 1
+            return
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta/self.count
+        self.m2 += delta*(x - self.mean)
+        self.min = min(self.min, x)
+        self.max = max(self.max, x)
+        if self.histogram is not None:
+            h = x if h is None else h
+            b = np.searchsorted(self.edges, h, 'right') - 1
+            self.histogram[min(max(b, 0), len(self.histogram) - 1)] += 1
+
+    @property
+    def variance(self):
+        return self.m2/(self.count - 1) if self.count > 1 else 0.
+
+    @property
+    def std(self):
+        return self.variance**0.5
+
+    def summary(self):
+        s = {'count': self.count, 'failed': self.failed, 'mean': self.mean,
+             'std': self.std, 'min': self.min, 'max': self.max}
+        if self.histogram is not None:
+            s['edges'] = self.edges.tolist()
+            s['histogram'] = self.histogram.tolist()
+        return s
+
+# per-process state, see _init_worker
+_base_trace = None
+
+def _init_worker(source):
+    global _base_trace
+    _base_trace = open_trace(source)
+    # the EWMA of the trace, computed once and used by all the replicas
+    _base_trace.ewma_matrix(ehct.pred_alpha)
+
+def _run_replica(job):
+    """Simulate the algorithms for one replica.
+    Returns the summary of every algorithm; a failed simulation
+    (e.g. MALLEC finding no solution) gives NaNs.
+    """
+    algorithms, with_oracle, noise, target, seed, replica = job
+    model, params = noise
+    rng = replica_rng(seed, replica)
+    trace = _base_trace
+    spc = trace.slots_per_cycle
+    factors = noise_models[model](rng, len(trace) + spc, **params)
+    if target == 'trace':
+        trace = EHTrace.from_slots(trace.trace*factors[:len(trace)], trace.slot_length,
+                                   trace.panel_area, trace.div_factor)
+    def make_predictor():
+        # a predictor per simulation, from the start of the trace
+        if with_oracle:
+            predictor = MatrixPredictor(trace.cycle_matrix(), spc, True, len(trace))
+        else:
+            predictor = MatrixPredictor(trace.ewma_matrix(ehct.pred_alpha), spc)
+        if target == 'prediction':
+            predictor = NoisyPredictor(predictor, factors, spc)
+        return predictor
+    summaries = []
+    for alg_name in algorithms:
+        sim = EHSimulator(trace, ehct.bmax, with_oracle, predictor=make_predictor())
+        sim.add_algorithm(alg_name, run_test.make_algorithm(alg_name, trace))
+        try:
+            sim.advance()
+            s = sim.algorithms[0].summary()
+            summaries.append([s[m] for m in metrics])
+        except Exception, e:
+            print "Ensemble: %s failed in replica %d: %r" % (alg_name, replica, e)
+            summaries.append([float('nan')]*len(metrics))
+    return summaries
+
+def ensemble(trace_spec, replicas, noise=('gaussian', {'sigma': 0.2}), target='prediction',
+             algorithms=None, with_oracle=False, seed=0, processes=1, edges=default_edges):
+    """
+    Run replicas of the simulation of the algorithms over a trace, each
+    with its own noise, see the module documentation.
+
+    trace_spec  -- (file, measurement_interval, time_slot, panel_area, div_factor),
+                   as in run_test.traces
+    replicas    -- number of replicas
+    noise       -- (model, parameters), model a key of noise_models
+    target      -- 'prediction' or 'trace', what the noise perturbs
+    algorithms  -- algorithm names, default run_test.algorithm_names
+    with_oracle -- predictions perturbed from the oracle (True) or EWMA
+    seed        -- seed of the ensemble, the replicas' are derived from it
+    processes   -- number of worker processes, None for one per cpu
+    edges       -- histogram edges of the errors, waste and overspending,
+                   in % of the harvested energy
+    Returns {algorithm: {metric: Distribution}}, metrics as in metrics.
+    """
+    if noise[0] not in noise_models:
+        raise ValueError("Unknown noise model %s" % noise[0])
+    if target not in targets:
+        raise ValueError("Unknown noise target %s" % target)
+    if algorithms is None:
+        algorithms = run_test.algorithm_names
+    jobs = ((algorithms, with_oracle, noise, target, seed, r) for r in xrange(replicas))
+    relative = ('error_quantity', 'waste', 'overspent')
+    dists = dict((a, dict((m, Distribution(edges if m in relative else None)) for m in metrics))
+                 for a in algorithms)
+
+    def aggregate(results):
+        # in replica order, whatever the number of processes
+        for summaries in results:
+            for alg_name, values in zip(algorithms, summaries):
+                s = dict(zip(metrics, values))
+                for m in metrics:
+                    dists[alg_name][m].add(s[m], 100.*s[m]/s['harvested'] if m in relative else None)
+
+    if processes == 1:
+        _init_worker(trace_spec)
+        aggregate(itertools.imap(_run_replica, jobs))
+    else:
+        # the trace and its predictions, loaded once for all the workers
+        shared = SharedArrays()
+        try:
+            source = SharedTrace(shared, EHTrace(*trace_spec), trace_spec)
+            pool = multiprocessing.Pool(processes, _init_worker, (source,))
+            try:
+                aggregate(pool.imap(_run_replica, jobs, chunksize=4))
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            shared.close()
+    return dists
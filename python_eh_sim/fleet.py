@@ -0,0 +1,346 @@
+"""
+Simulation of a fleet of nodes that see the same irradiance.
+
+The nodes of a site differ in panel area, battery thresholds and initial
+battery, but share the trace. FleetSimulator simulates them together:
+the battery, allocation and error bookkeeping of every algorithm are
+arrays over the nodes (FleetAlg), and the algorithms plan and correct
+the allocations of all the nodes in one call per slot:
+
+    fleet = FleetSimulator(trace, b0=np.linspace(16200, 32400, 1000),
+                           panel_area=np.random.uniform(20, 30, 1000))
+    fleet.add_algorithm('kansal', FleetKansal(1, trace.slots_per_cycle, trace.slot_length))
+    fleet.add_algorithm('mallec', FleetMallec(trace.slots_per_cycle, fleet.bmin, fleet.bmax))
+    results = fleet.run()   # for each algorithm, per node [allocated, harvested, errors, final]
+
+The harvested energy of a node is the trace scaled by its panel area,
+and so are its predictions (EWMA or oracle, precomputed once for the
+trace). The algorithms are those of EHSimulator for arrays of nodes:
+FleetKansal gives the same allocations as Kansal for every node;
+FleetMallec plans as MallecOptimal (simple_optimum_batch) and, with
+correction='incremental' (the default), corrects the prediction errors
+as MallecOptimal does, to the rounding.
+The fleet plans a cycle at a time.
+"""
+import numpy as np
+
+import eh_constants as ehct
+from alg_tester import no_error, waste, overspent, EHTraceStream
+from predictor import MatrixPredictor
+import optimised_scheduler_for_energy_neutrality as mallec
+
+class FleetKansal():
+    """Kansal's algorithm (see _kansal.Kansal) for all the nodes of a
+    fleet at once. The allocations are duty cycles, nodes x slots."""
+
+    def __init__(self, eta, slots_per_cycle, t_slot):
+        self.eta = eta
+        self.t_slot = t_slot
+        self.allocation = np.zeros((0, slots_per_cycle))
+        self.eh = None
+        self.coef = None
+
+    def allocate(self, eh_pred, b0):
+        """Kansal.allocate for every row of eh_pred (nodes x slots).
+        Returns the energy allocated in the first slot, per node."""
+        dmin, dmax, pc, eta = ehct.dmin, ehct.dmax, ehct.pc, self.eta
+        self.eh = np.asarray(eh_pred, dtype=np.float64)/self.t_slot
+        nodes, slots = self.eh.shape
+        rows = np.arange(nodes)
+        # the sums of Kansal.allocate, added up in the same order
+        total_eh = np.cumsum(self.eh*self.t_slot, axis=1)[:, -1]
+        sunny = self.eh >= pc
+        self.allocation = np.where(sunny, dmax, dmin)
+        allocated = np.cumsum(ehct.emax*self.allocation, axis=1)[:, -1]
+        excess = total_eh - allocated
+        n_sunny = sunny.sum(axis=1)
+        n_dark = slots - n_sunny
+        # underallocated, increase dark slots, by coefficient (stable)
+        under = np.flatnonzero((excess > 0) & (n_dark > 0))
+        if len(under):
+            coef = pc/float(eta) + self.eh[under]*(1 - 1/eta)
+            coef[sunny[under]] = np.inf
+            dark = np.argsort(coef, axis=1, kind='mergesort')
+            e_dmax = ehct.emax*dmax
+            available_for = np.minimum((excess[under]/e_dmax).astype(np.int64), n_dark[under])
+            left = excess[under]
+            for i in xrange(available_for.max()):
+                full = np.flatnonzero(available_for > i)
+                self.allocation[under[full], dark[full, i]] = dmax
+                left[full] -= e_dmax
+            # assign remainder
+            rest = np.flatnonzero((left > 0) & (available_for < n_dark[under]))
+            slt = dark[rest, available_for[rest]]
+            eh = self.eh[under[rest], slt]
+            self.allocation[under[rest], slt] = dmin + (left[rest]/self.t_slot)/((-eh + pc)/eta + eh)
+        # overallocated, decrease sun slots evenly
+        over = np.flatnonzero((excess < 0) & (n_sunny > 0))
+        if len(over):
+            per_slot = (allocated[over] - total_eh[over])/n_sunny[over].astype(np.float64)
+            self.allocation[over] -= np.where(sunny[over], (per_slot/ehct.emax)[:, None], 0)
+        self.coef = np.where(self.eh > pc, pc, pc/eta + self.eh*(1 - 1/eta))
+        return ehct.emax*self.allocation[rows, 0]
+
+    def update(self, slot_idx, eh_pred, eh_pred_prev, eh_real, prev_battery):
+        """Kansal.update for every node, see Kansal.update_incremental.
+        Each slot from slot_idx on is visited for all the nodes that still
+        have some of their excess (deficit) to allocate."""
+        dmin, dmax = ehct.dmin, ehct.dmax
+        estimated = eh_pred_prev/float(self.t_slot)
+        eh_real_p = eh_real/float(self.t_slot)
+        excess = np.where(eh_real > ehct.pc, estimated - eh_real_p,
+                          (estimated - eh_real_p)*(1 - self.allocation[:, slot_idx-1]*(1 - 1/self.eta)))
+        slots = self.allocation.shape[1]
+        # increase consumption in the remaining slots, in order
+        active = np.flatnonzero(excess > 0)
+        for j in xrange(slot_idx, slots):
+            if len(active) == 0:
+                break
+            alloc = self.allocation[active, j]
+            raisable = alloc != dmax
+            r = self.coef[active, j]*(dmax - alloc)
+            full = raisable & (r < excess[active])
+            part = raisable & ~full
+            excess[active[full]] -= r[full]
+            self.allocation[active[full], j] = dmax
+            self.allocation[active[part], j] += excess[active[part]]/self.coef[active[part], j]
+            active = active[~part]
+        # decrease consumption in the remaining slots, from the end
+        active = np.flatnonzero(excess < 0)
+        for j in xrange(slots - 1, slot_idx - 1, -1):
+            if len(active) == 0:
+                break
+            alloc = self.allocation[active, j]
+            lowerable = alloc > dmin
+            r = self.coef[active, j]*(dmin - alloc)
+            full = lowerable & (r > excess[active])
+            part = lowerable & ~full
+            excess[active[full]] -= r[full]
+            self.allocation[active[full], j] = dmin
+            self.allocation[active[part], j] += excess[active[part]]/self.coef[active[part], j]
+            active = active[~part]
+        return ehct.emax*self.allocation[:, slot_idx]
+
+class FleetMallec():
+    """MALLEC (see optimised_scheduler_for_energy_neutrality.MallecOptimal)
+    for all the nodes of a fleet at once."""
+    corrections = ('incremental', 'none')
+
+    def __init__(self, slots_per_cycle, bmin=None, bmax=None, correction='incremental'):
+        """
+        Parameters:
+        bmin, bmax  -- battery thresholds, per node or for all of them,
+                       default from eh_constants
+        correction  -- 'incremental' or 'none', see MallecOptimal
+        """
+        if correction not in self.corrections:
+            raise ValueError("Unknown correction %s" % correction)
+        self.correction = correction
+        self.bmin = ehct.bmin if bmin is None else bmin
+        self.bmax = ehct.bmax if bmax is None else bmax
+        self.allocation = np.zeros((0, slots_per_cycle))
+        self.battery_pred = None
+        self.batt_offset = None
+        self.eh_pred = None
+        self.start_batt = None
+
+    def allocate(self, eh_pred, start_batt):
+        if self.start_batt is None:
+            self.start_batt = np.array(start_batt, dtype=np.float64)
+        nodes = len(self.start_batt)
+        bmin = np.broadcast_to(np.asarray(self.bmin, dtype=np.float64), (nodes,))
+        bmax = np.broadcast_to(np.asarray(self.bmax, dtype=np.float64), (nodes,))
+        self.eh_pred = np.asarray(eh_pred, dtype=np.float64)
+        (self.allocation, self.battery_pred, ok) = mallec.simple_optimum_batch(
+                self.start_batt, bmin, bmax, ehct.emin, ehct.emax, self.eh_pred)
+        if not ok.all():
+            raise ValueError("No allocation for node %d" % np.flatnonzero(~ok)[0])
+        self.batt_offset = np.zeros(nodes)
+        return self.allocation[:, 0].copy()
+
+    def update(self, slot_idx, eh_pred, eh_pred_prev, eh_observed, crt_batt):
+        """Plan the rest of the cycle again, from the battery of every
+        node (MallecOptimal.update_incremental)."""
+        if self.correction == 'incremental':
+            self.update_incremental(slot_idx, crt_batt)
+        return self.allocation[:, slot_idx].copy()
+
+    def update_incremental(self, slot_idx, crt_batt):
+        """simple_optimum_batch on the rest of the cycle, to the battery
+        planned for its end; the nodes without a solution keep their
+        allocation"""
+        nodes = len(crt_batt)
+        bmin = np.broadcast_to(np.asarray(self.bmin, dtype=np.float64), (nodes,))
+        bmax = np.broadcast_to(np.asarray(self.bmax, dtype=np.float64), (nodes,))
+        target = self.battery_pred[:, -1] + self.batt_offset
+        (cons, batt, ok) = mallec.simple_optimum_batch(crt_batt, bmin, bmax, ehct.emin, ehct.emax,
+                                                       self.eh_pred[:, slot_idx:], target)
+        self.allocation[ok, slot_idx:] = cons[ok]
+        self.battery_pred[ok, slot_idx:] = batt[ok] - self.batt_offset[ok, None]
+
+class FleetAlg(object):
+    """For maintaining and running an algorithm over a fleet, as SimAlg
+    for one node: the totals are arrays over the nodes. With history,
+    the allocation and the battery of every slot are kept (slots x nodes).
+    """
+
+    def __init__(self, name, alg, B0, bmin, bmax, num_slots=0, history=False):
+        self.name = name
+        self.alg = alg
+        self.bmin = bmin
+        self.bmax = bmax
+        nodes = len(B0)
+        self.slot_count = 0
+        self.history = history
+        if history:
+            self._allocation = np.zeros((num_slots, nodes))
+            self._battery = np.zeros((num_slots+1, nodes))
+            self._battery[0] = B0
+        self.allocated = np.zeros(nodes)
+        self.harvested = np.zeros(nodes)
+        self.predicted = np.zeros(nodes)
+        self.battery_level = np.array(B0, dtype=np.float64)
+        self.error_count = np.zeros(nodes, dtype=np.int64)
+        self.error_quantity = np.zeros(nodes)
+        self.waste = np.zeros(nodes)
+        self.overspent = np.zeros(nodes)
+        self.min_e_used = np.full(nodes, np.inf)
+        self.max_e_used = np.full(nodes, -np.inf)
+        self.zero_e_slots = np.zeros(nodes, dtype=np.int64)
+
+    def update_metrics(self, e, eh, eh_pred):
+        """Account for a slot, for every node, as SimAlg.update_metrics.
+        Returns the battery errors, as (error types, quantities)."""
+        i = self.slot_count
+        self.allocated += e
+        self.harvested += eh
+        self.predicted += eh_pred
+        self.slot_count += 1
+        b = self.battery_level + eh - e
+        np.minimum(self.min_e_used, e, out=self.min_e_used)
+        np.maximum(self.max_e_used, e, out=self.max_e_used)
+        self.zero_e_slots += (e == 0)
+        over = b < self.bmin
+        wasted = ~over & (b > self.bmax)
+        error_type = np.where(over, overspent, np.where(wasted, waste, no_error)).astype(np.int8)
+        q_over = np.where(over, self.bmin - b, 0)
+        q_waste = np.where(wasted, b - self.bmax, 0)
+        self.overspent += q_over
+        self.waste += q_waste
+        self.error_quantity += q_over + q_waste
+        self.error_count += over | wasted
+        self.battery_level = np.where(over, self.bmin, np.where(wasted, self.bmax, b))
+        if self.history:
+            self._allocation[i] = e
+            self._battery[i+1] = self.battery_level
+        return error_type, q_over + q_waste
+
+    @property
+    def allocation(self):
+        """Allocation for the simulated slots, slots x nodes"""
+        return self._allocation[:self.slot_count]
+
+    @property
+    def battery(self):
+        """Battery trace, starting with B0, slots+1 x nodes"""
+        return self._battery[:self.slot_count+1]
+
+    def summary(self):
+        """The totals of the simulation so far, per node"""
+        return {'allocated': self.allocated,
+                'harvested': self.harvested,
+                'predicted': self.predicted,
+                'errors': self.error_count,
+                'error_quantity': self.error_quantity,
+                'waste': self.waste,
+                'overspent': self.overspent,
+                'final': self.battery_level,
+                'slots': self.slot_count,
+                'min_e_used': self.min_e_used,
+                'max_e_used': self.max_e_used,
+                'zero_e_slots': self.zero_e_slots}
+
+    def results(self):
+        """[allocated, harvested, errors, final] per node (nodes x 4)"""
+        return np.column_stack((self.allocated, self.harvested, self.error_quantity, self.battery_level))
+
+    def pretty_print(self):
+        s = self.summary()
+        nodes = len(self.allocated)
+        print "Algorithm:", self.name, "over", nodes, "nodes"
+        print "Mean allocated %d vs harvested %d predicted %d. Ratio %2.2f" % (s['allocated'].mean(), s['harvested'].mean(), s['predicted'].mean(), (s['allocated']/s['harvested']).mean())
+        print "Nodes with battery errors %d, mean quantity %d. Mean waste %d overspent %d. Mean final %f" % (np.count_nonzero(s['errors']), s['error_quantity'].mean(), s['waste'].mean(), s['overspent'].mean(), s['final'].mean())
+        return self.results()
+
+class FleetSimulator():
+    def __init__(self, eh_trace, b0, panel_area=None, bmin=None, bmax=None, dummy_predictor=False, history=False):
+        """
+        Parameters:
+        eh_trace    -- energy harvesting trace (EHTrace), for the panel
+                       area it was loaded with
+        b0          -- initial battery, per node
+        panel_area  -- panel area per node, default that of the trace
+        bmin, bmax  -- battery thresholds, per node or for all of them,
+                       default from eh_constants
+        dummy_predictor -- True for the oracle, False for EWMA
+        history     -- keep the allocation and battery of every slot
+        All the parameters given per node have the same length, the
+        number of nodes.
+        """
+        if isinstance(eh_trace, EHTraceStream):
+            raise ValueError("A fleet needs the full trace")
+        self.eh_trace = eh_trace
+        self.b0 = np.asarray(b0, dtype=np.float64)
+        nodes = len(self.b0)
+        if panel_area is None:
+            panel_area = eh_trace.panel_area
+        self.panel_area = np.broadcast_to(np.asarray(panel_area, dtype=np.float64), (nodes,))
+        self.bmin = np.broadcast_to(np.asarray(ehct.bmin if bmin is None else bmin, dtype=np.float64), (nodes,))
+        self.bmax = np.broadcast_to(np.asarray(ehct.bmax if bmax is None else bmax, dtype=np.float64), (nodes,))
+        # the harvested energy is linear in the panel area, see EHTrace.rescaled
+        self.scale = self.panel_area/float(eh_trace.panel_area)
+        self.dummy_predictor = dummy_predictor
+        self.history = history
+        self.algorithms = []
+
+    def add_algorithm(self, name, alg):
+        """alg plans for all the nodes, e.g. FleetKansal, FleetMallec"""
+        num_slots = len(self.eh_trace) - self.eh_trace.slots_per_cycle
+        self.algorithms.append(FleetAlg(name, alg, self.b0, self.bmin, self.bmax, num_slots, self.history))
+
+    def run(self):
+        """Runs the simulation, as EHSimulator.run, for all the nodes.
+        Prints the results.
+        Returns for each algorithm, per node [allocated, harvested, errors, final]
+        """
+        spc = self.eh_trace.slots_per_cycle
+        if self.dummy_predictor:
+            predictor = MatrixPredictor(self.eh_trace.cycle_matrix(), spc, True, len(self.eh_trace))
+        else:
+            predictor = MatrixPredictor(self.eh_trace.ewma_matrix(ehct.pred_alpha), spc)
+        # first cycle is only for obtaining the prediction, no algorithms run
+        for eh in self.eh_trace[:spc]:
+            predictor.add_value(eh)
+        scale = self.scale
+        for idx, eh in enumerate(self.eh_trace[spc:]):
+            _idx = idx%spc
+            pred = predictor.predict(_idx)*scale
+            if _idx == 0:
+                cycle_pred = scale[:, None]*predictor.predict_cycle()
+                for a in self.algorithms:
+                    e = a.alg.allocate(cycle_pred, a.battery_level)
+                    a.update_metrics(e, eh*scale, pred)
+            else:
+                pred_prev = predictor.predict(_idx-1)*scale
+                observed = self.eh_trace[idx-1]*scale
+                for a in self.algorithms:
+                    e = a.alg.update(_idx, pred, pred_prev, observed, a.battery_level)
+                    a.update_metrics(e, eh*scale, pred)
+            predictor.add_value(eh)
+        return self.results()
+
+    def results(self):
+        """Prints the results of the algorithms.
+        Returns for each algorithm, per node [allocated, harvested, errors, final]
+        """
+        return [a.pretty_print() for a in self.algorithms]
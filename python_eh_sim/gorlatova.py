@@ -1,12 +1,26 @@
+import numpy as np
 import eh_constants as ehct
 
 class Gorlatova():
     """
     Implements the progressive filling algorithm of Gorlatova et al.
     """
+    # the configuration, checked by EHSimulator.restore
+    parameters = ('bmin', 'delta', 'engine')
 
-    def __init__(self, slots_per_cycle):
+    def __init__(self, slots_per_cycle, bmin=None, engine='fast'):
+        """
+        Parameters:
+        slots_per_cycle -- number of slots in a cycle
+        bmin            -- minimum battery threshold, default from eh_constants
+        engine          -- 'fast' (fill_levels), 'legacy' (one delta at a
+                           time) or 'check' (run both and report differences)
+        """
+        if engine not in ('fast', 'legacy', 'check'):
+            raise ValueError("Unknown engine %s" % engine)
         self.slots = slots_per_cycle
+        self.bmin = ehct.bmin if bmin is None else bmin
+        self.engine = engine
         self.alloc = [0 for i in xrange(self.slots)]
         self.delta = 0.0086     # 8.6mJ, according to paper
         self.eh_pred = None
@@ -27,7 +41,7 @@ class Gorlatova():
                 B_crt = B_crt + cycle_eh[s] - crt_alloc[s]
             else:
                 B_crt = B_crt + cycle_eh[s] - test_i
-            if B_crt < ehct.bmin: # or B_crt > ehct.bmax:
+            if B_crt < self.bmin: # or B_crt > ehct.bmax:
                 #print "Error"
                 return False
         if B_crt < B0:
@@ -41,18 +55,84 @@ class Gorlatova():
         The PF algorithm is static, doesn't have error correction,
         so everything happens on the first slot of the cycle.
         """
+        if self.engine == 'legacy':
+            self.alloc = self.allocate_legacy(eh_pred, B0)
+        else:
+            self.alloc = self.fill_levels(eh_pred, B0)
+            if self.engine == 'check':
+                legacy = self.allocate_legacy(eh_pred, B0)
+                diff = max([abs(a - b) for a, b in zip(self.alloc, legacy)])
+                if diff > self.delta/2:
+                    print "Gorlatova: fast and legacy allocations differ by", diff
+                self.alloc = legacy
+        return self.alloc[0]
+
+    def allocate_legacy(self, eh_pred, B0):
+        """
+        Progressive filling one delta at a time, checking the full cycle
+        for every increase.
+        """
         remaining = set(range(len(eh_pred)))
-        self.alloc = [0 for i in xrange(len(eh_pred))]
+        alloc = [0 for i in xrange(len(eh_pred))]
         while len(remaining) > 0:
             to_remove = set()
             for i in remaining:
-                test_i = self.alloc[i] + self.delta
-                if self.check_validity(self.alloc, eh_pred, B0, test_i, i):
-                    self.alloc[i] = test_i
+                test_i = alloc[i] + self.delta
+                if self.check_validity(alloc, eh_pred, B0, test_i, i):
+                    alloc[i] = test_i
                 else:
                     to_remove.add(i)
             remaining -= to_remove
-        return self.alloc[0]
+        return alloc
+
+    def fill_levels(self, eh_pred, B0):
+        """
+        Same result as allocate_legacy, without stepping through every round.
+
+        slack[s] is how much more energy can be consumed in slots 0..s
+        before the battery goes below bmin at the end of slot s (for the
+        last slot, also below B0). Raising slot i by delta takes delta
+        from slack[i:]. In a round the slots are raised in order, so slot
+        i is raised iff min(slack[i:]) >= (k+1)*delta, with k the slots
+        raised before it in that round; otherwise it stops for good.
+
+        Rounds where every remaining slot is raised are skipped at once:
+        with m[s] remaining slots in 0..s, there are
+        min(slack[s]/(m[s]*delta)) such rounds. The round after that
+        stops at least one slot, so there are at most len(eh_pred) of them.
+        """
+        n = len(eh_pred)
+        alloc = np.zeros(n)
+        if n == 0:
+            return []
+        eh_cum = np.cumsum(np.asarray(eh_pred, dtype=np.float64))
+        slack = B0 + eh_cum - self.bmin
+        slack[-1] = min(slack[-1], eh_cum[-1])
+        if slack.min() < 0:
+            # the battery is already out of bounds, nothing can be raised
+            return list(alloc)
+        active = np.ones(n, dtype=bool)
+        while active.any():
+            # skip the rounds where all the remaining slots are raised
+            m = np.cumsum(active)
+            used = m > 0
+            rounds = int(np.floor((slack[used]/(m[used]*self.delta)).min()))
+            if rounds > 0:
+                alloc[active] += rounds*self.delta
+                slack -= rounds*self.delta*m
+            # one round, in slot order, stopping at least one slot
+            suffix_min = np.minimum.accumulate(slack[::-1])[::-1]
+            raised = np.zeros(n, dtype=bool)
+            k = 0
+            for i in np.flatnonzero(active):
+                if suffix_min[i] >= (k+1)*self.delta:
+                    raised[i] = True
+                    k += 1
+                else:
+                    active[i] = False
+            alloc[raised] += self.delta
+            slack -= self.delta*np.cumsum(raised)
+        return list(alloc)
 
     def update(self, slot_idx, eh_pred, eh_pred_prev, eh_obs, batt_start):
         # The algorithm doesn't provide error correction,
@@ -8,7 +8,11 @@ between zero and max. Also, to have Bn=B1
 The battery level is considered as energy
 We consider a linear energy storage.
 
+first_pass, apply_changes and compute_battery have a scalar (legacy)
+and a NumPy engine, with the same results; the NumPy one is the default.
 """
+import numpy as np
+
 class BatterySlot:
   def __init__(self, type, start, size, avg, min, max, wasted, missed, delta_e_full, delta_e_sleep):
     self.type = type  # 'emax', 'ein', 'emin'
@@ -43,6 +47,50 @@ class BatterySlot:
   def __str__(self):
     return "From %d to %d, min=%d, max=%d" % (self.start, self.start + self.size, self.min, self.max)
 
+class BatterySlotTable:
+  """
+  The battery slots of a cycle, as parallel arrays (one element per
+  battery slot, in order), see BatterySlot for the fields.
+  The type is a code, an index in types.
+  The passes work on index ranges of the table; table[i] is the
+  BatterySlot i, for display.
+  """
+  types = ('emin', 'ein', 'emax')
+  fields = ('start', 'size', 'min', 'max', 'wasted', 'missed', 'delta_e_full', 'delta_e_sleep')
+
+  def __init__(self, type, start, size, min, max, wasted, missed, delta_e_full, delta_e_sleep):
+    self.type = np.asarray(type, dtype=np.int8)
+    self.start = np.asarray(start, dtype=np.int64)
+    self.size = np.asarray(size, dtype=np.int64)
+    self.min = np.asarray(min, dtype=np.float64)
+    self.max = np.asarray(max, dtype=np.float64)
+    self.wasted = np.asarray(wasted, dtype=np.float64)
+    self.missed = np.asarray(missed, dtype=np.float64)
+    self.delta_e_full = np.asarray(delta_e_full, dtype=np.float64)
+    self.delta_e_sleep = np.asarray(delta_e_sleep, dtype=np.float64)
+
+  @classmethod
+  def from_slots(cls, batt_slots):
+    """Table of a list of BatterySlot"""
+    columns = [[getattr(b, f) for b in batt_slots] for f in cls.fields]
+    return cls([cls.types.index(b.type) for b in batt_slots], *columns)
+
+  def __len__(self):
+    return len(self.type)
+
+  def __getitem__(self, i):
+    return BatterySlot(self.types[self.type[i]], int(self.start[i]), int(self.size[i]), None,
+                       float(self.min[i]), float(self.max[i]), float(self.wasted[i]), float(self.missed[i]),
+                       float(self.delta_e_full[i]), float(self.delta_e_sleep[i]))
+
+  def type_names(self, start=0, stop=None):
+    """The types of the battery slots [start:stop], as names"""
+    return [self.types[t] for t in self.type[start:stop].tolist()]
+
+  def section(self, start, stop):
+    """The table of the battery slots [start:stop]"""
+    return BatterySlotTable(self.type[start:stop], *[getattr(self, f)[start:stop] for f in self.fields])
+
 # global variables
 #e_cons = [] # list of e_cons slots
 """
@@ -66,13 +114,7 @@ In the next minimum list, every item represents
 the minimum value from that position on in the list
 """
 def next_minimum_list(data_list):
-  l = []
-  l.extend(data_list)
-  prev_min = l[-1]
-  for i in range(len(data_list)-1, -1, -1):
-    l[i] = min(l[i], prev_min)
-    prev_min = l[i]
-  return l
+  return np.minimum.accumulate(np.asarray(data_list, dtype=np.float64)[::-1])[::-1]
 
 def opposite(type):
   if type == 'emax':
@@ -81,18 +123,17 @@ def opposite(type):
     return 'emax'
 
 """
-Return the list of battery deltas, given the error type.
+Return the battery deltas of the battery slots [start:stop] of
+the table, given the error type.
 If err_type is 'emax', return (B(i) - Bmin).
 If err_type is 'emin', return (Bmax - B(i)).
 """
-def delta_list(batt_slot_list, err_type, bmax, bmin):
-  deltas = []
-  for b in batt_slot_list:
-    if err_type == 'emax':
-      deltas.append(b.min - bmin)
-    elif err_type == 'emin':
-      deltas.append(bmax - b.max)
-  return deltas
+def delta_list(batt_slots, start, stop, err_type, bmax, bmin):
+  if err_type == 'emax':
+    return batt_slots.min[start:stop] - bmin
+  elif err_type == 'emin':
+    return bmax - batt_slots.max[start:stop]
+  return np.zeros(0)
 
 """
 Tweak the energy consumption in the list to eliminate
@@ -102,7 +143,7 @@ We need to know:
   - the type of the errors that are recovered (emin or emax)
   because we need to know which slots can be modified
   - the maximum error that must be recovered
-  - the list
+  - the battery slots [start:stop] of the table
   - the next minimum for every item
   - any previous change that would affect the list
   - minimum and maximum energy consumption possible in a slot.
@@ -112,19 +153,23 @@ We need to get out of this:
   - keep track and return the total amount of energy changed, so
   it can be taken into account in the subsequent slots.
 """
-def process_slots(slots, max_err, err_type, next_min_list, batt_delta, emin, emax):
+def process_slots(batt_slots, start, stop, max_err, err_type, next_min_list, batt_delta, emin, emax):
   #print next_min_list, len(next_min_list)
-  changes = [(0, batt_delta) for i in range(len(slots))]
+  types = batt_slots.type_names(start, stop)
+  wasted = batt_slots.wasted[start:stop].tolist()
+  missed = batt_slots.missed[start:stop].tolist()
+  if err_type == 'emin':
+    max_energy_deltas = batt_slots.delta_e_sleep[start:stop].tolist()
+  else:
+    max_energy_deltas = batt_slots.delta_e_full[start:stop].tolist()
+  next_min_list = list(next_min_list)
+  changes = [(0, batt_delta) for i in range(len(types))]
   idx = 0
   batt_change = batt_delta
-  while idx < len(slots) and max_err > 0:
+  while idx < len(types) and max_err > 0:
     # change only in ein and opposite slots
-    max_energy_delta = None
-    if err_type == 'emin':
-      max_energy_delta = slots[idx].delta_e_sleep
-    elif err_type == 'emax':
-      max_energy_delta = slots[idx].delta_e_full
-    if slots[idx].type in ['ein', opposite(err_type)]:
+    max_energy_delta = max_energy_deltas[idx]
+    if types[idx] in ['ein', opposite(err_type)]:
       if err_type == 'emin': # overspend
         # battery change reduces the minimum
         change = min(max_err, next_min_list[idx] - batt_change, max_energy_delta)
@@ -143,27 +188,145 @@ def process_slots(slots, max_err, err_type, next_min_list, batt_delta, emin, ema
       changes[idx] = (change, batt_change)
     else:
       changes[idx] = (0, batt_change)
-    if slots[idx].type == err_type and max(slots[idx].wasted, slots[idx].missed) > abs(batt_change):
+    if types[idx] == err_type and max(wasted[idx], missed[idx]) > abs(batt_change):
       # we couldn't recover the error in this slot
       # Note: we can use the second expression in the test,
       # as we can't have both
       # wasted and missed in a slot (failure in previous pass)
-      print "Error in slot", idx, max(slots[idx].wasted, slots[idx].missed), "couldn't be recovered. Change so far", batt_change
+      print "Error in slot", idx, max(wasted[idx], missed[idx]), "couldn't be recovered. Change so far", batt_change
       return None
     idx += 1
   if max_err > 0:
     print "Remaining error:", max_err
     return None
   else:
-    while idx < len(slots):
+    while idx < len(types):
       changes[idx] = (0, batt_change)
       idx += 1
   return (changes, batt_change)
 
 
 #def schedule(B0, e_in, e_min, e_max, b_min, b_max):
-  
-def first_pass(B0, e_in, e_min, e_max, b_min, b_max):
+
+engines = ('numpy', 'legacy')
+
+def first_pass(B0, e_in, e_min, e_max, b_min, b_max, engine='numpy'):
+  """
+  First pass of the algorithm, see first_pass_legacy.
+  engine: 'numpy' (first_pass_numpy) or 'legacy'
+  The battery slots are returned as a BatterySlotTable.
+  """
+  if engine == 'legacy':
+    (e_cons, batt, batt_slots) = first_pass_legacy(B0, e_in, e_min, e_max, b_min, b_max)
+    return (e_cons, batt, BatterySlotTable.from_slots(batt_slots))
+  return first_pass_numpy(B0, e_in, e_min, e_max, b_min, b_max)
+
+def _run_sums(values, starts, sizes):
+  """
+  Sum of values over every run (starts, sizes), added up in order,
+  as sum() does, so that the results are the same as the scalar loop.
+  The runs of the same size are summed together, with a cumulative
+  sum along the rows; there are at most sqrt(2*len(values)) sizes.
+  """
+  sums = np.empty(len(starts))
+  for size in np.unique(sizes):
+    runs = np.flatnonzero(sizes == size)
+    idx = starts[runs][:, None] + np.arange(size)
+    sums[runs] = np.cumsum(values[idx], axis=1)[:, -1]
+  return sums
+
+def first_pass_numpy(B0, e_in, e_min, e_max, b_min, b_max):
+  """
+  Same as first_pass_legacy, on arrays: the consumption is e_in clipped
+  to [e_min, e_max], the battery its cumulative sum, the battery slots
+  the runs of the same consumption type, and their statistics are
+  reduced over every run at once.
+
+  returns arrays of energy consumption and battery, and BatterySlotTable
+  """
+  e_in = np.asarray(e_in, dtype=np.float64)
+  n = len(e_in)
+  # 0 for 'emin', 1 for 'ein', 2 for 'emax'
+  kind = np.where(e_in >= e_max, 2, np.where(e_in <= e_min, 0, 1))
+  e_cons = np.where(kind == 2, e_max, np.where(kind == 0, e_min, e_in))
+  # the battery as if there was no min/max, added up slot by slot
+  batt = np.cumsum(np.concatenate(([B0], e_in - e_cons)))
+  if n == 0:
+    return (e_cons, batt, BatterySlotTable(*[[]]*9))
+
+  starts = np.concatenate(([0], np.flatnonzero(np.diff(kind)) + 1))
+  ends = np.append(starts[1:], n)
+  sizes = ends - starts
+  # min and max include the level at the start of the battery slot,
+  # waste and overspending only the levels at the end of its slots
+  levels = batt[1:]
+  batt_min = np.minimum(np.minimum.reduceat(batt[:-1], starts), batt[ends])
+  batt_max = np.maximum(np.maximum.reduceat(batt[:-1], starts), batt[ends])
+  wasted = np.maximum(np.maximum.reduceat(levels, starts) - b_max, 0)
+  missed = np.maximum(b_min - np.minimum.reduceat(levels, starts), 0)
+  total_e_cons = _run_sums(e_cons, starts, sizes)
+  delta_e_full = sizes*e_max - total_e_cons
+  delta_e_sleep = total_e_cons - sizes*e_min
+
+  # energy loss or gain greater than battery cap (checked when a slot ends)
+  for i in np.flatnonzero(batt_max[:-1] - batt_min[:-1] > (b_max - b_min)):
+    print "Fail loss/gain", float(batt_max[i]), float(batt_min[i]), (b_max - b_min)
+  batt_slots = BatterySlotTable(kind[starts], starts, sizes, batt_min, batt_max,
+                                wasted, missed, delta_e_full, delta_e_sleep)
+  return (e_cons, batt, batt_slots)
+
+def first_pass_batch(B0, e_in, e_min, e_max, b_min, b_max):
+  """
+  first_pass_numpy for every row of the matrix e_in at once, B0, b_min
+  and b_max being arrays of one value per row. The battery slots of all
+  the rows are found and reduced together, a row starting a new one.
+
+  returns matrices of energy consumption and battery, the
+  BatterySlotTable of all the rows, one after the other (the starts
+  being within the row), and the bounds of the rows in it: the battery
+  slots of row r are [bounds[r]:bounds[r+1]]
+  """
+  e_in = np.asarray(e_in, dtype=np.float64)
+  rows, n = e_in.shape
+  B0, b_min, b_max = [np.broadcast_to(np.asarray(v, dtype=np.float64), (rows,)) for v in (B0, b_min, b_max)]
+  kind = np.where(e_in >= e_max, 2, np.where(e_in <= e_min, 0, 1))
+  e_cons = np.where(kind == 2, e_max, np.where(kind == 0, e_min, e_in))
+  batt = np.cumsum(np.concatenate((B0[:, None], e_in - e_cons), axis=1), axis=1)
+  if n == 0:
+    return (e_cons, batt, BatterySlotTable(*[[]]*9), np.zeros(rows + 1, dtype=np.int64))
+
+  new_run = np.ones((rows, n), dtype=bool)
+  new_run[:, 1:] = kind[:, 1:] != kind[:, :-1]
+  starts = np.flatnonzero(new_run)       # in the rows, one after the other
+  row = starts // n
+  # every row starts a battery slot, so the last one of a row ends there
+  ends = np.append(starts[1:], rows*n)
+  sizes = ends - starts
+  # the level at the end of a battery slot is in the same row of batt,
+  # which has a column more than e_in
+  batt_ends = batt.reshape(-1)[ends + row]
+  levels = batt[:, 1:].reshape(-1)
+  batt_min = np.minimum(np.minimum.reduceat(batt[:, :-1].reshape(-1), starts), batt_ends)
+  batt_max = np.maximum(np.maximum.reduceat(batt[:, :-1].reshape(-1), starts), batt_ends)
+  wasted = np.maximum(np.maximum.reduceat(levels, starts) - b_max[row], 0)
+  missed = np.maximum(b_min[row] - np.minimum.reduceat(levels, starts), 0)
+  flat_cons = e_cons.reshape(-1)
+  total_e_cons = _run_sums(flat_cons, starts, sizes)
+  delta_e_full = sizes*e_max - total_e_cons
+  delta_e_sleep = total_e_cons - sizes*e_min
+
+  bounds = np.concatenate(([0], np.cumsum(np.bincount(row, minlength=rows))))
+  # energy loss or gain greater than battery cap (checked when a slot
+  # ends, so not in the last battery slot of a row)
+  not_last = np.ones(len(starts), dtype=bool)
+  not_last[bounds[1:] - 1] = False
+  for i in np.flatnonzero(not_last & (batt_max - batt_min > (b_max - b_min)[row])):
+    print "Fail loss/gain", float(batt_max[i]), float(batt_min[i]), float(b_max[row[i]] - b_min[row[i]])
+  batt_slots = BatterySlotTable(kind.reshape(-1)[starts], starts - row*n, sizes, batt_min, batt_max,
+                                wasted, missed, delta_e_full, delta_e_sleep)
+  return (e_cons, batt, batt_slots, bounds)
+
+def first_pass_legacy(B0, e_in, e_min, e_max, b_min, b_max):
   """
   In each slot, set the energy consumption to e_in, if possible.
   If e_in is too low, set ec to e_sleep.
@@ -275,6 +438,20 @@ def second_pass(batt_slots, bmin, bmax, emin, emax):
   # TODO: keep track of all the changes
   # TODO: indicate if there is no solution
 
+  # the slots are walked one at a time, on lists of the columns used
+  types = batt_slots.type_names()
+  mins = batt_slots.min.tolist()
+  maxs = batt_slots.max.tolist()
+  def error(i, delta_b):
+    # BatterySlot.error
+    return max((maxs[i] - bmax) + delta_b, (bmin - mins[i]) - delta_b)
+  def error_type(i, delta_b):
+    # BatterySlot.error_type
+    if (maxs[i] - bmax) + delta_b > 0:
+      return 'emax'
+    if (bmin - mins[i]) - delta_b > 0:
+      return 'emin'
+
   # scan the list until there is an error of opposite type
   index = 0             # keep track of position in list
   crt_err_type = None   # to determine changes in error type
@@ -284,33 +461,32 @@ def second_pass(batt_slots, bmin, bmax, emin, emax):
   batt_delta = 0
   tent_err = 0
   changes = [(0,0) for i in range(len(batt_slots))]
-  for idx, b in enumerate(batt_slots):
-      if b.wasted != 0 or b.missed != 0:
-          print "Batt error in slot %d: %s" % (idx, b)
-  while index < len(batt_slots):
-    if batt_slots[index].type == 'ein':
+  for idx in np.flatnonzero((batt_slots.wasted != 0) | (batt_slots.missed != 0)):
+      print "Batt error in slot %d: %s" % (idx, batt_slots[idx])
+  while index < len(types):
+    if types[index] == 'ein':
       index += 1
       continue
     # include the max_err as a tentative change
-    if batt_slots[index].error(batt_delta+tent_err, bmin, bmax) > 1e-6:
+    if error(index, batt_delta+tent_err) > 1e-6:
       # we have an error
       if crt_err_type == None:
         # it's the first one we encountered
-        crt_err_type = batt_slots[index].type
-      elif crt_err_type != batt_slots[index].error_type(batt_delta+tent_err, bmin, bmax):
+        crt_err_type = types[index]
+      elif crt_err_type != error_type(index, batt_delta+tent_err):
         # found error of opposite type, analyse what we have so far
         print "Slots [%d:%d] max_error = %f at %d" % (list_start, max_err_index, max_err, max_err_index)
         # determine next minimum for [list_start:index]
-        next_min_list = next_minimum_list(delta_list(batt_slots[list_start:max_err_index + 1], crt_err_type, bmax, bmin))
+        next_min_list = next_minimum_list(delta_list(batt_slots, list_start, max_err_index + 1, crt_err_type, bmax, bmin))
         # process list [list_start:max_err_index+1]
-        process_rez = process_slots(batt_slots[list_start: max_err_index+1], max_err, crt_err_type, next_min_list, batt_delta, emin, emax)
-        if process_rez == None:
+        process_rez = process_slots(batt_slots, list_start, max_err_index+1, max_err, crt_err_type, next_min_list, batt_delta, emin, emax)
+        if process_rez is None:
           print "Second pass: couldn't recover error"
           return None
         (changes[list_start:max_err_index+1], batt_delta) = process_rez
 
         # reset statistics
-        crt_err_type = batt_slots[index].type
+        crt_err_type = types[index]
         list_start = max_err_index+1
         index = max_err_index +1
         max_err = 0
@@ -318,8 +494,8 @@ def second_pass(batt_slots, bmin, bmax, emin, emax):
         max_err_index = 0
         continue
     # track maximum error and its index
-    if batt_slots[index].error(batt_delta, bmin, bmax) > max_err:
-      max_err = batt_slots[index].error(batt_delta, bmin, bmax)
+    if error(index, batt_delta) > max_err:
+      max_err = error(index, batt_delta)
       max_err_index = index
       tent_err = max_err
       if crt_err_type == 'emax':
@@ -327,13 +503,13 @@ def second_pass(batt_slots, bmin, bmax, emin, emax):
     index += 1
   
   # handle any remaining slots
-  if list_start < len(batt_slots) and max_err != 0:
+  if list_start < len(types) and max_err != 0:
     print "Last slots [%d:%d] max_error = %f at %d" % (list_start, max_err_index, max_err, max_err_index)
     # determine next minimum for [list_start:]
-    next_min_list = next_minimum_list(delta_list(batt_slots[list_start:], crt_err_type, bmax, bmin))
+    next_min_list = next_minimum_list(delta_list(batt_slots, list_start, len(types), crt_err_type, bmax, bmin))
     # process list [list_start:]
-    process_rez = process_slots(batt_slots[list_start:], max_err, crt_err_type, next_min_list, batt_delta, emin, emax)
-    if process_rez == None:
+    process_rez = process_slots(batt_slots, list_start, len(types), max_err, crt_err_type, next_min_list, batt_delta, emin, emax)
+    if process_rez is None:
       print "Second pass: couldn't recover error"
       return None
     (changes[list_start:], batt_delta) = process_rez
@@ -352,57 +528,62 @@ def offset_correction(batt_slots, changes, B0, bmin, bmax):
   Can only apply changes that reduce the offset
   """
   # TODO: what do we return?
-  final_changes = [0 for i in range(len(batt_slots))]
+  types = batt_slots.type_names()
+  mins = batt_slots.min.tolist()
+  maxs = batt_slots.max.tolist()
+  delta_e_full = batt_slots.delta_e_full.tolist()
+  delta_e_sleep = batt_slots.delta_e_sleep.tolist()
+  final_changes = [0 for i in range(len(types))]
   offset = None
-  if batt_slots[-1].type == 'emin':
-    offset = B0 - (batt_slots[-1].min + changes[-1][1])
+  if types[-1] == 'emin':
+    offset = B0 - (mins[-1] + changes[-1][1])
   else:
-    offset = B0 - (batt_slots[-1].max + changes[-1][1])
+    offset = B0 - (maxs[-1] + changes[-1][1])
   
   # can we reduce the offset in the final slot?
-  if offset > 0 and batt_slots[-1].type in ['ein', 'emax']:
-    final_changes[-1] = -min(offset, batt_slots[-1].delta_e_sleep + changes[-1][0])
-  elif offset < 0 and batt_slots[-1].type in ['ein', 'emin']:
+  if offset > 0 and types[-1] in ['ein', 'emax']:
+    final_changes[-1] = -min(offset, delta_e_sleep[-1] + changes[-1][0])
+  elif offset < 0 and types[-1] in ['ein', 'emin']:
     # negative offset here because delta_e_full > 0
-    final_changes[-1] = min(-offset, batt_slots[-1].delta_e_full - changes[-1][0])
+    final_changes[-1] = min(-offset, delta_e_full[-1] - changes[-1][0])
 
   offset += final_changes[-1]
-  if abs(offset) < 1e-6:
-    # lucky break!
+  if abs(offset) < 1e-6 or len(types) < 2:
+    # lucky break! (or nothing more to change)
     return final_changes # TODO: what do we return?
 
   # not so lucky, there is still some offset left
   # min_delta represents the maximum amount of energy that can
   # be corrected from the offset without causing waste or overspending
   min_delta = None
-  if batt_slots[-2].type in ['ein', 'emax']:
-      end_slot = batt_slots[-2].max + changes[-2][1]
+  if types[-2] in ['ein', 'emax']:
+      end_slot = maxs[-2] + changes[-2][1]
   else:
-      end_slot = batt_slots[-2].min + changes[-2][1]
+      end_slot = mins[-2] + changes[-2][1]
   if offset > 0:
     min_delta = bmax - end_slot
   else:
     min_delta = end_slot - bmin
   
-  index = len(batt_slots) - 2
+  index = len(types) - 2
   while index >=0 and min_delta >= abs(offset) and abs(offset) > 0:
     change = 0
-    if offset > 0 and batt_slots[index].type in ['ein', 'emax']:
+    if offset > 0 and types[index] in ['ein', 'emax']:
       # reduce energy consumption to reduce offset
       # TODO no need to have min_delta in the following, since we know it's >= offset
-      change = -min(offset, batt_slots[index].delta_e_sleep + changes[index][0], min_delta)
-    elif offset < 0 and batt_slots[index].type in ['ein', 'emin']:
+      change = -min(offset, delta_e_sleep[index] + changes[index][0], min_delta)
+    elif offset < 0 and types[index] in ['ein', 'emin']:
       # increase energy consumption to reduce offset
       #   negative offset here because delta_e_sleep > 0
-      change = min(-offset, batt_slots[index].delta_e_full - changes[index][0], min_delta)
+      change = min(-offset, delta_e_full[index] - changes[index][0], min_delta)
     offset  += change
     final_changes[index] = change
     #print "At", index, min_delta, "Offset =", offset
     index -= 1
-    if batt_slots[index].type in ['ein', 'emax']:
-      end_slot = batt_slots[index].max + changes[index][1]
+    if types[index] in ['ein', 'emax']:
+      end_slot = maxs[index] + changes[index][1]
     else:
-      end_slot = batt_slots[index].min + changes[index][1]
+      end_slot = mins[index] + changes[index][1]
     if offset > 0:
       min_delta = min(bmax - end_slot, min_delta)
     else:
@@ -416,7 +597,61 @@ def offset_correction(batt_slots, changes, B0, bmin, bmax):
   
 
 
-def apply_changes(changes, batt_slots, consumption, emin, emax):
+def apply_changes(changes, batt_slots, consumption, emin, emax, engine='numpy'):
+  """
+  Apply the changes to the consumption, see apply_changes_legacy.
+  engine: 'numpy' (apply_changes_numpy) or 'legacy'
+  """
+  if engine == 'legacy':
+    return apply_changes_legacy(changes, batt_slots, consumption, emin, emax)
+  return apply_changes_numpy(changes, batt_slots, consumption, emin, emax)
+
+def _spread(cons, ch, emin, emax):
+  """
+  Apply the change ch to cons (an array, changed in place) greedily,
+  as apply_changes_legacy does: as much as possible in every slot,
+  in order, within [emin, emax]. Returns the change left.
+
+  While the slots saturate, the change left after slot i is
+  (change left before it + cons[i]) - bound, bound being emax for an
+  increase and emin for a decrease. A cumulative sum of
+  ch, cons[0], -bound, cons[1], -bound, ... makes the same additions,
+  in the same order, for all the slots at once; the change stops at
+  the first one that doesn't saturate.
+  cons is within [emin, emax], as first_pass makes it.
+  """
+  bound = emax if ch > 0 else emin
+  steps = np.empty(2*len(cons) + 1)
+  steps[0] = ch
+  steps[1::2] = cons
+  steps[2::2] = -bound
+  acc = np.cumsum(steps)
+  new_e_cons = acc[1::2]
+  if ch > 0:
+    stop = np.flatnonzero(new_e_cons <= emax)
+  else:
+    stop = np.flatnonzero(new_e_cons >= emin)
+  if len(stop) > 0:
+    cons[:stop[0]] = bound
+    cons[stop[0]] = new_e_cons[stop[0]]
+    return 0
+  cons[:] = bound
+  return acc[-1]
+
+def apply_changes_numpy(changes, batt_slots, consumption, emin, emax):
+  """
+  Same as apply_changes_legacy, a battery slot at a time (see _spread).
+  """
+  updated_cons = np.array(consumption, dtype=np.float64)
+  for idx in np.flatnonzero(np.asarray(changes) != 0):
+    start, size = batt_slots.start[idx], batt_slots.size[idx]
+    ch = _spread(updated_cons[start:start + size], changes[idx], emin, emax)
+    if abs(ch) > 1e-6:
+      print "Left with", ch, "in slot", start + size - 1, "batt slot", idx
+      return None # couldn't apply transformation - this shouldn't happen
+  return updated_cons
+
+def apply_changes_legacy(changes, batt_slots, consumption, emin, emax):
   """
   Changes need to be applied in a greedy manner on the
   slots of energy consumption.
@@ -455,11 +690,19 @@ def apply_changes(changes, batt_slots, consumption, emin, emax):
       return None # couldn't apply transformation - this shouldn't happen
   return updated_cons   
     
-def compute_battery(B0, econs, ein, bmin, bmax, e_min, e_max):
+def compute_battery(B0, econs, ein, bmin, bmax, e_min, e_max, engine='numpy'):
   """
   Given values for harvested and consumed energy,
   determine the battery values
+  engine: 'numpy' (a cumulative sum) or 'legacy'
   """
+  if engine == 'legacy':
+    return compute_battery_legacy(B0, econs, ein, bmin, bmax, e_min, e_max)
+  delta_e = np.asarray(ein, dtype=np.float64) - np.asarray(econs, dtype=np.float64)
+  return np.cumsum(np.concatenate(([B0], delta_e)))
+
+def compute_battery_legacy(B0, econs, ein, bmin, bmax, e_min, e_max):
+  """Battery values, adding up the slots one at a time"""
   battery = [B0]
   
   prev = None
@@ -469,85 +712,530 @@ def compute_battery(B0, econs, ein, bmin, bmax, e_min, e_max):
     battery.append(b_i)
   return battery
 
-def simple_optimum(B0, bmin, bmax, emin, emax, e_in):
+def simple_optimum(B0, bmin, bmax, emin, emax, e_in, engine='numpy', target=None):
   """
   Run the algorithm
+  engine: 'numpy' or 'legacy', for first_pass, apply_changes and compute_battery
+  target: battery level at the end of e_in, default B0
+  """
+  first_pass_rez = first_pass(B0, e_in, emin, emax, bmin, bmax, engine)
+  return later_passes(first_pass_rez, B0, bmin, bmax, emin, emax, e_in, engine, target)
+
+def later_passes(first_pass_rez, B0, bmin, bmax, emin, emax, e_in, engine='numpy', target=None):
+  """
+  The rest of simple_optimum, given the result of the first pass
   """
-  first_pass_rez = first_pass(B0, e_in, emin, emax, bmin, bmax)
-  if first_pass_rez == None:
+  if target is None:
+    target = B0
+  if first_pass_rez is None:
     print "Failure in first pass"
     return None
   (e_cons, batt, batt_slots) = first_pass_rez
+  changes = total_changes(batt_slots, bmin, bmax, emin, emax, target)
+  if changes is None:
+    return None
+  new_cons = apply_changes(changes, batt_slots, e_cons, emin, emax, engine)
+  if new_cons is None:
+    print "Error applying changes"
+    return None
+  new_batt = compute_battery(B0, new_cons, e_in, bmin, bmax, emin, emax, engine)
+  return (new_cons, new_batt, batt_slots)
+
+def total_changes(batt_slots, bmin, bmax, emin, emax, target):
+  """
+  The second pass and the offset correction, to the battery level
+  target: the change of consumption of every battery slot, or None if
+  there is no solution
+  """
   second_pass_rez = second_pass(batt_slots, bmin, bmax, emin, emax)
-  if second_pass_rez == None:
+  if second_pass_rez is None:
     print "Failure in second pass"
     return None
   (changes, batt_delta) = second_pass_rez
-  final_changes = offset_correction(batt_slots, changes, B0, bmin, bmax)
+  final_changes = offset_correction(batt_slots, changes, target, bmin, bmax)
   if len(final_changes) == 0:
     print "Error in offset correction"
     return None
-  total_changes = [e[0][0] + e[1] for e in zip(changes, final_changes)]
-  new_cons = apply_changes(total_changes, batt_slots, e_cons, emin, emax)
-  if new_cons == None:
-    print "Error applying changes"
-    return None
-  new_batt = compute_battery(B0, new_cons, e_in, bmin, bmax, emin, emax)
-  return (new_cons, new_batt, batt_slots)
+  return [e[0][0] + e[1] for e in zip(changes, final_changes)]
+
+# the codes of BatterySlotTable.types, and no error type
+_emin, _ein, _emax, _none = 0, 1, 2, -1
+# the status of a row in second_pass_batch
+_done, _failed, _odd = 2, 3, 4
+
+def _range_min_table(values):
+  """
+  The minimums of values over [i, i + 2**k), for k = 0, 1, ...: with
+  them, the minimum of any range of values takes two lookups
+  (_range_min).
+  """
+  levels = [values]
+  width = 1
+  while 2*width <= len(values):
+    prev = levels[-1]
+    levels.append(np.minimum(prev[:len(prev) - width], prev[width:]))
+    width *= 2
+  return levels
+
+def _range_min(levels, lo, hi):
+  """Minimum of values[lo:hi], for arrays of non-empty ranges, see _range_min_table"""
+  k = np.floor(np.log2(hi - lo)).astype(np.int64)
+  mins = np.empty(len(lo))
+  for level in np.unique(k):
+    sel = np.flatnonzero(k == level)
+    mins[sel] = np.minimum(levels[level][lo[sel]], levels[level][hi[sel] - (1 << level)])
+  return mins
+
+def second_pass_batch(batt_slots, bounds, bmin, bmax):
+  """
+  second_pass for many rows at once, batt_slots holding the battery
+  slots of all the rows and bounds their limits (see first_pass_batch),
+  bmin and bmax being arrays of one value per row. Nothing is printed.
+
+  The rows go through the states of second_pass in lockstep, one battery
+  slot per row and step: scanning for errors, or recovering the errors
+  of a list of slots (process_slots, whose next minimum lists are range
+  minimums over the table). Rows that second_pass would take back before
+  their current list (an error of the opposite type before any maximum
+  error in the list) or leave with errors of no type are left to it.
+
+  returns (change, batt_change, status): the changes of every battery
+  slot, and per row _done, _failed (second_pass returns None) or
+  _odd (for second_pass)
+  """
+  rows = len(bounds) - 1
+  first = bounds[:-1]
+  length = np.diff(bounds)
+  typ = batt_slots.type.astype(np.int64)
+  row_of = np.repeat(np.arange(rows), length)
+  # the terms of error() and delta_list()
+  over = batt_slots.max - bmax[row_of]
+  under = bmin[row_of] - batt_slots.min
+  to_bmin = _range_min_table(batt_slots.min - bmin[row_of])
+  to_bmax = _range_min_table(bmax[row_of] - batt_slots.max)
+  lost = np.maximum(batt_slots.wasted, batt_slots.missed)
+  change = np.zeros(len(typ))
+  batt_change = np.zeros(len(typ))
+
+  _scan, _process = 0, 1
+  state = np.where(length > 0, _scan, _done)
+  # second_pass
+  index = np.zeros(rows, dtype=np.int64)
+  crt_err_type = np.full(rows, _none, dtype=np.int64)
+  list_start = np.zeros(rows, dtype=np.int64)
+  max_err = np.zeros(rows)
+  max_err_index = np.zeros(rows, dtype=np.int64)
+  batt_delta = np.zeros(rows)
+  tent_err = np.zeros(rows)
+  # process_slots, on [pos:end] of the row, and the type to scan for after
+  # it (_none after the last list)
+  pos = np.zeros(rows, dtype=np.int64)
+  end = np.zeros(rows, dtype=np.int64)
+  err = np.zeros(rows)
+  err_type = np.zeros(rows, dtype=np.int64)
+  bc = np.zeros(rows)
+  next_type = np.zeros(rows, dtype=np.int64)
+  # the slots left unchanged at the end of the lists: (start, stop, batt_change)
+  rests = []
+
+  while True:
+    scanning = np.flatnonzero(state == _scan)
+    processing = np.flatnonzero(state == _process)
+    if len(scanning) == 0 and len(processing) == 0:
+      break
+
+    if len(processing) > 0:
+      r = processing
+      going = (pos[r] < end[r]) & (err[r] > 0)
+      done = r[~going]
+      state[done[err[done] > 0]] = _failed
+      done = done[err[done] <= 0]
+      rests.append((first[done] + pos[done], first[done] + end[done], bc[done]))
+      batt_delta[done] = bc[done]
+      state[done[next_type[done] == _none]] = _done
+      done = done[next_type[done] != _none]
+      # reset statistics
+      crt_err_type[done] = next_type[done]
+      list_start[done] = end[done]
+      index[done] = end[done]
+      max_err[done] = 0
+      tent_err[done] = 0
+      max_err_index[done] = 0
+      state[done] = _scan
+
+      r = r[going]
+      i = first[r] + pos[r]
+      stop = first[r] + end[r]
+      t = typ[i]
+      e = err_type[r]
+      is_emin = e == _emin
+      next_min = np.empty(len(r))
+      sel = np.flatnonzero(is_emin)
+      next_min[sel] = _range_min(to_bmax, i[sel], stop[sel])
+      sel = np.flatnonzero(~is_emin)
+      next_min[sel] = _range_min(to_bmin, i[sel], stop[sel])
+      max_energy_delta = np.where(is_emin, batt_slots.delta_e_sleep[i], batt_slots.delta_e_full[i])
+      ch = np.where(is_emin, np.minimum(np.minimum(err[r], next_min - bc[r]), max_energy_delta),
+                             np.minimum(np.minimum(err[r], bc[r] + next_min), max_energy_delta))
+      ch = np.where((t == _ein) | (t == _emin + _emax - e), ch, 0)
+      err[r] -= ch
+      ch = np.where(is_emin, -ch, ch)
+      bc[r] -= ch
+      change[i] = ch
+      batt_change[i] = bc[r]
+      state[r[(t == e) & (lost[i] > np.abs(bc[r]))]] = _failed
+      pos[r] += 1
+
+    if len(scanning) > 0:
+      r = scanning
+      # handle any remaining slots
+      at_end = index[r] >= length[r]
+      last = r[at_end]
+      state[last] = _done
+      last = last[(list_start[last] < length[last]) & (max_err[last] != 0)]
+      state[last[crt_err_type[last] == _none]] = _odd
+      last = last[crt_err_type[last] != _none]
+      pos[last] = list_start[last]
+      end[last] = length[last]
+      err[last] = max_err[last]
+      err_type[last] = crt_err_type[last]
+      bc[last] = batt_delta[last]
+      next_type[last] = _none
+      state[last] = _process
+
+      r = r[~at_end]
+      i = first[r] + index[r]
+      t = typ[i]
+      index[r[t == _ein]] += 1
+      r, i, t = r[t != _ein], i[t != _ein], t[t != _ein]
+      # include the max_err as a tentative change
+      delta = batt_delta[r] + tent_err[r]
+      has_err = np.maximum(over[i] + delta, under[i] - delta) > 1e-6
+      new_type = np.where(over[i] + delta > 0, _emax, np.where(under[i] - delta > 0, _emin, _none))
+      opposite = has_err & (crt_err_type[r] != _none) & (crt_err_type[r] != new_type)
+      found = has_err & (crt_err_type[r] == _none)
+      crt_err_type[r[found]] = t[found]
+      # found error of opposite type, process [list_start:max_err_index+1]
+      o, ot = r[opposite], t[opposite]
+      back = max_err_index[o] < list_start[o]
+      state[o[back]] = _odd
+      o, ot = o[~back], ot[~back]
+      pos[o] = list_start[o]
+      end[o] = max_err_index[o] + 1
+      err[o] = max_err[o]
+      err_type[o] = crt_err_type[o]
+      bc[o] = batt_delta[o]
+      next_type[o] = ot
+      state[o] = _process
+      # track maximum error and its index
+      r, i = r[~opposite], i[~opposite]
+      e = np.maximum(over[i] + batt_delta[r], under[i] - batt_delta[r])
+      up = e > max_err[r]
+      u = r[up]
+      max_err[u] = e[up]
+      max_err_index[u] = index[u]
+      tent_err[u] = np.where(crt_err_type[u] == _emax, -e[up], e[up])
+      index[r] += 1
+
+  if rests:
+    start, stop, value = [np.concatenate(c) for c in zip(*rests)]
+    sizes = stop - start
+    offsets = np.cumsum(sizes) - sizes
+    batt_change[np.arange(sizes.sum()) - np.repeat(offsets - start, sizes)] = np.repeat(value, sizes)
+  return (change, batt_change, state)
+
+def offset_correction_batch(batt_slots, bounds, change, batt_change, B0, bmin, bmax, rows):
+  """
+  offset_correction for the given rows, at once: the battery slots,
+  bounds and changes as in second_pass_batch; B0 (the target), bmin
+  and bmax arrays of one value per row.
+  returns the final changes of every battery slot (0 out of rows)
+  """
+  first = bounds[:-1]
+  typ = batt_slots.type.astype(np.int64)
+  final_changes = np.zeros(len(typ))
+  length = bounds[rows + 1] - first[rows]
+  i = first[rows] + length - 1
+  t = typ[i]
+  offset = B0[rows] - (np.where(t == _emin, batt_slots.min[i], batt_slots.max[i]) + batt_change[i])
+  # can we reduce the offset in the final slot?
+  final = np.where((offset > 0) & (t != _emin), -np.minimum(offset, batt_slots.delta_e_sleep[i] + change[i]),
+                   np.where((offset < 0) & (t != _emax), np.minimum(-offset, batt_slots.delta_e_full[i] - change[i]), 0))
+  final_changes[i] = final
+  offset = offset + final
+  left = (np.abs(offset) >= 1e-6) & (length >= 2)
+  rows, length, offset = rows[left], length[left], offset[left]
+
+  index = length - 2
+  def min_delta_at(index, offset, min_delta=None):
+    # the battery at the end of the slot index, or of the last one at -1
+    i = first[rows] + np.where(index >= 0, index, length - 1)
+    end_slot = np.where(typ[i] != _emin, batt_slots.max[i], batt_slots.min[i]) + batt_change[i]
+    delta = np.where(offset > 0, bmax[rows] - end_slot, end_slot - bmin[rows])
+    return delta if min_delta is None else np.minimum(delta, min_delta)
+  min_delta = min_delta_at(index, offset)
+  while True:
+    going = (index >= 0) & (min_delta >= np.abs(offset)) & (np.abs(offset) > 0)
+    if not going.any():
+      break
+    rows, length, index, offset, min_delta = rows[going], length[going], index[going], offset[going], min_delta[going]
+    i = first[rows] + index
+    t = typ[i]
+    ch = np.where((offset > 0) & (t != _emin),
+                  -np.minimum(np.minimum(offset, batt_slots.delta_e_sleep[i] + change[i]), min_delta),
+                  np.where((offset < 0) & (t != _emax),
+                           np.minimum(np.minimum(-offset, batt_slots.delta_e_full[i] - change[i]), min_delta), 0))
+    offset = offset + ch
+    final_changes[i] = ch
+    index = index - 1
+    min_delta = min_delta_at(index, offset, min_delta)
+  return final_changes
+
+def apply_changes_batch(changes, batt_slots, bounds, consumption, emin, emax):
+  """
+  apply_changes_numpy for every row of the matrix consumption at once,
+  the changes being those of the battery slots of all the rows (see
+  second_pass_batch): _spread, for all the battery slots of the same
+  size together, one per row of a matrix.
+  returns the updated consumption, and per row whether the changes
+  could be applied
+  """
+  updated_cons = np.array(consumption, dtype=np.float64)
+  rows = len(bounds) - 1
+  row_of = np.repeat(np.arange(rows), np.diff(bounds))
+  applied = np.ones(rows, dtype=bool)
+  slots = np.flatnonzero(changes != 0)
+  sizes = batt_slots.size[slots]
+  for size in np.unique(sizes):
+    s = slots[sizes == size]
+    r = row_of[s][:, None]
+    cols = batt_slots.start[s][:, None] + np.arange(size)
+    ch = changes[s]
+    bound = np.where(ch > 0, emax, emin)
+    steps = np.empty((len(s), 2*size + 1))
+    steps[:, 0] = ch
+    steps[:, 1::2] = updated_cons[r, cols]
+    steps[:, 2::2] = -bound[:, None]
+    acc = np.cumsum(steps, axis=1)
+    new_e_cons = acc[:, 1::2]
+    fits = np.where((ch > 0)[:, None], new_e_cons <= emax, new_e_cons >= emin)
+    stops = fits.any(axis=1)
+    stop = np.where(stops, fits.argmax(axis=1), size)
+    cons = np.where(np.arange(size) < stop[:, None], bound[:, None], steps[:, 1::2])
+    k = np.flatnonzero(stops)
+    cons[k, stop[k]] = new_e_cons[k, stop[k]]
+    updated_cons[r, cols] = cons
+    applied[row_of[s[~stops & (np.abs(acc[:, -1]) > 1e-6)]]] = False
+  return (updated_cons, applied)
+
+def simple_optimum_batch(B0, bmin, bmax, emin, emax, e_in, target=None):
+  """
+  simple_optimum (numpy engine) for every row of the matrix e_in, e.g.
+  the predictions of the nodes of a fleet, with B0, bmin, bmax and
+  target arrays of one value per row. All the passes are made for all
+  the rows at once (first_pass_batch, second_pass_batch,
+  offset_correction_batch and apply_changes_batch), without the
+  diagnostics of the scalar passes; the rows that second_pass_batch
+  leaves to second_pass are planned by later_passes.
+  Returns matrices of the consumption and the battery of every row, and
+  per row whether simple_optimum has a solution (it doesn't return None).
+  """
+  e_in = np.asarray(e_in, dtype=np.float64)
+  rows = len(e_in)
+  B0, bmin, bmax = [np.broadcast_to(np.asarray(v, dtype=np.float64), (rows,)) for v in (B0, bmin, bmax)]
+  target = B0 if target is None else np.broadcast_to(np.asarray(target, dtype=np.float64), (rows,))
+  (e_cons, batt, batt_slots, bounds) = first_pass_batch(B0, e_in, emin, emax, bmin, bmax)
+  (change, batt_change, status) = second_pass_batch(batt_slots, bounds, bmin, bmax)
+  done = np.flatnonzero(status == _done)
+  final_changes = offset_correction_batch(batt_slots, bounds, change, batt_change, target, bmin, bmax, done)
+  # the changes of the other rows aren't applied
+  total_changes = np.where(np.repeat(status == _done, np.diff(bounds)), change + final_changes, 0)
+  (new_cons, applied) = apply_changes_batch(total_changes, batt_slots, bounds, e_cons, emin, emax)
+  ok = (status == _done) & applied
+  for r in np.flatnonzero(status == _odd):
+    first_pass_rez = (e_cons[r], batt[r], batt_slots.section(bounds[r], bounds[r+1]))
+    plan = later_passes(first_pass_rez, B0[r], bmin[r], bmax[r], emin, emax, e_in[r], target=target[r])
+    if plan is not None:
+      new_cons[r] = plan[0]
+      ok[r] = True
+  new_batt = np.cumsum(np.concatenate((B0[:, None], e_in - new_cons), axis=1), axis=1)
+  return (new_cons, new_batt, ok)
 
 import eh_constants as ehct
 class MallecOptimal():
-    def __init__(self, slots_per_cycle):
-        self.allocation = [0 for i in xrange(slots_per_cycle)]
+    corrections = ('incremental', 'replan', 'none')
+    # the configuration, checked by EHSimulator.restore
+    parameters = ('bmin', 'bmax', 'engine', 'correction')
+
+    def __init__(self, slots_per_cycle, bmin=None, bmax=None, engine='numpy', correction='incremental'):
+        """
+        Parameters:
+        slots_per_cycle -- number of slots in a cycle
+        bmin, bmax      -- battery thresholds, default from eh_constants
+        engine          -- 'numpy' or 'legacy' (scalar) passes, same results
+        correction      -- how update corrects the prediction errors:
+                           'incremental' (update_incremental) or 'replan'
+                           (update_replan), which plan the rest of the
+                           cycle alike, from the current battery to the
+                           level planned for the end of the cycle, or
+                           'none', keeping the allocation of the cycle as
+                           it was planned. From a full battery, as in
+                           run_test, steering the battery back to the
+                           planned level turns prediction errors into
+                           waste (e.g. 2879 J against 331 J with 'none',
+                           over 60 days of 725315 with EWMA)
+        """
+        if engine not in engines:
+            raise ValueError("Unknown engine %s" % engine)
+        if correction not in self.corrections:
+            raise ValueError("Unknown correction %s" % correction)
+        self.engine = engine
+        self.correction = correction
+        self.bmin = ehct.bmin if bmin is None else bmin
+        self.bmax = ehct.bmax if bmax is None else bmax
+        self.allocation = np.zeros(slots_per_cycle)
         self.battery_pred = None
         self.battery_slots = []
-        self.current_batt_slot = 0
-        self.offset_in_batt_slot = 0
+        self.batt_offset = 0    # added to all of battery_pred, see update_incremental
+        self.eh_pred = None
         self.start_batt = None
+        # the first pass of the cycle (consumption and battery), the
+        # extremes of the battery at the end of the slots of every battery
+        # slot and the change planned for every battery slot, see
+        # update_incremental
+        self.first_cons = None
+        self.first_batt = None
+        self.level_min = None
+        self.level_max = None
+        self.changes = None
 
     def allocate(self, eh_pred, start_batt):
         if self.start_batt == None:
             self.start_batt = start_batt
-        self.allocation, self.battery_pred, self.battery_slots = simple_optimum(self.start_batt, ehct.bmin, ehct.bmax, ehct.emin, ehct.emax, eh_pred)
-        self.current_batt_slot = 0
-        self.offset_in_batt_slot = 0
+        # simple_optimum, keeping the first pass and the changes
+        (e_cons, batt, batt_slots) = first_pass(self.start_batt, eh_pred, ehct.emin, ehct.emax, self.bmin, self.bmax, self.engine)
+        changes = total_changes(batt_slots, self.bmin, self.bmax, ehct.emin, ehct.emax, self.start_batt)
+        allocation = None
+        if changes is not None:
+            allocation = apply_changes(changes, batt_slots, e_cons, ehct.emin, ehct.emax, self.engine)
+        if allocation is None:
+            raise ValueError("No energy neutral allocation from a battery of %s" % self.start_batt)
+        self.allocation = np.array(allocation, dtype=np.float64)
+        self.battery_pred = np.array(compute_battery(self.start_batt, allocation, eh_pred, self.bmin, self.bmax, ehct.emin, ehct.emax, self.engine), dtype=np.float64)
+        self.battery_slots = batt_slots
+        self.batt_offset = 0
+        self.eh_pred = eh_pred
+        self.first_cons = np.array(e_cons, dtype=np.float64)
+        self.first_batt = np.array(batt, dtype=np.float64)
+        if len(batt_slots) > 0:
+            self.level_min = np.minimum.reduceat(self.first_batt[1:], batt_slots.start)
+            self.level_max = np.maximum.reduceat(self.first_batt[1:], batt_slots.start)
+        self.changes = np.array(changes, dtype=np.float64)
         return self.allocation[0]
 
     def update(self, slot_idx, eh_pred, eh_pred_prev, eh_observed, crt_batt):
-        """Increase or decrease the energy allocated in the current
-        battery slot, accounting for prediction errors
+        """Increase or decrease the energy allocated from this slot on,
+        accounting for prediction errors
         """
-        # how many slots are left in the current battery slot?
-        remaining = self.battery_slots[self.current_batt_slot].size - self.offset_in_batt_slot
-        # allocate the energy difference in a greedy fashion, avoiding errors
-#        excess = crt_batt - self.battery_pred[slot_idx]
-#        if abs(excess) > 1e-6:
-#            print excess
-#        for i in range(slot_idx, slot_idx+remaining):
-#            new_e_cons = self.allocation[i]+excess
-#            # what is the remaining change
-#            if new_e_cons < ehct.emin:
-#                excess = new_e_cons - ehct.emin
-#                self.allocation[i] = ehct.emin
-#            elif new_e_cons > ehct.emax:
-#                excess = new_e_cons - ehct.emax
-#                self.allocation[i] = ehct.emax
-#            else:
-#                self.allocation[i] = new_e_cons
-#                excess = 0
-#                break # done
-
-        per_slot = (crt_batt - self.battery_pred[slot_idx])/float(remaining)
-        map(lambda x: x+per_slot, self.allocation[slot_idx:slot_idx+remaining])
-        # advance in battery slot
-        if self.offset_in_batt_slot == self.battery_slots[self.current_batt_slot].size - 1:
-            # next slot
-            self.current_batt_slot += 1
-            self.offset_in_batt_slot = 0
-        else:
-            self.offset_in_batt_slot += 1
+        if self.correction == 'incremental':
+            self.update_incremental(slot_idx, crt_batt)
+        elif self.correction == 'replan':
+            self.update_replan(slot_idx, crt_batt)
         return self.allocation[slot_idx]
-        
+
+    def _first_pass_from(self, slot_idx, crt_batt):
+        """
+        The battery slots of the first pass of simple_optimum on the rest
+        of the cycle, from crt_batt, without making the pass again: the
+        consumption of the first pass doesn't depend on the battery, so
+        the battery slots are those of the cycle from the one of slot_idx
+        on, and their battery is moved by a constant. Only the statistics
+        of the battery slot of slot_idx are taken again, from slot_idx.
+        """
+        t = self.battery_slots
+        b = np.searchsorted(t.start, slot_idx, 'right') - 1
+        end = t.start[b] + t.size[b]
+        shift = crt_batt - self.first_batt[slot_idx]
+        rest = BatterySlotTable(t.type[b:], t.start[b:] - slot_idx, t.size[b:].copy(),
+                                t.min[b:] + shift, t.max[b:] + shift,
+                                np.maximum(self.level_max[b:] + shift - self.bmax, 0),
+                                np.maximum(self.bmin - (self.level_min[b:] + shift), 0),
+                                t.delta_e_full[b:].copy(), t.delta_e_sleep[b:].copy())
+        # the battery slot of slot_idx, as first_pass_numpy
+        batt = self.first_batt[slot_idx:end+1] + shift
+        total_e_cons = np.cumsum(self.first_cons[slot_idx:end])[-1]
+        rest.start[0] = 0
+        rest.size[0] = end - slot_idx
+        rest.min[0] = batt.min()
+        rest.max[0] = batt.max()
+        rest.wasted[0] = max(batt[1:].max() - self.bmax, 0)
+        rest.missed[0] = max(self.bmin - batt[1:].min(), 0)
+        rest.delta_e_full[0] = rest.size[0]*ehct.emax - total_e_cons
+        rest.delta_e_sleep[0] = total_e_cons - rest.size[0]*ehct.emin
+        for i in np.flatnonzero(rest.max[:-1] - rest.min[:-1] > (self.bmax - self.bmin)):
+            print "Fail loss/gain", float(rest.max[i]), float(rest.min[i]), (self.bmax - self.bmin)
+        return rest
+
+    def update_incremental(self, slot_idx, crt_batt):
+        """
+        Plan the rest of the cycle again, as update_replan does, without
+        making the whole of simple_optimum again: the first pass is
+        taken from that of the cycle (_first_pass_from), and the second
+        pass and the offset correction, which decide the change of every
+        battery slot, are made on the battery slots left. The consumption
+        is only spread again in the battery slots whose change differs
+        from the previous plan, and in that of slot_idx; the predicted
+        battery is computed again up to the last of them, and moved by a
+        constant after it, kept as batt_offset.
+        If there is no solution the allocation is kept.
+        """
+        target = self.battery_pred[-1] + self.batt_offset
+        t = self.battery_slots
+        b = np.searchsorted(t.start, slot_idx, 'right') - 1
+        changes = total_changes(self._first_pass_from(slot_idx, crt_batt), self.bmin, self.bmax, ehct.emin, ehct.emax, target)
+        if changes is None:
+            return
+        changes = np.array(changes, dtype=np.float64)
+        touched = np.flatnonzero(changes != self.changes[b:])
+        if len(touched) == 0 or touched[0] != 0:
+            touched = np.concatenate(([0], touched))
+        spread = []
+        for i in touched:
+            start = max(t.start[b+i], slot_idx)
+            stop = t.start[b+i] + t.size[b+i]
+            cons = self.first_cons[start:stop].copy()
+            if changes[i] != 0:
+                ch = _spread(cons, changes[i], ehct.emin, ehct.emax)
+                if abs(ch) > 1e-6:
+                    # as apply_changes
+                    print "Left with", ch, "in slot", stop - 1 - slot_idx, "batt slot", i
+                    print "Error applying changes"
+                    return
+            spread.append((start, stop, cons))
+        for (start, stop, cons) in spread:
+            self.allocation[start:stop] = cons
+        self.changes[b:] = changes
+        # the battery up to the end of the last battery slot changed
+        end = spread[-1][1]
+        delta_e = np.asarray(self.eh_pred[slot_idx:end], dtype=np.float64) - self.allocation[slot_idx:end]
+        batt = np.cumsum(np.concatenate(([crt_batt], delta_e)))
+        self.batt_offset += batt[-1] - (self.battery_pred[end] + self.batt_offset)
+        self.battery_pred[slot_idx:end+1] = batt - self.batt_offset
+
+    def update_replan(self, slot_idx, crt_batt):
+        """
+        Run simple_optimum again on the rest of the cycle, from the
+        current battery to the level the cycle was planned to end with.
+        If there is no solution the allocation is kept.
+        """
+        target = self.battery_pred[-1] + self.batt_offset
+        rez = simple_optimum(crt_batt, self.bmin, self.bmax, ehct.emin, ehct.emax, self.eh_pred[slot_idx:], self.engine, target)
+        if rez is None:
+            return
+        (allocation, battery_pred, batt_slots) = rez
+        self.allocation[slot_idx:] = allocation
+        self.battery_pred[slot_idx:] = np.asarray(battery_pred) - self.batt_offset
+
 #if __name__ == '__main__':
 #  # harvested energy
 #  p_in_file = open('power.dat', 'r')
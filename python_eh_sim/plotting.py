@@ -1,6 +1,33 @@
+"""
+Plotting of simulation results.
+
+plot_results draws the totals of every trace and algorithm as bar charts.
+plot_timeseries draws per-slot metrics (battery, allocation, ...) of runs
+of a ResultsStore; the series are downsampled to about one bucket per
+pixel (see downsample.py), so years of slots plot as fast as a day.
+export_figures writes the figures of a whole store to a folder.
+
+Without a display (e.g. on a cluster node) the non-interactive Agg
+backend is used, and export_figures always draws on Agg figures, outside
+of pyplot, so it runs headless and in worker processes.
+"""
+import os
+import multiprocessing
 import numpy as np
-import eh_constants as ehct
+import matplotlib
+if not os.environ.get('DISPLAY'):
+    matplotlib.use('Agg')
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import eh_constants as ehct
+import downsample
+
+# units of the per-slot columns of a ResultsStore
+column_labels = {'allocation': 'Allocated energy', 'battery': 'Battery',
+                 'harvested': 'Harvested energy', 'predicted': 'Predicted energy',
+                 'error_type': 'Error type', 'error_quantity': 'Error quantity'}
+downsample_methods = ('minmax', 'lttb', None)
 
 # functions for computing the plotted data
 def econsfun(r, alg, res):
@@ -16,16 +43,42 @@ def finalfun(r, alg, res):
     """Final energy (\% of initial)"""
     return res[r][alg][3]/float(ehct.bmax)
 
-def plot_results(results, with_oracle, saveas=None):
+def store_selection(store, with_oracle, traces=None, algorithms=None, **config):
+    """The traces and algorithms of the runs of a ResultsStore, in the
+    order they were first added, unless given"""
+    runs = store.runs(with_oracle=with_oracle, **config)
+    if traces is None:
+        traces = _distinct(r['trace'] for r in runs)
+    if algorithms is None:
+        algorithms = _distinct(r['algorithm'] for r in runs)
+    return traces, algorithms
+
+def _distinct(values):
+    seen = []
+    for v in values:
+        if v not in seen:
+            seen.append(v)
+    return seen
+
+def plot_results(results, with_oracle, saveas=None, algs=None, traces=None):
     """
     Plot the results
 
     results     -- This can be a string, in which case they represent a pickle.
-                   Otherwise, they are considered the array of results.
+                   It can be a ResultsStore, with any number of traces and
+                   algorithms (all of them, unless traces/algs select some).
+                   Otherwise, they are considered the array of results,
+                   results[trace][algorithm].
     saveas      -- Suffix to use when saving plots in the current folder.
                    If ignored won't save.
+    algs        -- Names of the algorithms, in the order of results,
+                   by default those of run_test.
+    traces      -- With a ResultsStore, the traces to plot.
     """
-    if type(results) == str:
+    if hasattr(results, 'runs'):
+        traces, algs = store_selection(results, with_oracle, traces, algs)
+        results = results.results(traces, algs, with_oracle)
+    elif type(results) == str:
         try:
             import pickle
             if results.split('.')[0].split('_')[-1] == 'oracle':
@@ -36,10 +89,16 @@ def plot_results(results, with_oracle, saveas=None):
         except:
             print "Error loading pickled results"
             return None
+    if algs is None:
+        import run_test
+        algs = run_test.algorithm_names
 
     plot_data = {'eff_econsfun':{}, 'errorsfun':{}, 'finalfun':{}}
-    algs = ['kansal', 'mallec', 'buchli', 'gorlatova']
-    colors = ['0.1', '0.4', '0.7', '1'] # Shades of gray
+    n = len(results)
+    width = 0.8/len(algs)
+    colors = [str(c) for c in np.linspace(0.1, 1, len(algs))] # Shades of gray
+    bars = [[r + alg*width for r in xrange(n)] for alg in xrange(len(algs))]
+    ticks = [0.4+r for r in xrange(n)]
 
     # plot
     for fun_idx, fun in enumerate([eff_econsfun, errorsfun, finalfun]):
@@ -52,39 +111,39 @@ def plot_results(results, with_oracle, saveas=None):
             f, (ax1, ax2) = plt.subplots(2, 1, sharex=True,
                     gridspec_kw={'height_ratios':[3,1]}, num=fun.__name__)
             for alg, algname in enumerate(algs):
-                ax1.bar([r + alg*0.2 for r in xrange(7)],
-                        [fun(r,alg,results)*100 for r in xrange(7)],
-                        width=0.2, color=colors[alg], label=algs[alg])
+                ax1.bar(bars[alg],
+                        [fun(r,alg,results)*100 for r in xrange(n)],
+                        width=width, color=colors[alg], label=algs[alg])
             ax1.set_ylim([y_thr, 7])
             for alg, algname in enumerate(algs):
-                ax2.bar([r + alg*0.2 for r in xrange(7)],
-                        [fun(r,alg,results)*100 for r in xrange(7)],
-                        width=0.2, color=colors[alg], label=algs[alg])
+                ax2.bar(bars[alg],
+                        [fun(r,alg,results)*100 for r in xrange(n)],
+                        width=width, color=colors[alg], label=algs[alg])
             ax2.set_ylim([0, y_thr])
             ax2.set_yticks(np.linspace(0.0, y_thr, 2))
             ax2.set_yticklabels(['0', str(y_thr)])
             ax2.tick_params(axis='y', pad=0)
             plt.text(0.02, 0.87, 'Energy errors (\% of harvested)',
                     rotation=90, transform=plt.gcf().transFigure)
-            plt.xticks([0.4+r for r in xrange(7)], range(1,8))
+            plt.xticks(ticks, range(1,n+1))
             ax1.set_ylim([y_thr, 35])
             ax1.set_yticks(np.linspace(10, 35, 3))
             ax1.set_yticklabels(['10', '20', '30'])
             ax1.legend(loc=1, ncol=2, frameon=True, framealpha=0.5)
             ax2.set_xlabel('Data set')
             plt.tight_layout(pad=1.7, h_pad=-0.6)
-            ax1.set_xlim([-0.2,7])
-            ax2.set_xlim([-0.2,7])
+            ax1.set_xlim([-0.2,n])
+            ax2.set_xlim([-0.2,n])
             if saveas:
                     plt.savefig(fun.__name__+saveas+'.pdf', dpi=150)
             # Done, on to the next
             continue
         plt.figure(fun.__name__)
         for alg in xrange(len(algs)):
-            plt.bar([r + alg*0.2 for r in xrange(7)], [fun(r, alg, results)*100 for r in xrange(7)], width=0.2, color=colors[alg], label=algs[alg])
-            plot_data[fun.__name__][algs[alg]] = [fun(r, alg, results)*100 for r in xrange(7)]
+            plt.bar(bars[alg], [fun(r, alg, results)*100 for r in xrange(n)], width=width, color=colors[alg], label=algs[alg])
+            plot_data[fun.__name__][algs[alg]] = [fun(r, alg, results)*100 for r in xrange(n)]
         plt.legend(loc=1, ncol=2, frameon=True, framealpha=0.5)
-        plt.xticks([0.4+r for r in xrange(7)], range(1,8))
+        plt.xticks(ticks, range(1,n+1))
         if fun_idx == 0:
             plt.ylim([90,140])
             plt.axhline(100, color='k', linestyle='--')
@@ -96,8 +155,123 @@ def plot_results(results, with_oracle, saveas=None):
         #    plt.ylim([90, 135])
         plt.xlabel('Data set')
         plt.ylabel(fun.__doc__)
-        plt.xlim([-0.2,7])
+        plt.xlim([-0.2,n])
         plt.tight_layout()
         if saveas:
                 plt.savefig(fun.__name__+saveas+'.pdf', dpi=150)
     return plot_data
+
+def downsampled(y, width, method='minmax'):
+    """Indices of the points of y to draw in width pixels, see downsample.py.
+    method -- 'minmax' (min and max per pixel), 'lttb' (one point per
+              pixel) or None (all the points)"""
+    if method not in downsample_methods:
+        raise ValueError("Unknown downsampling method %s" % method)
+    if method == 'minmax':
+        return downsample.minmax(y, width)
+    if method == 'lttb':
+        return downsample.lttb(y, width)
+    return np.arange(len(y))
+
+def plot_timeseries(store, runs, column='battery', ax=None, start=None, stop=None,
+                    width=None, method='minmax'):
+    """
+    Plot a per-slot column of runs of a ResultsStore against time (days).
+
+    runs        -- runs of store.runs (dictionaries), or their ids
+    column      -- one of results_store.slot_columns
+    ax          -- the axes to draw on, by default a new pyplot figure
+    start, stop -- the slots to plot, by default all of them
+    width       -- buckets to downsample to, by default the width of the
+                   axes in pixels
+    method      -- see downsampled
+    Returns the axes.
+    """
+    if ax is None:
+        ax = plt.figure().add_subplot(111)
+    if width is None:
+        width = max(1, int(ax.get_window_extent().width))
+    for run in runs:
+        if not isinstance(run, dict):
+            run = store.run(run)
+        y = store.column(run['id'], column, start, stop)
+        idx = downsampled(y, width, method)
+        # slot length from the trace specification, hourly if unknown
+        slot = run['trace_spec'][2] if run['trace_spec'] else 3600
+        days = (idx + (start or 0)) * slot / 86400.
+        ax.plot(days, y[idx], label='%s %s' % (os.path.basename(run['trace']), run['algorithm']),
+                linewidth=0.8)
+    if column == 'battery':
+        ax.axhline(ehct.bmin, color='k', linestyle='--', linewidth=0.5)
+        ax.axhline(ehct.bmax, color='k', linestyle='--', linewidth=0.5)
+    ax.set_xlabel('Time (days)')
+    ax.set_ylabel(column_labels.get(column, column))
+    ax.legend(loc=1, fontsize='small', frameon=True, framealpha=0.5)
+    return ax
+
+def _export_trace(job):
+    """Write the time series figures of one trace, see export_figures"""
+    store_dir, trace, with_oracle, columns, out_dir, fmt, size, dpi, method, config = job
+    from results_store import ResultsStore
+    store = ResultsStore(store_dir)
+    # the last run of each algorithm, as in ResultsStore.results
+    last = {}
+    for run in store.runs(trace, with_oracle=with_oracle, **config):
+        last[run['algorithm']] = run
+    runs = sorted(last.values(), key=lambda run: run['id'])
+    # one figure for all the columns, cleared in between
+    fig = Figure(figsize=size, dpi=dpi)
+    FigureCanvasAgg(fig)
+    files = []
+    name = os.path.splitext(os.path.basename(trace))[0]
+    for column in columns:
+        fig.clear()
+        ax = fig.add_subplot(111)
+        plot_timeseries(store, runs, column, ax, width=int(size[0]*dpi), method=method)
+        ax.set_title(name)
+        path = os.path.join(out_dir, '%s_%s%s.%s' % (name, column, '_oracle' if with_oracle else '', fmt))
+        fig.savefig(path)
+        files.append(path)
+    store.close()
+    return files
+
+def export_figures(store, out_dir, with_oracle, columns=('battery', 'allocation'),
+                   traces=None, fmt='png', size=(8, 3), dpi=100, method='minmax',
+                   processes=1, config=None):
+    """
+    Write the time series of every trace of a ResultsStore, one figure
+    per trace and column with all the algorithms, to out_dir, as
+    <trace>_<column>[_oracle].<fmt>.
+
+    store       -- a ResultsStore, or its folder
+    columns     -- the per-slot columns to plot
+    traces      -- the traces, by default all the traces of the store
+    size, dpi   -- size of the figures, in inches and dots per inch;
+                   the series are downsampled to the width in pixels
+    processes   -- worker processes, the traces are spread over them
+                   (None for one per cpu)
+    config      -- selects the runs by their configuration parameters
+                   (see ResultsStore.runs); the last run of each
+                   algorithm is plotted
+    Returns the paths of the files written.
+    """
+    store_dir = getattr(store, 'store_dir', store)
+    config = config or {}
+    if traces is None:
+        from results_store import ResultsStore
+        s = ResultsStore(store_dir)
+        traces = store_selection(s, with_oracle, **config)[0]
+        s.close()
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    jobs = [(store_dir, t, with_oracle, columns, out_dir, fmt, size, dpi, method, config) for t in traces]
+    if processes == 1:
+        files = map(_export_trace, jobs)
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            files = pool.map(_export_trace, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    return sum(files, [])
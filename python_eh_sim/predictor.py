@@ -18,6 +18,8 @@ Paremeters:
   @num_slots - number of slots in the cycle
   @alpha     - tweaking parameter
 """
+import numpy as np
+
 class Predictor:
   def __init__(self, num_slots, alpha):
     self.num_slots = num_slots
@@ -25,17 +27,29 @@ class Predictor:
     self.alpha = alpha
     self.crt_slot = 0
     self.ready = False
+    # cumulative sums of the slots, cum[j] = sum(slots[:j]); the ones
+    # after crt_slot still have the slots of the previous pass, and are
+    # off by pending, see cumulative
+    self.cum = [0.0]
+    self.pending = 0.0
 
   def add_value(self, value):
     if len(self.slots) < self.num_slots:
       self.slots.append(value)
+      self.cum.append(self.cum[-1] + value)
       #print "Added slot", self.crt_slot, ":", value
     else:
       val = (1 - self.alpha) * self.slots[self.crt_slot] + self.alpha * value
       #print "Update slot", self.crt_slot, "with value", value, "=>", self.slots[self.crt_slot], "to", val
       self.slots[self.crt_slot] = val
+      new_cum = self.cum[self.crt_slot] + val
+      self.pending = new_cum - self.cum[self.crt_slot + 1]
+      self.cum[self.crt_slot + 1] = new_cum
       self.ready = True
     self.crt_slot = (self.crt_slot + 1) % self.num_slots
+    if self.crt_slot == 0:
+      # all the sums were recomputed in this pass
+      self.pending = 0.0
 
   def predict(self, slot):
     return self.slots[slot]
@@ -43,74 +57,284 @@ class Predictor:
   def predict_cycle(self):
     return self.slots
 
+  def predict_horizon(self, length):
+    """Prediction for the next length slots, from the slot to be added
+    next on, going around the cycle as many times as needed (an array)
+    """
+    idx = (self.crt_slot + np.arange(length)) % self.num_slots
+    return np.asarray(self.slots, dtype=np.float64)[idx]
+
+  def cumulative(self, j):
+    """sum(slots[:j]), in O(1)"""
+    if j <= self.crt_slot:
+      return self.cum[j]
+    return self.cum[j] + self.pending
+
+  def energy_until(self, t, slot_length):
+    """Predicted energy from time 0 (start of slot 0) to t, counting
+    a fraction of a slot as that fraction of the slot's energy.
+    """
+    cycle_length = self.num_slots * slot_length
+    cycles = t // cycle_length
+    pos = t - cycles * cycle_length
+    slot = min(int(pos // slot_length), self.num_slots - 1)
+    frac = (pos - slot * slot_length) / float(slot_length)
+    return cycles * self.cumulative(self.num_slots) + self.cumulative(slot) + frac * self.slots[slot]
+
   """
   This determines the energy prediction for a precise
-  timeframe (as opposed to a slot)
+  timeframe (as opposed to a slot), [t0, t1), in O(1).
+  t1 may be any number of cycles after t0.
   """
   def predict_precise(self, t0, t1, slot_length):
+    return self.energy_until(t1, slot_length) - self.energy_until(t0, slot_length)
+
+  def predict_precise_batch(self, t0, t1, slot_length):
+    """predict_precise for arrays of window starts and ends"""
+    cum = np.array(self.cum)
+    cum[self.crt_slot + 1:] += self.pending
+    slots = np.asarray(self.slots, dtype=np.float64)
     cycle_length = self.num_slots * slot_length
-    pos0 = float(t0 % cycle_length)
-    slot0 = int(pos0 / slot_length)
-    pos1 = float(t1 % cycle_length)
-    slot1 = int(pos1 / slot_length)
-    e_cons = 0
-    if slot0 == slot1:
-      e_cons = (pos1 - pos0) * self.predict(slot0)
-    else:
-      slot = slot0
-      if slot0 == self.num_slots - 1:
-        e_cons = (cycle_length - pos0) * self.predict(slot0)
-      else:
-        e_cons = ((slot0 + 1)*slot_length - pos0) * self.predict(slot0)
-      slot = (slot + 1) % self.num_slots
-      while slot != slot1:
-        e_cons += self.predict(slot)
-        slot = (slot + 1) % self.num_slots
-      e_cons += (pos1 - slot*slot_length) * self.predict(slot)
-    return e_cons
+    def energy_until(t):
+      t = np.asarray(t, dtype=np.float64)
+      cycles = np.floor(t / cycle_length)
+      pos = t - cycles * cycle_length
+      slot = np.minimum((pos // slot_length).astype(int), self.num_slots - 1)
+      frac = (pos - slot * slot_length) / float(slot_length)
+      return cycles * cum[-1] + cum[slot] + frac * slots[slot]
+    return energy_until(t1) - energy_until(t0)
  
 
+def cycle_matrix(trace, num_slots):
+  """
+  The trace as a (cycles x num_slots) matrix, with the last (partial)
+  cycle padded with NaN.
+  """
+  trace = np.asarray(trace, dtype=np.float64)
+  cycles = -(-len(trace) // num_slots)
+  m = np.empty(cycles * num_slots)
+  m[:len(trace)] = trace
+  m[len(trace):] = np.nan
+  return m.reshape(cycles, num_slots)
+
+def ewma_states(cycles, alphas):
+  """
+  ewma_matrix for several alphas at once, from a cycle_matrix:
+  returns (len(alphas) x cycles x num_slots).
+  """
+  alphas = np.asarray(alphas, dtype=np.float64)[:, None]
+  m = np.empty((len(alphas),) + cycles.shape)
+  if len(cycles) == 0:
+    return m
+  m[:, 0] = cycles[0]
+  for d in xrange(1, len(cycles)):
+    m[:, d] = (1 - alphas) * m[:, d-1] + alphas * cycles[d]
+  if len(cycles) > 1:
+    missing = np.isnan(cycles[-1])
+    m[:, -1, missing] = m[:, -2, missing]
+  return m
+
+def ewma_matrix(trace, num_slots, alpha):
+  """
+  The state of a Predictor fed with trace, after each cycle: row d is
+  the predictor's slots once the values of cycle d were added. A partial
+  last cycle only updates its slots.
+
+  The recurrence runs along the cycles, for all the slots at once, with
+  the same arithmetic as add_value, so the values are identical.
+  """
+  return ewma_states(cycle_matrix(trace, num_slots), [alpha])[0]
+
+def wcma_predictions(cycles, alphas, days, k):
+  """
+  Weather-Conditioned Moving Average (Piorno et al., 2009) for several
+  alphas, from a cycle_matrix. The prediction for the next slot is
+
+    alpha*x + (1-alpha)*GAP*M(next slot)
+
+  with x the value just observed, M the mean of the slot over the last
+  days cycles (fewer at the start of the trace) and GAP how the last k
+  slots compare to their means, weighted towards the most recent.
+
+  Returns (cycle, slot):
+  cycle -- (cycles x num_slots), row d is M for the cycle after d,
+           as in ewma_matrix
+  slot  -- (len(alphas) x cycles x num_slots), the prediction for each
+           slot made just before it, NaN for the first cycle
+  """
+  alphas = np.asarray(alphas, dtype=np.float64)[:, None]
+  n_cycles, n = cycles.shape
+  total = np.zeros((n_cycles + 1, n))
+  np.cumsum(cycles, axis=0, out=total[1:])
+  # mean[d] is the mean of cycles max(0, d-days)..d-1
+  first = np.maximum(np.arange(n_cycles + 1) - days, 0)
+  count = np.maximum(np.arange(n_cycles + 1) - first, 1)[:, None]
+  mean = (total - total[first])/count
+  mean[0] = np.nan
+  x = cycles.ravel()
+  m = mean[:-1].ravel()
+  # how the observed values compare to their means, 1 if unknown
+  eta = np.ones(len(x))
+  with np.errstate(invalid='ignore'):
+    known = m > 0
+  eta[known] = x[known]/m[known]
+  weights = np.arange(1, k+1, dtype=np.float64)/k
+  gap = np.convolve(eta, weights[::-1], 'full')[:len(x)]/weights.sum()
+  gap[:k-1] = np.nan
+  slot = np.empty((len(alphas), len(x)))
+  slot[:, 0] = np.nan
+  slot[:, 1:] = alphas * x[:-1] + (1 - alphas) * gap[:-1] * m[1:]
+  slot[:, :n] = np.nan
+  return mean[1:], slot.reshape(len(alphas), n_cycles, n)
+
+class MatrixPredictor:
+  """
+  Replays precomputed predictions with the interface of Predictor.
+
+  For EWMA, matrix is ewma_matrix(trace, ...) and the predictions are
+  those a Predictor fed with the same values would give. For the oracle,
+  matrix is cycle_matrix(trace, ...) and each cycle is predicted by its
+  own values, as with alg_tester.DummyPredictor; length is then the
+  length of the trace.
+
+  Other predictors give slot_matrix, the prediction for each slot made
+  just before it, used by predict instead of matrix.
+
+  predict_cycle returns a read-only row of matrix, which unlike the
+  Predictor's slots doesn't change as the cycle goes on.
+  """
+  # the precomputed predictions aren't part of the state of a simulation,
+  # see alg_tester.EHSimulator.checkpoint
+  shared = ('matrix', 'slot_matrix')
+
+  def __init__(self, matrix, num_slots, oracle=False, length=None, slot_matrix=None):
+    self.matrix = matrix.view()
+    self.matrix.flags.writeable = False
+    self.num_slots = num_slots
+    self.oracle = oracle
+    self.length = length
+    self.slot_matrix = slot_matrix
+    self.added = 0
+
+  def add_value(self, value):
+    self.added += 1
+
+  def predict(self, slot):
+    day, crt = divmod(self.added, self.num_slots)
+    if self.slot_matrix is not None:
+      return self.slot_matrix[day, slot]
+    if self.oracle or slot < crt:
+      return self.matrix[day, slot]
+    # not updated yet in this cycle
+    return self.matrix[day-1, slot]
+
+  def predict_cycle(self):
+    day = self.added // self.num_slots
+    if self.oracle:
+      return self.matrix[day, :self.length - self.added]
+    return self.matrix[day-1]
+
+  def predict_horizon(self, length):
+    """As Predictor.predict_horizon; the oracle's horizon ends with the trace"""
+    if self.oracle:
+      return self.matrix.reshape(-1)[self.added:min(self.added + length, self.length)]
+    day, crt = divmod(self.added, self.num_slots)
+    if self.slot_matrix is not None:
+      cycle = self.slot_matrix[day]
+    else:
+      cycle = np.concatenate((self.matrix[day, :crt], self.matrix[day-1, crt:]))
+    return cycle[(crt + np.arange(length)) % self.num_slots]
+
+
+
+class PredictorBank:
+  """
+  Many predictor configurations evaluated over one trace at once, e.g.
+
+    bank = PredictorBank(trace.trace, trace.slots_per_cycle)
+    bank.add_ewma([0.1, 0.25, 0.5])
+    bank.add_wcma([0.7], days=4, k=3)
+    for r in bank.evaluate(): print r['config'], r['rmse']
+
+  The EWMA alphas are computed in one recurrence, the WCMA alphas for
+  the same days and k share everything but the final blend. Configurations
+  are ('ewma', alpha) and ('wcma', alpha, days, k), in the order added.
+
+  Errors are those of the prediction for each slot made just before it,
+  from the second cycle on: for EWMA, the slot's value in the previous
+  cycle's row.
+  """
+  def __init__(self, trace, num_slots):
+    self.num_slots = num_slots
+    self.length = len(trace)
+    self.actual = cycle_matrix(trace, num_slots)
+    self.configs = []
+    self.cycle = []     # per config, rows as in ewma_matrix
+    self.slot = []      # per config, prediction for each slot
+
+  def add_ewma(self, alphas):
+    states = ewma_states(self.actual, alphas)
+    for a, m in zip(alphas, states):
+      slot = np.empty_like(m)
+      slot[0] = np.nan
+      slot[1:] = m[:-1]
+      self.configs.append(('ewma', a))
+      self.cycle.append(m)
+      self.slot.append(slot)
+
+  def add_wcma(self, alphas, days=4, k=3):
+    cycle, slots = wcma_predictions(self.actual, alphas, days, k)
+    for a, slot in zip(alphas, slots):
+      self.configs.append(('wcma', a, days, k))
+      self.cycle.append(cycle)
+      self.slot.append(slot)
+
+  def errors(self, i):
+    """Prediction minus actual value for each slot of config i,
+    as (cycles x num_slots), NaN where there is no prediction
+    """
+    return self.slot[i] - self.actual
+
+  def evaluate(self, first_cycle=1):
+    """RMSE and MAPE of every config, from first_cycle on.
+    MAPE is over the slots with harvested energy.
+    Returns [{'config', 'rmse', 'mape'}], in the order of configs.
+    """
+    actual = self.actual[first_cycle:]
+    results = []
+    for i, config in enumerate(self.configs):
+      err = self.errors(i)[first_cycle:]
+      valid = ~np.isnan(err)
+      lit = valid & (np.nan_to_num(actual) > 0)
+      results.append({'config': config,
+                      'rmse': np.sqrt(np.mean(err[valid]**2)),
+                      'mape': np.mean(np.abs(err[lit])/actual[lit])})
+    return results
+
+  def predictor(self, i):
+    """A MatrixPredictor for config i, for EHSimulator(predictor=...)"""
+    if self.configs[i][0] == 'ewma':
+      return MatrixPredictor(self.cycle[i], self.num_slots)
+    return MatrixPredictor(self.cycle[i], self.num_slots, slot_matrix=self.slot[i])
+
 
 if __name__ == '__main__':
-  from harvester import Harvester
-  from time import sleep
-  import random
-  
-  """
-  Test the predictor to see if the energy generated 
-  is well predicted
-  """
-  cycle_length = 24*3600 # 1 day cycle
-  exp_length = 10* cycle_length
-  slot_size = 60*10 # 10 minute slots
-
-  num_slots = exp_length / slot_size
-  slots_per_cycle = cycle_length / slot_size
-  slots = []
-  prediction = [0 for i in range(0,cycle_length/slot_size)]
-  h = Harvester(cycle_length)
-  p = Predictor(cycle_length / slot_size, 0.24)
-  random.seed()
-  for i in range(0, num_slots):
-    e_val = h.get_energy(i*slot_size, (i+1)*slot_size)
-    e_val += 0.05*random.randint(-10,10)*e_val
-    slots.append(e_val)
-    p.add_value(e_val)
-    prediction.append(p.predict(i % slots_per_cycle))
-    #sleep(0.5)
-  diffs = []
-  for i in range(slots_per_cycle, num_slots):
-    err = slots[i] - prediction[i]
-    diffs.append(err)
-
-  import matplotlib.pyplot as plt
-  plt.figure()
-  plt.plot(slots)
-  plt.title("Generated")
-  plt.figure()
-  plt.plot(prediction)
-  plt.title("Predicted")
-  plt.figure()
-  plt.plot(diffs)
-  plt.title("Errors")
-  plt.show()
+  """
+  Compare EWMA alphas and WCMA configurations on an EH trace
+  (hourly slots), by the error of the per-slot predictions.
+  """
+  import sys
+  from alg_tester import EHTrace
+
+  if len(sys.argv) > 1:
+    trace_file = sys.argv[1]
+  else:
+    trace_file = '../datasets/725315_rad_only_full_no_gaps.csv'
+  trace = EHTrace(trace_file, 3600, 3600, 25, 100)
+  bank = PredictorBank(trace.trace, trace.slots_per_cycle)
+  bank.add_ewma([i/20.0 for i in xrange(1, 20)])
+  for days in [2, 4, 8]:
+    for k in [1, 2, 3]:
+      bank.add_wcma([0.3, 0.5, 0.7, 0.9], days, k)
+  for r in sorted(bank.evaluate(), key=lambda r: r['rmse']):
+    print "%-28s RMSE %8.3f MAPE %6.3f" % (r['config'], r['rmse'], r['mape'])
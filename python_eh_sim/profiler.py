@@ -0,0 +1,150 @@
+"""
+Opt-in profiler for the allocation algorithms.
+
+enable() replaces the profiled functions (see targets) with timed
+wrappers and disable() puts the originals back, so there is no cost
+at all while the profiler is disabled:
+
+    import profiler
+    profiler.enable()
+    runsim(trace, algorithms, ehct.bmax, False)
+    profiler.disable()
+    profiler.write_report('profile.json')
+
+Profiled are the phases of MALLEC's simple_optimum and the allocate and
+update of every algorithm. Times are inclusive: a phase's time is also
+part of the allocate that ran it. An algorithm calling its own allocate
+from update (Buchli) is timed once, as update.
+
+While enabled, the simulator's cycles are tracked too, so the report
+has, for every target, the distribution of its time per cycle.
+The profiler only sees the process it runs in: profile simulations
+with processes=1.
+"""
+import json
+from timeit import default_timer
+
+import numpy as np
+
+# name -> (module, class or None, function)
+targets = {
+        'mallec.first_pass': ('optimised_scheduler_for_energy_neutrality', None, 'first_pass'),
+        'mallec.second_pass': ('optimised_scheduler_for_energy_neutrality', None, 'second_pass'),
+        'mallec.offset_correction': ('optimised_scheduler_for_energy_neutrality', None, 'offset_correction'),
+        'mallec.apply_changes': ('optimised_scheduler_for_energy_neutrality', None, 'apply_changes'),
+        'mallec.compute_battery': ('optimised_scheduler_for_energy_neutrality', None, 'compute_battery'),
+        'mallec.allocate': ('optimised_scheduler_for_energy_neutrality', 'MallecOptimal', 'allocate'),
+        'mallec.update': ('optimised_scheduler_for_energy_neutrality', 'MallecOptimal', 'update'),
+        'kansal.allocate': ('_kansal', 'Kansal', 'allocate'),
+        'kansal.update': ('_kansal', 'Kansal', 'update'),
+        'buchli.allocate': ('_buchli', 'Buchli', 'allocate'),
+        'buchli.update': ('_buchli', 'Buchli', 'update'),
+        'gorlatova.allocate': ('gorlatova', 'Gorlatova', 'allocate'),
+        'gorlatova.update': ('gorlatova', 'Gorlatova', 'update'),
+        }
+
+_originals = {}     # (owner object, attribute) -> original
+_active = set()     # classes with a timed method running
+_calls = {}
+_total = {}
+_cycle = {}         # time in the current cycle
+_per_cycle = {}     # time in each (complete) cycle
+_cycles = [0]
+
+def _record(name, elapsed):
+    _calls[name] = _calls.get(name, 0) + 1
+    _total[name] = _total.get(name, 0.0) + elapsed
+    _cycle[name] = _cycle.get(name, 0.0) + elapsed
+
+def _timed(name, owner, func):
+    def timed(*args, **kwargs):
+        if owner in _active:
+            return func(*args, **kwargs)
+        _active.add(owner)
+        start = default_timer()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _record(name, default_timer() - start)
+            _active.discard(owner)
+    timed.__name__ = func.__name__
+    timed.__doc__ = func.__doc__
+    return timed
+
+def _patch(obj, attr, wrapper):
+    if (obj, attr) not in _originals:
+        _originals[(obj, attr)] = obj.__dict__[attr]
+    setattr(obj, attr, wrapper)
+
+def enable(names=None):
+    """Start profiling the targets, all of them by default"""
+    from importlib import import_module
+    import alg_tester
+    for name in (names or targets):
+        module, cls, func = targets[name]
+        obj = import_module(module)
+        if cls is not None:
+            obj = getattr(obj, cls)
+        if (obj, func) in _originals:
+            continue
+        _patch(obj, func, _timed(name, cls or name, obj.__dict__[func]))
+    # a new cycle starts with slot 0
+    simulate_slot = alg_tester.EHSimulator.__dict__['simulate_slot']
+    if (alg_tester.EHSimulator, 'simulate_slot') not in _originals:
+        def tracked(self, _idx, eh, observed):
+            if _idx == 0:
+                new_cycle()
+            return simulate_slot(self, _idx, eh, observed)
+        _patch(alg_tester.EHSimulator, 'simulate_slot', tracked)
+
+def disable():
+    """Stop profiling, the results are kept until reset"""
+    for (obj, attr), original in _originals.items():
+        setattr(obj, attr, original)
+    _originals.clear()
+    _active.clear()
+
+def reset():
+    """Forget the results so far"""
+    for d in (_calls, _total, _cycle, _per_cycle):
+        d.clear()
+    _cycles[0] = 0
+
+def new_cycle():
+    """Close the current cycle; called by the simulator while enabled"""
+    if _cycle:
+        for name, elapsed in _cycle.items():
+            _per_cycle.setdefault(name, []).append(elapsed)
+        _cycle.clear()
+        _cycles[0] += 1
+
+def report(raw=False):
+    """The results so far, as a dictionary:
+    {'cycles': n, 'targets': {name: {'calls', 'total', 'mean',
+     'per_cycle': {'cycles', 'mean', 'std', 'min', 'p50', 'p90', 'p99', 'max'}}}}
+    Times are in seconds. With raw, per_cycle also has the 'times' of
+    every cycle.
+    """
+    new_cycle()
+    rez = {'cycles': _cycles[0], 'targets': {}}
+    for name in sorted(_calls):
+        times = np.array(_per_cycle.get(name, []))
+        per_cycle = {'cycles': len(times)}
+        if len(times):
+            per_cycle.update({'mean': times.mean(), 'std': times.std(),
+                    'min': times.min(), 'max': times.max(),
+                    'p50': np.percentile(times, 50),
+                    'p90': np.percentile(times, 90),
+                    'p99': np.percentile(times, 99)})
+            if raw:
+                per_cycle['times'] = times.tolist()
+        rez['targets'][name] = {'calls': _calls[name],
+                'total': _total[name],
+                'mean': _total[name]/_calls[name],
+                'per_cycle': per_cycle}
+    return rez
+
+def write_report(filename, raw=False):
+    """Write report() to a JSON file"""
+    with open(filename, 'w') as f:
+        json.dump(report(raw), f, indent=1, sort_keys=True)
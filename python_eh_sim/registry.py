@@ -0,0 +1,78 @@
+"""
+The power management algorithms, by name.
+
+An algorithm's module is imported the first time the algorithm is made,
+so that a run only loads the algorithms it simulates:
+
+    alg = registry.make_algorithm('mallec', trace, bmax=64800, correction='replan')
+
+Other algorithms are added with register(name, factory), or named as
+'module:factory' (e.g. in a runner.py configuration), factory being a
+function (trace, **parameters) returning the algorithm.
+"""
+import importlib
+
+def kansal(trace, eta=1, **options):
+    import _kansal
+    # Kansal with eta = 1
+    return _kansal.Kansal(eta, trace.slots_per_cycle, trace.slot_length, **options)
+
+def mallec(trace, bmin=None, bmax=None, **options):
+    import optimised_scheduler_for_energy_neutrality as module
+    return module.MallecOptimal(trace.slots_per_cycle, bmin, bmax, **options)
+
+def buchli(trace, epsilon=10, bmin=None, bmax=None, **options):
+    import _buchli
+    # Buchli with epsilon = 10
+    return _buchli.Buchli(epsilon, trace.slots_per_cycle, bmin, bmax, **options)
+
+def gorlatova(trace, bmin=None, **options):
+    import gorlatova as module
+    return module.Gorlatova(trace.slots_per_cycle, bmin, **options)
+
+# name -> factory(trace, **parameters); each factory takes the parameters
+# of make_algorithm it uses, and the options of the algorithm's constructor
+factories = {
+        'kansal': kansal,
+        'mallec': mallec,
+        'buchli': buchli,
+        'gorlatova': gorlatova,
+        }
+
+# the parameters common to all the algorithms, and those they use
+parameters = {
+        'kansal': ('eta',),
+        'mallec': ('bmin', 'bmax'),
+        'buchli': ('epsilon', 'bmin', 'bmax'),
+        'gorlatova': ('bmin',),
+        }
+
+def register(name, factory, uses=('bmin', 'bmax')):
+    """Add an algorithm: factory(trace, **parameters), taking the
+    parameters in uses (of eta, epsilon, bmin, bmax) and any options"""
+    factories[name] = factory
+    parameters[name] = tuple(uses)
+
+def factory(name):
+    """The factory of an algorithm, imported if named as 'module:factory'"""
+    if name in factories:
+        return factories[name]
+    if ':' in name:
+        module, function = name.split(':', 1)
+        return getattr(importlib.import_module(module), function)
+    raise ValueError("Unknown algorithm %s" % name)
+
+def make_algorithm(name, trace, eta=1, epsilon=10, bmin=None, bmax=None, **options):
+    """
+    Instantiate algorithm name for the given trace.
+
+    eta         -- Kansal's storage efficiency
+    epsilon     -- Buchli's convergence threshold
+    bmin, bmax  -- battery thresholds, default from eh_constants
+    options     -- passed to the algorithm, e.g. engine, correction
+    """
+    common = {'eta': eta, 'epsilon': epsilon, 'bmin': bmin, 'bmax': bmax}
+    uses = parameters.get(name, ('bmin', 'bmax'))
+    kwargs = dict([(p, common[p]) for p in uses])
+    kwargs.update(options)
+    return factory(name)(trace, **kwargs)
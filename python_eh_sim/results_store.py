@@ -0,0 +1,157 @@
+"""
+A store of simulation results, with the per-slot traces of every run.
+
+Every run is one algorithm simulated over one trace with one
+configuration. Its metadata and totals are a row in a SQLite database,
+and its per-slot metrics (SimAlg.view) are one .npy file per column,
+so that any column of any run can be memory mapped and sliced without
+reading the rest of the experiment:
+
+    store = ResultsStore('results')
+    for run in store.runs(algorithm='mallec', with_oracle=False):
+        battery = store.column(run['id'], 'battery', 0, 24*7)
+
+Runs can be added from several processes at once (e.g. the workers of
+run_test.test_modes): SQLite serialises the inserts, every process has
+its own connection, and the arrays are written under a temporary name
+and renamed. A run is only listed once all its arrays are written.
+
+Store layout (a folder):
+  runs.sqlite               -- table runs, see columns
+  runs/<id>.<column>.npy    -- per-slot metrics of run <id>
+"""
+import os
+import json
+import sqlite3
+from datetime import datetime
+import numpy as np
+
+# per-slot metrics of a run, as in SimAlg.view
+slot_columns = ['allocation', 'battery', 'harvested', 'predicted', 'error_type', 'error_quantity']
+# totals of a run, as in SimAlg.summary
+total_columns = ['allocated', 'harvested', 'predicted', 'errors', 'error_quantity',
+                 'waste', 'overspent', 'final', 'slots']
+# the totals returned by SimAlg.pretty_print and runsim
+result_columns = ['allocated', 'harvested', 'error_quantity', 'final']
+
+default_store = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results_store')
+
+_schema = """
+create table if not exists runs (
+    id integer primary key autoincrement,
+    trace text,
+    trace_spec text,
+    algorithm text,
+    with_oracle integer,
+    config text,
+    created text,
+    complete integer default 0,
+    %s
+)""" % ',\n    '.join('%s real' % c for c in total_columns)
+
+def _run_dict(row):
+    run = dict(zip(row.keys(), row))
+    run['config'] = json.loads(run['config'])
+    run['trace_spec'] = json.loads(run['trace_spec'])
+    run['with_oracle'] = bool(run['with_oracle'])
+    return run
+
+class ResultsStore():
+    """Results of simulation runs, see the module documentation"""
+
+    def __init__(self, store_dir=default_store):
+        self.store_dir = store_dir
+        self.runs_dir = os.path.join(store_dir, 'runs')
+        if not os.path.isdir(self.runs_dir):
+            try:
+                os.makedirs(self.runs_dir)
+            except OSError:
+                # created by another process in the meantime
+                if not os.path.isdir(self.runs_dir):
+                    raise
+        self.db = sqlite3.connect(os.path.join(store_dir, 'runs.sqlite'), timeout=60, isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute(_schema)
+
+    def close(self):
+        self.db.close()
+
+    def add(self, sim_alg, trace, with_oracle, config=None, trace_spec=None):
+        """Store the results of a simulated algorithm.
+
+        Parameters:
+        sim_alg     -- the SimAlg of the algorithm, after the simulation
+        trace       -- name of the trace, e.g. its file
+        with_oracle -- the predictor mode
+        config      -- dictionary of the parameters of the run (JSON)
+        trace_spec  -- optional, the trace specification (JSON)
+        Returns the id of the run.
+        """
+        summary = sim_alg.summary()
+        values = [trace, json.dumps(trace_spec), sim_alg.name, int(with_oracle),
+                  json.dumps(config or {}, sort_keys=True), datetime.now().isoformat()]
+        values += [float(summary[c]) for c in total_columns]
+        cur = self.db.execute("insert into runs (trace, trace_spec, algorithm, with_oracle, config, created, %s) values (%s)"
+                              % (', '.join(total_columns), ', '.join('?'*len(values))), values)
+        run_id = cur.lastrowid
+        for column, data in sim_alg.view().items():
+            path = self._path(run_id, column)
+            with open(path + '.tmp', 'wb') as f:
+                np.save(f, data)
+            os.rename(path + '.tmp', path)
+        self.db.execute("update runs set complete = 1 where id = ?", (run_id,))
+        return run_id
+
+    def _path(self, run_id, column):
+        return os.path.join(self.runs_dir, '%d.%s.npy' % (run_id, column))
+
+    def runs(self, trace=None, algorithm=None, with_oracle=None, trace_spec=None, **config):
+        """The complete runs matching the selection, as dictionaries of
+        the runs columns, in the order they were added. trace_spec
+        selects runs by their trace specification, e.g. for a trace
+        simulated with several panel areas; config by their
+        configuration parameters, e.g. bmax=32400.
+        """
+        where = ['complete = 1']
+        args = []
+        for column, value in (('trace', trace), ('algorithm', algorithm), ('with_oracle', with_oracle)):
+            if value is not None:
+                where.append('%s = ?' % column)
+                args.append(int(value) if column == 'with_oracle' else value)
+        rows = self.db.execute("select * from runs where %s order by id" % ' and '.join(where), args)
+        runs = []
+        for row in rows:
+            run = _run_dict(row)
+            if trace_spec is not None and run['trace_spec'] != list(trace_spec):
+                continue
+            if all(run['config'].get(k) == v for k, v in config.items()):
+                runs.append(run)
+        return runs
+
+    def run(self, run_id):
+        """A complete run, by its id, see runs"""
+        row = self.db.execute("select * from runs where id = ? and complete = 1", (run_id,)).fetchone()
+        if row is None:
+            raise KeyError("No run %s" % run_id)
+        return _run_dict(row)
+
+    def column(self, run_id, column, start=None, stop=None):
+        """Slots [start:stop] of a per-slot column of a run, a read-only
+        view on the memory mapped file"""
+        if column not in slot_columns:
+            raise ValueError("Unknown column %s" % column)
+        return np.load(self._path(run_id, column), mmap_mode='r')[start:stop]
+
+    def columns(self, run_id, start=None, stop=None):
+        """All the per-slot columns of a run, see column"""
+        return dict([(c, self.column(run_id, c, start, stop)) for c in slot_columns])
+
+    def results(self, traces, algorithms, with_oracle, **config):
+        """The totals as returned by runsim, [allocated, harvested, errors,
+        final], for each trace and algorithm, as expected by
+        plotting.plot_results. The last run of each is used.
+        """
+        last = {}
+        for run in self.runs(with_oracle=with_oracle, **config):
+            last[(run['trace'], run['algorithm'])] = [run[c] for c in result_columns]
+        return [[last[(trace, alg)] for alg in algorithms] for trace in traces]
@@ -4,18 +4,19 @@ and a trace.
 
 Used 10 for epsilon
 """
-import _kansal
-import _buchli
-import gorlatova
-import optimised_scheduler_for_energy_neutrality as mallec
+import os
+import multiprocessing
 import eh_constants as ehct
+import registry
 
-from alg_tester import EHTrace, runsim
+from alg_tester import EHTrace, EHSimulator
+from results_store import ResultsStore
+from shared import SharedArrays, SharedTrace, open_trace, source_spec
 
 # Trace specification:
 # (file, measurement_interval, desired_time_slot, panel_area, div_factor)
 traces=[
-        ('../datasets/columbia_irr_only_no_gaps.csv',30,600,25,1)
+        ('../datasets/columbia_irr_only_no_gaps.csv',30,600,25,1),
         ('../datasets/724125_rad_only_full_no_gaps.csv',3600,3600,25,100),
         ('../datasets/724699_rad_only_full_no_gaps.csv',3600,3600,25,100),
         ('../datasets/724776_rad_only_full_no_gaps.csv',3600,3600,25,100),
@@ -25,32 +26,124 @@ traces=[
         ('../datasets/726930_rad_only_full_no_gaps.csv',3600,3600,25,100)
         ]
 
-def test_all(with_oracle, pickle_res = False):
+# cycles between two checkpoints of a job, see test_modes
+checkpoint_every = 30
+
+# Algorithms compared, in the order expected by plotting.plot_results
+algorithm_names = ['kansal', 'mallec', 'buchli', 'gorlatova']
+
+def make_algorithm(name, trace, eta=1, epsilon=10, bmin=None, bmax=None):
     """
-    Run all the tests for all the algorithms.
+    Instantiate algorithm name for the given trace; its module is only
+    imported then, see registry.py.
 
-    with_oracle -- True if want to use oracle, False for EWMA
-    pickle_res  -- If True will pickle the results.
+    eta         -- Kansal's storage efficiency
+    epsilon     -- Buchli's convergence threshold
+    bmin, bmax  -- battery thresholds, default from eh_constants
+    """
+    return registry.make_algorithm(name, trace, eta, epsilon, bmin, bmax)
+
+def run_job(job):
+    """
+    Simulate a single (trace, algorithm, predictor mode) job.
+    The algorithms don't interact, so this gives the same result as
+    simulating the algorithm together with the others.
+
+    job -- (trace, algorithm name, with_oracle, store, checkpoints),
+           trace being a trace specification or a SharedTrace, store being a ResultsStore folder for the
+           per-slot results, checkpoints a folder for the checkpoints of
+           the simulation, or None for either. A job that its checkpoint
+           shows finished isn't simulated again, and its run is only
+           added to the store if missing (e.g. a store set after the
+           checkpoints were written).
+    Returns [allocated, harvested, errors, final] for the algorithm.
     """
+    source, alg_name, with_oracle, store_dir, checkpoint_dir = job
+    trace_spec = source_spec(source)
+    trace = open_trace(source)
+    sim = EHSimulator(trace, ehct.bmax, with_oracle, precomputed=True)
+    sim.add_algorithm(alg_name, make_algorithm(alg_name, trace))
+    if checkpoint_dir is None:
+        rez = sim.run()[0]
+    else:
+        # resumes from the checkpoint of an interrupted run, if any
+        name = '%s_%s_%s.checkpoint' % (os.path.splitext(os.path.basename(trace_spec[0]))[0],
+                                        alg_name, 'oracle' if with_oracle else 'ewma')
+        rez = sim.run(checkpoint_every, os.path.join(checkpoint_dir, name))[0]
+    if store_dir is not None:
+        store = ResultsStore(store_dir)
+        config = {'B0': ehct.bmax, 'bmin': ehct.bmin, 'bmax': ehct.bmax, 'precomputed': True}
+        # a finished job ran before, its run is in the store unless it was
+        # interrupted before adding it
+        if not (sim.resumed_finished and store.runs(trace_spec[0], alg_name, with_oracle, trace_spec, **config)):
+            store.add(sim.algorithms[0], trace_spec[0], with_oracle, config, trace_spec)
+        store.close()
+    return rez
 
-    results = []
-    for f in traces:
-        trace = EHTrace(*f)
+def run_jobs(jobs, processes=1):
+    """
+    Run the jobs, in a pool of processes if processes != 1
+    (None uses all the cpus). Results are in the order of jobs.
+    """
+    if processes == 1:
+        return map(run_job, jobs)
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(run_job, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
 
-        algorithms = []
-        # Kansal with eta = 1
-        algorithms.append(('kansal', _kansal.Kansal(1, trace.slots_per_cycle, trace.slot_length)))
-        algorithms.append(('mallec', mallec.MallecOptimal(trace.slots_per_cycle)))
-        # Buchli with epsilon = 10
-        algorithms.append(('buchli', _buchli.Buchli(10, trace.slots_per_cycle)))
-        algorithms.append(('gorlatova', gorlatova.Gorlatova(trace.slots_per_cycle)))
+def test_all(with_oracle, pickle_res = False, processes = 1, store = None, checkpoints = None):
+    """
+    Run all the tests for all the algorithms.
 
-        results.append(runsim(trace, algorithms, ehct.bmax, with_oracle))
+    with_oracle -- True if want to use oracle, False for EWMA
+    pickle_res  -- If True will pickle the results.
+    processes   -- Number of worker processes, None for one per cpu.
+    store       -- ResultsStore folder to keep the per-slot results in
+    checkpoints -- folder for checkpoints, see test_modes
+    """
+    return test_modes([with_oracle], pickle_res, processes, store, checkpoints)[with_oracle]
 
-    if pickle_res:
-        import pickle
-        pickle.dump(results, open('comparative_analysis_results.pickle', 'w'))
+def test_modes(modes=(True, False), pickle_res = False, processes = None, store = None, checkpoints = None):
+    """
+    Run all the tests for all the algorithms and predictor modes,
+    spreading the (trace, algorithm, mode) jobs over a pool of processes.
+    With a pool, the traces and their predictions are loaded once and
+    shared with the workers (shared.SharedTrace).
 
-    return results
+    modes       -- with_oracle values to test
+    pickle_res  -- If True will pickle the results of each mode.
+    processes   -- Number of worker processes, None for one per cpu.
+    store       -- ResultsStore folder where every job adds its run, with
+                   the per-slot results; see results_store.py
+    checkpoints -- folder where every job checkpoints its simulation
+                   every checkpoint_every cycles. Running the tests again
+                   after an interruption resumes the jobs from there
+                   (finished jobs aren't simulated again).
+    Returns {with_oracle: results}, results as for test_all.
+    """
+    if checkpoints is not None and not os.path.isdir(checkpoints):
+        os.makedirs(checkpoints)
+    # the workers attach to the traces and their predictions, loaded once
+    shared = SharedArrays() if processes != 1 else None
+    try:
+        sources = dict([(f, SharedTrace(shared, EHTrace(*f), f) if shared else f) for f in traces])
+        jobs = [(sources[f], alg_name, with_oracle, store, checkpoints) for with_oracle in modes for f in traces for alg_name in algorithm_names]
+        job_results = iter(run_jobs(jobs, processes))
+    finally:
+        if shared:
+            shared.close()
 
+    all_results = {}
+    for with_oracle in modes:
+        results = []
+        for f in traces:
+            results.append([job_results.next() for alg_name in algorithm_names])
+        all_results[with_oracle] = results
+        if pickle_res:
+            import pickle
+            pickle.dump(results, open('comparative_analysis_results_%s.pickle' % ('oracle' if with_oracle else 'ewma'), 'w'))
 
+    return all_results
@@ -0,0 +1,242 @@
+"""
+Command-line runner: simulates the traces, algorithms and predictor
+modes of a JSON configuration file, e.g.
+
+    {
+        "traces": [["../datasets/725315_rad_only_full_no_gaps.csv", 3600, 3600, 25, 100]],
+        "algorithms": {"kansal": {}, "mallec": {"correction": "replan"}},
+        "parameters": {"bmin": 5000, "bmax": 64800, "eta": 1, "epsilon": 10},
+        "predictor": ["oracle", "ewma"],
+        "store": "results",
+        "processes": 4
+    }
+
+    python runner.py config.json --output results.json
+
+Only the algorithms of the configuration are imported (registry.py), and
+plotting (matplotlib) only when the configuration asks for figures, so a
+short job starts with the cost of importing numpy. Every key is optional,
+see defaults:
+  traces        -- trace specifications, as in run_test.traces
+  algorithms    -- names, or {name: options of the algorithm}; a name is
+                   a registry name or 'module:factory'
+  parameters    -- B0 (default bmax), bmin, bmax, eta, epsilon
+  predictor     -- 'oracle', 'ewma', or a list of them
+  precomputed, horizon, replan_every -- see alg_tester.EHSimulator
+  store         -- ResultsStore folder to add the runs to
+  checkpoints   -- folder to checkpoint the jobs in, see run_test.test_modes;
+                   a checkpoint is named after the trace, algorithm,
+                   predictor and a hash of the trace specification and
+                   the job's configuration
+  processes     -- worker processes, null for one per cpu
+  figures       -- with a store, arguments of plotting.export_figures,
+                   e.g. {"out_dir": "figures", "columns": ["battery"]}
+The totals of every run are written as JSON.
+"""
+import os
+import sys
+import json
+import hashlib
+import multiprocessing
+
+import eh_constants as ehct
+import registry
+
+defaults = {
+        'traces': None,             # run_test.traces
+        'algorithms': None,         # run_test.algorithm_names
+        'parameters': {},
+        'predictor': ['oracle', 'ewma'],
+        'precomputed': True,
+        'horizon': None,
+        'replan_every': None,
+        'store': None,
+        'checkpoints': None,
+        'processes': 1,
+        'figures': None,
+        }
+
+default_parameters = {'B0': None, 'bmin': ehct.bmin, 'bmax': ehct.bmax, 'eta': 1, 'epsilon': 10}
+
+predictor_modes = {'oracle': True, 'ewma': False}
+
+# cycles between two checkpoints of a job
+checkpoint_every = 30
+
+def load_config(config):
+    """
+    The configuration, from a file name or a dictionary, completed with
+    the defaults and checked.
+    Raises ValueError for unknown keys, parameters, predictors or algorithms.
+    """
+    if not isinstance(config, dict):
+        with open(config) as f:
+            config = json.load(f)
+    unknown = set(config) - set(defaults)
+    if unknown:
+        raise ValueError("Unknown configuration keys %s" % ', '.join(sorted(unknown)))
+    c = dict(defaults)
+    c.update(config)
+
+    if c['traces'] is None:
+        import run_test
+        c['traces'] = run_test.traces
+    c['traces'] = [tuple(t) for t in c['traces']]
+
+    algorithms = c['algorithms']
+    if algorithms is None:
+        import run_test
+        algorithms = run_test.algorithm_names
+    # [(name, options)], in the order given (by name for a dictionary)
+    if isinstance(algorithms, dict):
+        algorithms = sorted(algorithms.items())
+    else:
+        algorithms = [(name, {}) for name in algorithms]
+    for name, options in algorithms:
+        registry.factory(name)
+    c['algorithms'] = algorithms
+
+    unknown = set(c['parameters']) - set(default_parameters)
+    if unknown:
+        raise ValueError("Unknown parameters %s" % ', '.join(sorted(unknown)))
+    p = dict(default_parameters)
+    p.update(c['parameters'])
+    if p['B0'] is None:
+        p['B0'] = p['bmax']
+    c['parameters'] = p
+
+    modes = c['predictor']
+    if not isinstance(modes, list):
+        modes = [modes]
+    for m in modes:
+        if m not in predictor_modes:
+            raise ValueError("Unknown predictor %s" % m)
+    c['predictor'] = modes
+
+    if c['figures'] is not None and c['store'] is None:
+        raise ValueError("Figures are plotted from the store, which isn't set")
+    return c
+
+def run_job(job):
+    """
+    Simulate a single (trace, algorithm, predictor mode) job, as
+    run_test.run_job with the parameters of the configuration.
+
+    job -- (trace, algorithm name, options, predictor mode, configuration),
+           trace being a trace specification or a SharedTrace
+    Returns the summary of the algorithm, with the id of its run in the
+    store (or None). A job that its checkpoint shows finished isn't
+    simulated again, and its run is only added to the store if missing.
+    """
+    from alg_tester import EHSimulator
+    from shared import open_trace, source_spec
+    source, alg_name, options, mode, c = job
+    trace_spec = source_spec(source)
+    trace = open_trace(source)
+    p = c['parameters']
+    with_oracle = predictor_modes[mode]
+    sim = EHSimulator(trace, p['B0'], with_oracle, p['bmin'], p['bmax'], c['precomputed'],
+                      horizon=c['horizon'], replan_every=c['replan_every'])
+    sim.add_algorithm(alg_name, registry.make_algorithm(alg_name, trace, p['eta'], p['epsilon'],
+                                                        p['bmin'], p['bmax'], **options))
+    config = dict(p, precomputed=c['precomputed'], horizon=c['horizon'],
+                  replan_every=c['replan_every'], options=options)
+    if c['checkpoints'] is None:
+        sim.run()
+    else:
+        # the trace specification and the configuration are hashed into the
+        # name, so that a job whose trace (e.g. its panel area) or
+        # configuration changed doesn't resume from the previous checkpoint
+        digest = hashlib.sha1(json.dumps([trace_spec, config], sort_keys=True)).hexdigest()[:12]
+        name = '%s_%s_%s_%s.checkpoint' % (os.path.splitext(os.path.basename(trace_spec[0]))[0],
+                                           alg_name.replace(':', '_'), mode, digest)
+        sim.run(checkpoint_every, os.path.join(c['checkpoints'], name))
+    summary = dict((k, float(v)) for k, v in sim.algorithms[0].summary().items())
+    summary['run_id'] = None
+    if c['store'] is not None:
+        from results_store import ResultsStore
+        store = ResultsStore(c['store'])
+        runs = []
+        if sim.resumed_finished:
+            # the job ran before, its run is in the store unless it changed
+            runs = store.runs(trace_spec[0], alg_name, with_oracle, trace_spec, **config)
+        if runs:
+            summary['run_id'] = runs[-1]['id']
+        else:
+            summary['run_id'] = store.add(sim.algorithms[0], trace_spec[0], with_oracle, config, trace_spec)
+        store.close()
+    return summary
+
+def write_results(results, out):
+    """Write the results of run as JSON to out, a file or a file name"""
+    if not hasattr(out, 'write'):
+        with open(out, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+        return
+    json.dump(results, out, indent=1, sort_keys=True)
+    out.write('\n')
+    out.flush()
+
+def run(config, out=None):
+    """
+    Run the simulations of a configuration (file name or dictionary,
+    see the module documentation).
+    out -- where to write the results (see write_results), before the
+           figures are drawn, so that they are kept if plotting fails
+    Returns a list of {trace, algorithm, predictor, totals..., run_id},
+    in the order of the traces, predictor modes and algorithms.
+    """
+    c = load_config(config)
+    if c['checkpoints'] is not None and not os.path.isdir(c['checkpoints']):
+        os.makedirs(c['checkpoints'])
+    keys = [(t, mode, a) for t in c['traces'] for mode in c['predictor'] for a in c['algorithms']]
+    if c['processes'] == 1:
+        jobs = [(t, a, options, mode, c) for t, mode, (a, options) in keys]
+        summaries = map(run_job, jobs)
+    else:
+        from alg_tester import EHTrace
+        from shared import SharedArrays, SharedTrace
+        # the workers attach to the traces and their predictions, loaded once
+        shared = SharedArrays()
+        try:
+            sources = dict((t, SharedTrace(shared, EHTrace(*t), t)) for t in c['traces'])
+            jobs = [(sources[t], a, options, mode, c) for t, mode, (a, options) in keys]
+            pool = multiprocessing.Pool(c['processes'])
+            try:
+                summaries = pool.map(run_job, jobs, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            shared.close()
+
+    results = []
+    for (t, mode, (a, options)), summary in zip(keys, summaries):
+        summary.update({'trace': t[0], 'algorithm': a, 'predictor': mode})
+        results.append(summary)
+    if out is not None:
+        write_results(results, out)
+
+    if c['figures'] is not None:
+        import plotting
+        for mode in c['predictor']:
+            plotting.export_figures(c['store'], with_oracle=predictor_modes[mode], **c['figures'])
+    return results
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Simulate the traces and algorithms of a configuration')
+    parser.add_argument('config', help='JSON configuration file')
+    parser.add_argument('--output', help='where to write the results, default the standard output')
+    parser.add_argument('--processes', type=int, help='worker processes, overrides the configuration')
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        config = json.load(f)
+    if args.processes is not None:
+        config['processes'] = args.processes
+    out = sys.stdout
+    if args.output is None:
+        # what the simulations print goes to the standard error
+        sys.stdout = sys.stderr
+    run(config, out if args.output is None else args.output)
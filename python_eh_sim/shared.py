@@ -0,0 +1,141 @@
+"""
+Arrays shared with worker processes, without copies.
+
+A SharedArrays is a folder of .npy files in /dev/shm (in memory; the
+temporary folder where there is none). The parent process publishes
+arrays once, and the workers attach to them by name, as read-only
+memory mapped views on the same pages: nothing is pickled or copied per
+worker, however many there are.
+
+A SharedArrays is pickled as its name, and so is a SharedTrace, which
+publishes a trace with its oracle and EWMA prediction matrices:
+
+    with SharedArrays() as shared:
+        source = SharedTrace(shared, EHTrace(*trace_spec), trace_spec)
+        pool = multiprocessing.Pool(None, init, (source,))
+        ...
+    # in the workers
+    def init(source):
+        trace = open_trace(source)      # an EHTrace, with its matrices
+
+open_trace also takes a trace specification, for the same code to run
+with or without sharing. The folder is removed when the SharedArrays
+that created it is closed. (The NSRDB trace_store is memory mapped
+already, and shared through the page cache.)
+"""
+import os
+import shutil
+import tempfile
+import numpy as np
+
+import eh_constants as ehct
+from alg_tester import EHTrace
+
+shm_dir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+class SharedArrays(object):
+    """A named set of shared read-only arrays, see the module documentation"""
+
+    def __init__(self, name=None, root=shm_dir):
+        """
+        name    -- of an existing set, to attach to it; by default a new
+                   set is created (and removed by close)
+        root    -- folder of the sets
+        """
+        self.owner = name is None
+        if self.owner:
+            self.path = tempfile.mkdtemp(prefix='eh_sim_', dir=root)
+        else:
+            self.path = os.path.join(root, name)
+            if not os.path.isdir(self.path):
+                raise ValueError("No shared arrays %s" % name)
+        self.name = os.path.basename(self.path)
+        self.root = root
+
+    def __getstate__(self):
+        return {'name': self.name, 'root': self.root}
+
+    def __setstate__(self, state):
+        self.__init__(state['name'], state['root'])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Remove the set, if this created it; the views attached
+        remain valid"""
+        if self.owner and os.path.isdir(self.path):
+            shutil.rmtree(self.path)
+
+    def _file(self, key):
+        return os.path.join(self.path, key + '.npy')
+
+    def publish(self, key, array):
+        """Share an array under key; returns the attached view"""
+        tmp_file = '%s.%d.tmp' % (self._file(key), os.getpid())
+        with open(tmp_file, 'wb') as f:
+            np.save(f, np.asarray(array))
+        os.rename(tmp_file, self._file(key))
+        return self.attach(key)
+
+    def attach(self, key):
+        """The array shared under key, a read-only memory mapped view"""
+        return np.load(self._file(key), mmap_mode='r')
+
+    def unique_key(self, prefix):
+        """prefix and a number, not used by any array of the set yet
+        (as key, or as the start of a key followed by a dot)"""
+        used = set(f.split('.')[0] for f in os.listdir(self.path))
+        n = 0
+        while '%s%d' % (prefix, n) in used:
+            n += 1
+        return '%s%d' % (prefix, n)
+
+    def __contains__(self, key):
+        return os.path.exists(self._file(key))
+
+class SharedTrace(object):
+    """An EHTrace published in a SharedArrays with its prediction
+    matrices (the oracle's and the EWMA's for each of alphas). It is
+    passed to the workers instead of the trace; attach gives the trace.
+    """
+
+    def __init__(self, shared, trace, spec=None, alphas=(ehct.pred_alpha,)):
+        """
+        spec    -- the trace specification, if any, e.g. for results_store
+        """
+        self.shared = shared
+        self.spec = spec
+        self.key = shared.unique_key('trace')
+        self.attributes = (trace.sampling_interval, trace.slot_length, trace.panel_area, trace.div_factor)
+        self.alphas = list(alphas)
+        shared.publish(self.key + '.trace', trace.trace)
+        shared.publish(self.key + '.cycles', trace.cycle_matrix())
+        for i, alpha in enumerate(self.alphas):
+            shared.publish('%s.ewma%d' % (self.key, i), trace.ewma_matrix(alpha))
+
+    def attach(self):
+        """The EHTrace, on the shared arrays"""
+        sampling_interval, slot_length, panel_area, div_factor = self.attributes
+        trace = EHTrace.from_slots(self.shared.attach(self.key + '.trace'), slot_length, panel_area, div_factor)
+        trace.sampling_interval = sampling_interval
+        # the matrices EHTrace would compute, see cycle_matrix and ewma_matrix
+        trace._matrices['cycles'] = self.shared.attach(self.key + '.cycles')
+        for i, alpha in enumerate(self.alphas):
+            trace._matrices[alpha] = self.shared.attach('%s.ewma%d' % (self.key, i))
+        return trace
+
+def open_trace(source):
+    """The EHTrace of a SharedTrace, or loaded from a trace specification"""
+    if isinstance(source, SharedTrace):
+        return source.attach()
+    return EHTrace(*source)
+
+def source_spec(source):
+    """The trace specification of a SharedTrace, or the specification itself"""
+    if isinstance(source, SharedTrace):
+        return source.spec
+    return source
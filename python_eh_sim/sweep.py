@@ -0,0 +1,162 @@
+"""
+Parameter sweeps over battery, panel and algorithm parameters.
+
+A sweep runs the algorithms over the Cartesian product of the parameter
+values in a grid, e.g.
+
+    rows = sweep(('../datasets/725315_rad_only_full_no_gaps.csv',3600,3600,25,100),
+                 {'bmax': [16200, 32400, 64800], 'panel_area': [10, 25, 50]},
+                 with_oracle=False, processes=None)
+    write_csv(rows, 'sweep.csv')
+
+and returns a tidy table: one row (dict) per grid point and algorithm.
+
+The trace is loaded and aggregated once, and shared with the workers
+(shared.SharedTrace). The harvested energy is linear in the panel area
+and divisor, so other values only rescale it.
+Each algorithm is simulated once per combination of the parameters that
+affect it (e.g. Kansal doesn't depend on epsilon), and the simulations
+are scheduled grouped by panel area and divisor.
+"""
+import itertools
+import multiprocessing
+
+import eh_constants as ehct
+from alg_tester import EHTrace, runsim
+from shared import SharedArrays, SharedTrace, open_trace
+import run_test
+
+# Swept parameters and the algorithms they affect (None for all)
+parameters = {
+        'bmin': None,
+        'bmax': None,
+        'B0': None,
+        'panel_area': None,
+        'div_factor': None,
+        'eta': ['kansal'],
+        'epsilon': ['buchli'],
+        }
+param_order = ['panel_area', 'div_factor', 'bmin', 'bmax', 'B0', 'eta', 'epsilon']
+result_columns = ['allocated', 'harvested', 'errors', 'final']
+
+def defaults(trace_spec):
+    """Parameter values used for anything not in the grid"""
+    return {'bmin': ehct.bmin, 'bmax': ehct.bmax, 'B0': ehct.bmax,
+            'panel_area': trace_spec[3], 'div_factor': trace_spec[4],
+            'eta': 1, 'epsilon': 10}
+
+def relevant(param, alg_name):
+    return parameters[param] is None or alg_name in parameters[param]
+
+# per-process state, see _init_worker
+_base_trace = None
+_scaled = {}
+
+def _init_worker(source):
+    global _base_trace, _scaled
+    _base_trace = open_trace(source)
+    _scaled = {}
+
+def _trace_for(panel_area, div_factor):
+    key = (panel_area, div_factor)
+    if key not in _scaled:
+        if key == (_base_trace.panel_area, _base_trace.div_factor):
+            _scaled[key] = _base_trace
+        else:
+            _scaled[key] = _base_trace.rescaled(panel_area, div_factor)
+    return _scaled[key]
+
+def _run_point(job):
+    """Simulate one algorithm for one set of parameters.
+    A failed simulation (e.g. MALLEC finding no solution) gives NaNs.
+    """
+    alg_name, p, with_oracle = job
+    trace = _trace_for(p['panel_area'], p['div_factor'])
+    alg = run_test.make_algorithm(alg_name, trace, p['eta'], p['epsilon'], p['bmin'], p['bmax'])
+    try:
+        return runsim(trace, [(alg_name, alg)], p['B0'], with_oracle, p['bmin'], p['bmax'], True)[0]
+    except Exception, e:
+        print "Sweep: %s failed for %s: %r" % (alg_name, p, e)
+        return [float('nan')]*len(result_columns)
+
+def grid_points(grid, base):
+    """All the parameter combinations of grid, as dicts completed from base.
+    Unless swept, B0 is the (swept) bmax, as in run_test.
+    """
+    names = [n for n in param_order if n in grid]
+    for values in itertools.product(*[grid[n] for n in names]):
+        p = dict(base)
+        p.update(zip(names, values))
+        if 'B0' not in grid:
+            p['B0'] = p['bmax']
+        yield p
+
+def sweep(trace_spec, grid, algorithms=None, with_oracle=True, processes=1):
+    """
+    Run the algorithms for every point of the parameter grid.
+
+    trace_spec  -- (file, measurement_interval, time_slot, panel_area, div_factor),
+                   as in run_test.traces
+    grid        -- {parameter: list of values}, parameters are the keys of
+                   sweep.parameters
+    algorithms  -- algorithm names, default run_test.algorithm_names
+    with_oracle -- True for the oracle predictor, False for EWMA
+    processes   -- number of worker processes, None for one per cpu
+    Returns a list of rows {parameter: value, 'algorithm', 'allocated',
+    'harvested', 'errors', 'final'}, ordered by grid point and algorithm.
+    """
+    for n in grid:
+        if n not in parameters:
+            raise ValueError("Can't sweep over %s" % n)
+    if algorithms is None:
+        algorithms = run_test.algorithm_names
+    base = defaults(trace_spec)
+    points = list(grid_points(grid, base))
+
+    # one simulation per algorithm and distinct relevant parameters
+    runs = {}
+    for p in points:
+        for alg_name in algorithms:
+            key = (alg_name,) + tuple([p[n] for n in param_order if relevant(n, alg_name)])
+            if key not in runs:
+                runs[key] = dict(p)
+    # group by trace scaling, so each worker reuses its rescaled trace
+    keys = sorted(runs, key=lambda k: (runs[k]['panel_area'], runs[k]['div_factor'], k))
+    jobs = [(k[0], runs[k], with_oracle) for k in keys]
+    print "Sweep: %d grid points, %d simulations" % (len(points), len(jobs))
+
+    if processes == 1:
+        _init_worker(trace_spec)
+        results = map(_run_point, jobs)
+    else:
+        shared = SharedArrays()
+        try:
+            source = SharedTrace(shared, EHTrace(*trace_spec), trace_spec)
+            pool = multiprocessing.Pool(processes, _init_worker, (source,))
+            try:
+                chunk = max(1, len(jobs)/(4*(processes or multiprocessing.cpu_count())))
+                results = pool.map(_run_point, jobs, chunksize=chunk)
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            shared.close()
+    by_key = dict(zip(keys, results))
+
+    rows = []
+    for p in points:
+        for alg_name in algorithms:
+            key = (alg_name,) + tuple([p[n] for n in param_order if relevant(n, alg_name)])
+            row = dict([(n, p[n]) for n in param_order])
+            row['algorithm'] = alg_name
+            row.update(zip(result_columns, by_key[key]))
+            rows.append(row)
+    return rows
+
+def write_csv(rows, filename):
+    """Write the rows returned by sweep to a csv file"""
+    columns = param_order + ['algorithm'] + result_columns
+    with open(filename, 'w') as f:
+        f.write(','.join(columns) + '\n')
+        for row in rows:
+            f.write(','.join([str(row[c]) for c in columns]) + '\n')
@@ -0,0 +1,178 @@
+"""
+A consolidated, read-only store of the NSRDB traces.
+
+All the stations are kept in a single array of irradiance samples, with
+one row per day, which is memory mapped when the store is opened. The
+store also indexes every day by station, year and day of the year, so
+that any subset (e.g. station 725315, summer of 2003) can be opened as
+a view on the mapped array. Simulations opening the same store share one
+page-cache copy of the data.
+
+The data sets don't carry dates. Days are assigned to dates sequentially,
+starting on the 1st of January of the station's first year (see
+datasets/README.md). The pre-processing removed whole days, and where
+they were removed isn't recorded, so after the first removed day a day
+is dated earlier than it was measured. The store records how many days
+each data set lacks against the calendar days of its years
+(TraceStore.date_error), which bounds that shift: 724699 lacks 16 days,
+725315 7, 726830 6, 724776 2, 726883 and 726930 1, 724125 none.
+
+Store layout (a folder):
+  samples.npy   -- float32, (days, samples_per_day), irradiance in uW/cm2
+  station.npy   -- int16, index of the station of each day
+  year.npy      -- int16, year of each day
+  yday.npy      -- int16, day of the year (1-366)
+  month.npy     -- int8, month of each day (1-12)
+  index.json    -- stations, their rows in samples.npy and sampling interval
+"""
+import os
+import json
+from datetime import date, timedelta
+import numpy as np
+
+from alg_tester import read_samples
+
+# station -> first and last year in the data set, see datasets/README.md
+stations = {
+        '724125': (2001, 2005),
+        '724699': (1996, 2005),
+        '724776': (1995, 2002),
+        '725315': (2000, 2005),
+        '726830': (1995, 2005),
+        '726883': (1995, 2005),
+        '726930': (1992, 2005),
+        }
+trace_suffix = '_rad_only_full_no_gaps.csv'
+sampling_interval = 3600    # all NSRDB data sets have hourly samples
+
+seasons = {
+        'winter': (12, 1, 2),
+        'spring': (3, 4, 5),
+        'summer': (6, 7, 8),
+        'autumn': (9, 10, 11),
+        }
+
+default_store = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'datasets', 'nsrdb_store')
+default_datasets = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'datasets')
+
+def build_store(datasets_dir=default_datasets, store_dir=default_store):
+    """Consolidate the station traces from datasets_dir into a store.
+    Returns the opened store.
+    """
+    samples_per_day = 24*3600/sampling_interval
+    index = {'sampling_interval': sampling_interval, 'stations': []}
+    all_samples = []
+    station_col, year_col, yday_col, month_col = [], [], [], []
+    row = 0
+    for st_idx, station in enumerate(sorted(stations)):
+        trace_file = os.path.join(datasets_dir, station + trace_suffix)
+        if not os.path.exists(trace_file):
+            print "Skipping station", station, "no trace file"
+            continue
+        samples = read_samples(trace_file)
+        days = len(samples)/samples_per_day
+        if days*samples_per_day != len(samples):
+            print "Station", station, "has an incomplete last day, dropped"
+        all_samples.append(samples[:days*samples_per_day].astype(np.float32).reshape(days, samples_per_day))
+        first_year, last_year = stations[station]
+        first = date(first_year, 1, 1)
+        # days removed by the pre-processing, somewhere in the data set
+        missing = (date(last_year + 1, 1, 1) - first).days - days
+        for d in xrange(days):
+            day = first + timedelta(days=d)
+            station_col.append(st_idx)
+            year_col.append(day.year)
+            yday_col.append(day.timetuple().tm_yday)
+            month_col.append(day.month)
+        index['stations'].append({'station': station, 'index': st_idx, 'first_row': row, 'days': days,
+                                  'missing_days': missing})
+        row += days
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+    np.save(os.path.join(store_dir, 'samples.npy'), np.concatenate(all_samples))
+    np.save(os.path.join(store_dir, 'station.npy'), np.array(station_col, dtype=np.int16))
+    np.save(os.path.join(store_dir, 'year.npy'), np.array(year_col, dtype=np.int16))
+    np.save(os.path.join(store_dir, 'yday.npy'), np.array(yday_col, dtype=np.int16))
+    np.save(os.path.join(store_dir, 'month.npy'), np.array(month_col, dtype=np.int8))
+    with open(os.path.join(store_dir, 'index.json'), 'w') as f:
+        json.dump(index, f, indent=1)
+    return TraceStore(store_dir)
+
+class TraceStore():
+    """Read-only, memory mapped view of a store built with build_store."""
+
+    def __init__(self, store_dir=default_store):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, 'index.json')) as f:
+            index = json.load(f)
+        self.sampling_interval = index['sampling_interval']
+        self.stations = dict([(s['station'], s) for s in index['stations']])
+        self.samples = np.load(os.path.join(store_dir, 'samples.npy'), mmap_mode='r')
+        self.station = np.load(os.path.join(store_dir, 'station.npy'), mmap_mode='r')
+        self.year = np.load(os.path.join(store_dir, 'year.npy'), mmap_mode='r')
+        self.yday = np.load(os.path.join(store_dir, 'yday.npy'), mmap_mode='r')
+        self.month = np.load(os.path.join(store_dir, 'month.npy'), mmap_mode='r')
+
+    def date_error(self, station):
+        """The most days by which a day of station can be dated too early:
+        the days missing from its data set, see the module documentation"""
+        return self.stations[str(station)]['missing_days']
+
+    def years(self, station):
+        """The years available for station"""
+        st = self.stations[station]
+        return sorted(set(self.year[st['first_row']:st['first_row']+st['days']]))
+
+    def day_rows(self, station, year=None, season=None, yday=None):
+        """Rows of the store (days) matching the selection.
+
+        Parameters:
+        station     -- station id, e.g. '725315'
+        year        -- a year, or a (first, last) tuple of years, inclusive
+        season      -- one of the keys of seasons
+        yday        -- a (first, last) tuple of days of the year, inclusive
+        """
+        st = self.stations[str(station)]
+        first, last = st['first_row'], st['first_row'] + st['days']
+        mask = np.ones(last - first, dtype=bool)
+        if year is not None:
+            if isinstance(year, tuple):
+                y0, y1 = year
+            else:
+                y0 = y1 = year
+            mask &= (self.year[first:last] >= y0) & (self.year[first:last] <= y1)
+        if season is not None:
+            mask &= np.in1d(self.month[first:last], seasons[season])
+        if yday is not None:
+            mask &= (self.yday[first:last] >= yday[0]) & (self.yday[first:last] <= yday[1])
+        return np.flatnonzero(mask) + first
+
+    def select(self, station, year=None, season=None, yday=None):
+        """The irradiance samples of the selection (see day_rows) as a flat
+        array. If the selected days are consecutive, which is the case for
+        any single season except winter, this is a read-only view on the
+        memory mapped store; otherwise the days are copied.
+        """
+        rows = self.day_rows(station, year, season, yday)
+        if len(rows) == 0:
+            return self.samples[0:0].reshape(-1)
+        if rows[-1] - rows[0] + 1 == len(rows):
+            return self.samples[rows[0]:rows[-1]+1].reshape(-1)
+        return self.samples[rows].reshape(-1)
+
+    def select_spec(self, spec):
+        """Select using a short description such as '725315, 2003 summer'
+        or '726930 1995-1999'.
+        """
+        station, year, season = None, None, None
+        for tok in spec.replace(',', ' ').split():
+            if tok in seasons:
+                season = tok
+            elif tok in self.stations:
+                station = tok
+            elif '-' in tok:
+                y0, y1 = tok.split('-')
+                year = (int(y0), int(y1))
+            else:
+                year = int(tok)
+        return self.select(station, year, season)